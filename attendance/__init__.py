@@ -9,6 +9,8 @@ from flask_principal import Principal, RoleNeed, ActionNeed, Permission, identit
 from flask_sqlalchemy import *
 
 executor = ThreadPoolExecutor(2)
+# Uploaded files are imported one at a time, away from the solver jobs
+import_executor = ThreadPoolExecutor(1)
 app = Flask(__name__)
 
 app.config['LOGGING_FILE'] = appcfg['log']
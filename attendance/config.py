@@ -52,7 +52,75 @@ appcfg = {
         "subject_name": "Final Subject Name",
         "study_period": "Study Period"
     },
+    # Number of enrolment rows populate_students imports and commits at a time
+    "enrolment_import_chunk_size": 5000,
     "max_class_size": 16,
     "min_class_size": 0,
-    "default_room_capacity": 20
+    "default_room_capacity": 20,
+    # How the solver is run: "process" solves in a separate worker process, "thread" solves in the web server
+    "solver_mode": "process",
+    # Memory limit for the solver worker process in megabytes (None for no limit)
+    "solver_memory_limit": 4096,
+    # Wall clock limit for the solver worker process in seconds (None for no limit)
+    "solver_timeout": 3600,
+    # Check the timetable data for obvious infeasibilities before queueing the solver, and fail the job straight away
+    # if there are any
+    "solver_feasibility_check": True,
+    # Race the solver_portfolio_configurations in parallel worker processes and keep the first optimal timetable
+    "solver_portfolio": False,
+    # Solver configurations for the portfolio. "options" are extra CBC options for the timetable stage and any other
+    # key replaces the config value of the same name for that configuration only.
+    "solver_portfolio_configurations": [
+        {"name": "default"},
+        {"name": "tight", "solver_tight_formulation": True},
+        {"name": "cohorts", "solver_cohorts": True},
+        {"name": "nocuts", "options": ["cuts off"]},
+        {"name": "noheuristics", "options": ["heuristicsOnOff off"]},
+        {"name": "seed", "options": ["randomSeed 7", "randomCbcSeed 7"]}
+    ],
+    # Split the timetable into independent groups of subjects and solve them in parallel worker processes
+    "solver_decompose": False,
+    # Number of processes for parallel solves (None for one per CPU)
+    "solver_processes": None,
+    # Place students with identical enrolments together as cohorts in the first stage model
+    "solver_cohorts": False,
+    # Use the tightened first stage formulation with symmetry breaking between identical students
+    "solver_tight_formulation": False,
+    # Cache optimal solver results on disk, keyed by a hash of the timetable data and solver settings, so unchanged
+    # data is not solved again
+    "solver_cache": False,
+    # Directory for the solver cache (None for a solvercache directory in the upload directory)
+    "solver_cache_dir": None,
+    # Remove cached results not used for this many days
+    "solver_cache_max_age": 30,
+    # Maximum size of the solver cache in megabytes
+    "solver_cache_max_size": 500,
+    # Time limit in seconds for completing a starting solution from a previous timetable
+    "solver_warm_start_time_limit": 60,
+    # Time limit in seconds for the local search timetable engine when the timetable stage has no time limit set
+    "solver_local_search_time_limit": 60,
+    # Time limit in seconds for the large neighbourhood search engine when the timetable stage has no time limit set
+    "solver_lns_time_limit": 120,
+    # Time limit in seconds for each neighbourhood the large neighbourhood search re-optimises
+    "solver_lns_subproblem_time_limit": 10,
+    # Weights of the objective terms. The timetable stage counts student clashes, classes at non-preferred times,
+    # days each tutor works and projector classes beyond the projector rooms at a time; the room allocation stage
+    # counts students over a room's capacity, projector classes in projector rooms (subtracted) and rooms each tutor
+    # uses. What-if scenarios can override any of them.
+    "solver_weights": {"clash": 100, "nonpreferred": 1, "tutorday": 500, "projector": 5000, "overcapacity": 10,
+                       "projectorroom": 50, "tutorroom": 1},
+    # Largest number of what-if scenarios that can be run in one batch
+    "solver_max_scenarios": 8,
+    # Minutes a staging timetable version can be left unpublished before it is treated as abandoned and deleted
+    "timetable_staging_max_age": 60,
+    # Default CBC settings for the timetable and room allocation stages. These can be changed on the admin page.
+    # timelimit is in seconds and gap is the relative MIP gap to stop at (None for no limit), threads is the number
+    # of CBC threads (None for the CBC default) and acceptfeasible keeps the best timetable found when the time limit
+    # is reached before it is proven optimal. The timetable engine is "milp" for the single model, "sectioned" to
+    # place the classes first and then section the students, "localsearch" for the CBC free heuristic or "lns" to
+    # improve a timetable one part at a time with CBC, and the room allocation engine is "milp" or "heuristic".
+    "solver_settings": {
+        "timetable": {"timelimit": None, "gap": None, "threads": None, "acceptfeasible": False, "engine": "milp"},
+        "rooms": {"timelimit": None, "gap": None, "threads": None, "acceptfeasible": False, "engine": "milp"}
+    }
 }
@@ -1,283 +1,2788 @@
+import hashlib
+import json
+import math
+import multiprocessing
+import multiprocessing.connection
+import numpy
 import os
 import pandas
+import random
+import re
+import resource
+import shutil
+import signal
+import tempfile
 from docx import Document
 from pandas import ExcelFile
-from pulp import LpProblem, LpMinimize, lpSum, LpVariable, LpStatus, LpInteger, LpBinary
+from pulp import LpProblem, LpMinimize, lpSum, LpVariable, LpStatus, LpInteger, LpBinary, value, PULP_CBC_CMD
+from pulp.constants import LpSolutionIntegerFeasible
+from sqlalchemy.exc import IntegrityError
 import datetime
 import time
-from attendance import app, db, executor
+from concurrent.futures import ProcessPoolExecutor
+from attendance import app, db, executor, import_executor
+from attendance.config import appcfg
+from attendance.instance import ProblemInstance
 from attendance.models import *
 import attendance.models
-from attendance.forms import AddTimetableForm
 
 #TIMETABLE CODE
-def runtimetable_with_rooms_two_step(STUDENTS, SUBJECTS, TIMES, day, DAYS, TEACHERS, SUBJECTMAPPING, REPEATS,
-                                     TEACHERMAPPING,
-                                     TUTORAVAILABILITY, maxclasssize, minclasssize, ROOMS, PROJECTORS, PROJECTORROOMS, numroomsprojector, NONPREFERREDTIMES, CAPACITIES):
+def index_timetable_data(STUDENTS, TIMES, day, DAYS, TEACHERS, SUBJECTMAPPING, TEACHERMAPPING, TUTORAVAILABILITY):
     '''
-    Run the timetabling process and input into the database.
-
-    This process calls the CBCSolver using the PuLP package and then adds the classes to the database.
+    Precompute the lookups needed to build the timetabling model.
 
+    Building the model by scanning every tutor and subject for every student and time is quadratic in the size of
+    the problem, so we walk the mappings once up front and then only ever touch the entries that exist.
 
     :param STUDENTS: should be an array of student names
-    :param SUBJECTS: should be an array of subject codes
     :param TIMES: an array of strings representing possible timeslots
-    :param day:
-    :param DAYS: the days corresponding to the timeslots above
+    :param day: an array of the days that have timeslots
+    :param DAYS: the timeslots for each day
     :param TEACHERS: an array of the names of the tutors
-    :param SUBJECTMAPPING: This is a dictionary representing the subjects
-                            each tutor is taking
-    :param REPEATS: A dictionary of how many repeats each subject has
+    :param SUBJECTMAPPING: A dictionary of the students taking each subject
     :param TEACHERMAPPING: A dictionary of what subject each tutor teachers
-    :param TUTORAVAILABILITY:
-    :param maxclasssize: An integer representing the maximum class size
-    :param minclasssize: An integer representing the minimum class size
-    :param nrooms: An integer representing the max allowable concurrent classes
-    :param CAPACITIES: A dictionary indexed by room name with the amount of people that each room can contain
-    :return: A string representing model status.
+    :param TUTORAVAILABILITY: A dictionary of the times each tutor is available
+    :return: A dictionary of indexes:
+             classes - (subject, tutor) pairs in tutor order
+             studentclasses - student -> list of (subject, tutor) pairs they must attend
+             tutortimes - tutor -> times in TIMES the tutor is available
+             daytimes - day index -> times in TIMES on that day
     '''
-    print("Running solver")
+    classes = [(j, m) for m in TEACHERS for j in TEACHERMAPPING[m]]
+    studentclasses = {i: [] for i in STUDENTS}
+    for (j, m) in classes:
+        for i in SUBJECTMAPPING[j]:
+            studentclasses.setdefault(i, []).append((j, m))
+    tutortimes = {}
+    for m in TEACHERS:
+        available = TUTORAVAILABILITY.get(m, set())
+        tutortimes[m] = [k for k in TIMES if k in available]
+    daytimes = {d: [k for k in TIMES if k in DAYS[day[d]]] for d in range(len(day))}
+    return {'classes': classes, 'studentclasses': studentclasses, 'tutortimes': tutortimes, 'daytimes': daytimes}
+
+
+def check_timetable_feasibility(STUDENTS, SUBJECTS, TIMES, day, DAYS, TEACHERS, SUBJECTMAPPING, REPEATS,
+                                TEACHERMAPPING, TUTORAVAILABILITY, maxclasssize, minclasssize, ROOMS, PROJECTORS,
+                                PROJECTORROOMS, numroomsprojector, NONPREFERREDTIMES, CAPACITIES):
+    '''
+    Look for the obvious reasons the first stage model would be infeasible without building it, in time linear in
+    the size of the data. Errors are hard constraints that cannot be met, so the solver would only report
+    "Infeasible" after building and solving the model. Warnings are soft constraints that are certain to be broken.
+
+    :return: A dictionary of feasible (True if there are no errors), errors and warnings, each a list of
+             dictionaries of the check, a message and the tutor, subject or student concerned, and the time taken.
+    '''
+    started = time.time()
+    errors = []
+    warnings = []
+    times = set(TIMES)
+    for m in TEACHERS:
+        for j in TEACHERMAPPING.get(m, ()):
+            if j not in REPEATS:
+                errors.append({'check': 'subjects', 'tutor': m, 'subject': j,
+                               'message': "{} teaches {} which is not a subject this study period".format(m, j)})
+        ignored = sum(1 for k in TUTORAVAILABILITY.get(m, ()) if k not in times)
+        if ignored:
+            warnings.append({'check': 'tutortimes', 'tutor': m,
+                             'message': "{} has {} available times that are not timeslots of this timetable".format(
+                                 m, ignored)})
+    instance = ProblemInstance.from_timetable_data((STUDENTS, SUBJECTS, TIMES, day, DAYS, TEACHERS, SUBJECTMAPPING,
+                                                    REPEATS, TEACHERMAPPING, TUTORAVAILABILITY, maxclasssize,
+                                                    minclasssize, ROOMS, PROJECTORS, PROJECTORROOMS,
+                                                    numroomsprojector, NONPREFERREDTIMES, CAPACITIES))
+    report = check_problem_instance(instance)
+    report['errors'] = errors + report['errors']
+    report['warnings'] = warnings + report['warnings']
+    report['feasible'] = not report['errors']
+    report['time'] = time.time() - started
+    message = "Feasibility check: {} errors and {} warnings in {:.3f}s".format(len(report['errors']),
+                                                                               len(report['warnings']), report['time'])
+    print(message)
+    app.logger.info(message)
+    return report
+
+
+def check_problem_instance(instance):
+    '''
+    The array part of check_timetable_feasibility, with each check done for every tutor, subject, time or student at
+    once.
+
+    :param instance: The ProblemInstance.
+    :return: A dictionary of feasible, errors and warnings as for check_timetable_feasibility.
+    '''
+    errors = []
+    warnings = []
+    if not instance.times:
+        errors.append({'check': 'times', 'message': "There are no timeslots in the timetable"})
+    if not instance.rooms:
+        errors.append({'check': 'rooms', 'message': "There are no rooms to put classes in"})
+    available = instance.available_times()
+    owners = instance.tutor_of_subjects()
+    required = instance.repeats[instance.tutor_subjects]
+    for n in numpy.flatnonzero(available[owners] < required):
+        m, j = instance.tutors[owners[n]], instance.subjects[instance.tutor_subjects[n]]
+        errors.append({'check': 'tutoravailability', 'tutor': m, 'subject': j, 'required': int(required[n]),
+                       'available': int(available[owners[n]]),
+                       'message': "{} needs {} times for {} but is only available at {}".format(
+                           m, required[n], j, available[owners[n]])})
+    loads = instance.tutor_loads()
+    for t in numpy.flatnonzero(available < loads):
+        m = instance.tutors[t]
+        errors.append({'check': 'tutorload', 'tutor': m, 'required': int(loads[t]), 'available': int(available[t]),
+                       'message': "{} teaches {} classes but is only available at {} times".format(
+                           m, loads[t], available[t])})
+    enrolled = instance.enrolments()
+    repeats = instance.repeats
+    for s in numpy.flatnonzero((enrolled > 0) & (repeats < 1)):
+        j = instance.subjects[s]
+        errors.append({'check': 'repeats', 'subject': j,
+                       'message': "{} has {} students but no classes".format(j, enrolled[s])})
+    capacity = instance.maxclasssize * repeats
+    for s in numpy.flatnonzero((repeats >= 1) & (enrolled > capacity)):
+        j = instance.subjects[s]
+        errors.append({'check': 'maxclasssize', 'subject': j, 'enrolled': int(enrolled[s]),
+                       'capacity': int(capacity[s]),
+                       'message': "{} has {} students but {} classes of at most {} fit only {}".format(
+                           j, enrolled[s], repeats[s], instance.maxclasssize, capacity[s])})
+    needed = instance.minclasssize * repeats
+    for s in numpy.flatnonzero((repeats >= 1) & (enrolled > 0) & (enrolled < needed)):
+        j = instance.subjects[s]
+        errors.append({'check': 'minclasssize', 'subject': j, 'enrolled': int(enrolled[s]), 'required': int(needed[s]),
+                       'message': "{} has {} students but {} classes of at least {} need {}".format(
+                           j, enrolled[s], repeats[s], instance.minclasssize, needed[s])})
+    # Each time can hold at most one class per room and one class per available tutor
+    classes = int(loads.sum())
+    slots = int(numpy.minimum(instance.available_tutors(), len(instance.rooms)).sum())
+    if instance.rooms and instance.times and classes > slots:
+        errors.append({'check': 'roomtimes', 'required': classes, 'available': slots,
+                       'message': "There are {} classes but only {} room and tutor slots to run them in".format(
+                           classes, slots)})
+    if not instance.projectorrooms.any():
+        for s in numpy.flatnonzero(instance.projectors):
+            j = instance.subjects[s]
+            warnings.append({'check': 'projectors', 'subject': j,
+                             'message': "{} needs a projector but no room has one".format(j)})
+    studentloads = instance.student_loads()
+    for i in numpy.flatnonzero(studentloads > len(instance.times)):
+        student = instance.students[i]
+        warnings.append({'check': 'studentclashes', 'student': student, 'required': int(studentloads[i]),
+                         'available': len(instance.times),
+                         'message': "{} has {} classes but there are only {} timeslots".format(
+                             student, studentloads[i], len(instance.times))})
+    return {'feasible': not errors, 'errors': errors, 'warnings': warnings}
+
+
+def objective_weights(weights=None):
+    '''
+    Get the weights of the objective terms, from the solver_weights config value with any given weights on top.
+
+    :param weights: Optional dictionary of some or all of the weights.
+    :return: Dictionary of every weight.
+    '''
+    return dict(appcfg["solver_weights"], **(weights or {}))
+
+
+def build_timetable_model(STUDENTS, TIMES, day, DAYS, TEACHERS, SUBJECTMAPPING, REPEATS, TEACHERMAPPING,
+                          TUTORAVAILABILITY, maxclasssize, minclasssize, ROOMS, PROJECTORS, numroomsprojector,
+                          NONPREFERREDTIMES, cohorts=None, tight=False, weights=None):
+    '''
+    Build the first stage model which places each class at a time and each student in a class.
+
+    Variables are only created for the (subject, time, tutor) combinations that can actually run, i.e. the tutor is
+    available at that time and there is at least one room. Clash, tutor day and projector variables are only created
+    where they can be non-zero.
+
+    :param cohorts: Optional dictionary of cohort name -> students from group_student_cohorts. When given, students
+                    with the same subjects are placed together with one integer variable counting how many of the
+                    cohort attend each class, instead of one binary variable per student.
+    :param tight: Use the tightened formulation, which links tutor days and student clashes to the individual
+                  classes rather than their sums, bounds class sizes by whether the class runs and orders students
+                  with identical enrolments so that equivalent solutions are not explored twice.
+    :param weights: Optional objective weights to use instead of some or all of the solver_weights config value.
+    :return: A tuple of the model, the assignment variables, the subject variables and a dictionary of statistics
+             about how much smaller the model is than the dense formulation. The assignment variables are indexed by
+             (student, subject, time, tutor), or by (cohort, subject, time, tutor) when cohorts are used.
+    '''
+    print("Indexing timetable data")
+    indexes = index_timetable_data(STUDENTS, TIMES, day, DAYS, TEACHERS, SUBJECTMAPPING, TEACHERMAPPING,
+                                   TUTORAVAILABILITY)
+    classes = indexes['classes']
+    daytimes = indexes['daytimes']
+    # The units placed into classes: either each student on their own or each cohort of identical students.
+    if cohorts is None:
+        units = {i: 1 for i in STUDENTS}
+        studentclasses = indexes['studentclasses']
+        unitsofsubject = SUBJECTMAPPING
+    else:
+        units = {c: len(members) for c, members in cohorts.items()}
+        studentclasses = {c: indexes['studentclasses'][members[0]] for c, members in cohorts.items()}
+        unitsofsubject = {j: [] for j in SUBJECTMAPPING}
+        for c in cohorts:
+            for (j, m) in studentclasses[c]:
+                unitsofsubject[j].append(c)
+    # Classes can only run when their tutor is available and there is a room to put them in.
+    if len(ROOMS) > 0:
+        tutortimes = indexes['tutortimes']
+    else:
+        tutortimes = {m: [] for m in TEACHERS}
+    timeclasses = {k: [] for k in TIMES}
+    for (j, m) in classes:
+        for k in tutortimes[m]:
+            timeclasses[k].append((j, m))
+    projectorclasses = {k: [(j, m) for (j, m) in timeclasses[k] if j in PROJECTORS] for k in TIMES}
+    # A student can only clash at a time where at least two of their classes could run.
+    clashtimes = {}
+    clashclasses = {}
+    for i in units:
+        counts = {}
+        for (j, m) in studentclasses[i]:
+            for k in tutortimes[m]:
+                counts[k] = counts.get(k, 0) + 1
+        clashtimes[i] = [k for k in TIMES if counts.get(k, 0) >= 2]
+        clashclasses[i] = counts
+    tutordays = {m: [d for d in range(len(day)) if set(daytimes[d]).intersection(tutortimes[m])] for m in TEACHERS}
+    # The projector penalty can only be positive if more projector classes could run than there are projector rooms.
+    projectortimes = [k for k in TIMES if len(projectorclasses[k]) > numroomsprojector]
+
     model = LpProblem('Timetabling', LpMinimize)
     # Create Variables
     print("Creating Variables")
     app.logger.info('Assignment Variables')
-    assign_vars = LpVariable.dicts("StudentVariables",
-                                   [(i, j, k, m) for m in TEACHERS for j in TEACHERMAPPING[m] for i in SUBJECTMAPPING[j]
-                                    for k in TIMES], 0, 1, LpBinary)
+    if cohorts is None:
+        assign_vars = LpVariable.dicts("StudentVariables",
+                                       [(i, j, k, m) for (j, m) in classes for i in SUBJECTMAPPING[j]
+                                        for k in tutortimes[m]], 0, 1, LpBinary)
+    else:
+        assign_vars = {}
+        for (j, m) in classes:
+            for c in unitsofsubject[j]:
+                for k in tutortimes[m]:
+                    name = "CohortVariables_" + "_".join((c, j, k, m)).replace(' ', '_')
+                    assign_vars[(c, j, k, m)] = LpVariable(name, 0, units[c], LpInteger)
     app.logger.info('Subject Variables')
-    subject_vars = LpVariable.dicts("SubjectVariables",
-                                    [(j, k, m) for m in TEACHERS for j in TEACHERMAPPING[m] for k in TIMES], 0, 1,
+    subject_vars = LpVariable.dicts("SubjectVariables", [(j, k, m) for (j, m) in classes for k in tutortimes[m]], 0, 1,
                                     LpBinary)
 
     # c
     app.logger.info('9:30 classes')
-    num930classes = LpVariable.dicts("930Classes", [(i) for i in TIMES], lowBound=0, cat=LpInteger)
+    num930classes = LpVariable.dicts("930Classes", [(i) for i in TIMES if i in NONPREFERREDTIMES], lowBound=0,
+                                     cat=LpInteger)
     # w
     app.logger.info('Days for teachers')
-    daysforteachers = LpVariable.dicts("numdaysforteachers", [(i, j) for i in TEACHERS for j in range(len(DAYS))], 0, 1,
+    daysforteachers = LpVariable.dicts("numdaysforteachers", [(m, d) for m in TEACHERS for d in tutordays[m]], 0, 1,
                                        LpBinary)
     # p
     daysforteacherssum = LpVariable.dicts("numdaysforteacherssum", [(i) for i in TEACHERS], 0, cat=LpInteger)
     # variables for student clashes
-    studenttime = LpVariable.dicts("StudentTime", [(i, j) for i in STUDENTS for j in TIMES], lowBound=0, upBound=1,
-                                   cat=LpBinary)
-    studentsum = LpVariable.dicts("StudentSum", [(i) for i in STUDENTS], 0, cat=LpInteger)
-
-
-    projectortime = LpVariable.dicts("ProjectorSum", [(k) for k in TIMES], cat=LpInteger)
-    projectorpositive = LpVariable.dicts("ProjectorPositivePart", [(k) for k in TIMES], 0, cat=LpInteger)
+    if cohorts is None:
+        studenttime = LpVariable.dicts("StudentTime", [(i, k) for i in units for k in clashtimes[i]], lowBound=0,
+                                       upBound=1, cat=LpBinary)
+    else:
+        studenttime = {}
+        for c in units:
+            for k in clashtimes[c]:
+                studenttime[(c, k)] = LpVariable("CohortTime_" + "_".join((c, k)).replace(' ', '_'), 0, units[c],
+                                                 LpInteger)
+    studentsum = LpVariable.dicts("StudentSum", [(i) for i in units], 0, cat=LpInteger)
+
+    projectortime = LpVariable.dicts("ProjectorSum", [(k) for k in projectortimes], cat=LpInteger)
+    projectorpositive = LpVariable.dicts("ProjectorPositivePart", [(k) for k in projectortimes], 0, cat=LpInteger)
     # Count the days that a teacher is rostered on. Make it bigger than a small number times the sum
     # for that particular day.
     for m in TEACHERS:
         app.logger.info('Counting Teachers for ' + m)
-        for d in range(len(day)):
-            model += daysforteachers[(m, d)] >= 0.1 * lpSum(
-                subject_vars[(j, k, m)] for j in TEACHERMAPPING[m] for k in DAYS[day[d]])
-            model += daysforteachers[(m, d)] <= lpSum(
-                subject_vars[(j, k, m)] for j in TEACHERMAPPING[m] for k in DAYS[day[d]])
-    for m in TEACHERS:
-        model += daysforteacherssum[(m)] == lpSum(daysforteachers[(m, d)] for d in range(len(day)))
-
-    print("Constraining tutor availability")
-    # This bit of code puts in the constraints for the tutor availability.
-    # It reads in the 0-1 matrix of tutor availability and constrains that no classes
-    # can be scheduled when a tutor is not available.
-    # The last column of the availabilities is the tutor identifying number, hence why we have
-    # used a somewhat convoluted idea down here.
+        for d in tutordays[m]:
+            daysum = lpSum(subject_vars[(j, k, m)] for j in TEACHERMAPPING[m] for k in daytimes[d]
+                           if (j, k, m) in subject_vars)
+            if tight:
+                for j in TEACHERMAPPING[m]:
+                    for k in daytimes[d]:
+                        if (j, k, m) in subject_vars:
+                            model += daysforteachers[(m, d)] >= subject_vars[(j, k, m)]
+            else:
+                model += daysforteachers[(m, d)] >= 0.1 * daysum
+            model += daysforteachers[(m, d)] <= daysum
     for m in TEACHERS:
-        for k in TIMES:
-            if k not in TUTORAVAILABILITY[m]:
-                model += lpSum(subject_vars[(j, k, m)] for j in TEACHERMAPPING[m]) == 0
+        model += daysforteacherssum[(m)] == lpSum(daysforteachers[(m, d)] for d in tutordays[m])
 
     # Constraints on subjects for each students
     print("Constraining student subjects")
-    for m in TEACHERS:
-        for j in TEACHERMAPPING[m]:
-            for i in SUBJECTMAPPING[j]:
-                model += lpSum(assign_vars[(i, j, k, m)] for k in TIMES) == 1
+    for (j, m) in classes:
+        for i in unitsofsubject[j]:
+            model += lpSum(assign_vars[(i, j, k, m)] for k in tutortimes[m]) == units[i]
 
     # This code means that students cannot attend a tute when a tute is not running
     # But can not attend a tute if they attend a repeat.
-    for m in TEACHERS:
-        for j in TEACHERMAPPING[m]:
-            for i in SUBJECTMAPPING[j]:
-                for k in TIMES:
-                    model += assign_vars[(i, j, k, m)] <= subject_vars[(j, k, m)]
+    for (j, m) in classes:
+        for i in unitsofsubject[j]:
+            for k in tutortimes[m]:
+                model += assign_vars[(i, j, k, m)] <= units[i] * subject_vars[(j, k, m)]
 
     # Constraints on which tutor can take each class
     # This goes through each list and either constrains it to 1 or 0 depending if
     # the teacher needs to teach that particular class.
     print("Constraining tutor classes")
-    for m in TEACHERS:
-        for j in TEACHERMAPPING[m]:
-            model += lpSum(subject_vars[(j, k, m)] for k in TIMES) == REPEATS[j]
+    for (j, m) in classes:
+        model += lpSum(subject_vars[(j, k, m)] for k in tutortimes[m]) == REPEATS[j]
 
     # General Constraints on Rooms etc.
     print("Constraining times")
-    # For each time cannot exceed number of rooms
+    # For each time cannot exceed number of rooms. Tutors can only teach one class at a time, so this can only bind
+    # when more tutors are available than there are rooms.
     for k in TIMES:
-        model += lpSum(subject_vars[(j, k, m)] for m in TEACHERS for j in TEACHERMAPPING[m]) <= len(ROOMS)
-
+        if len(set(m for (j, m) in timeclasses[k])) > len(ROOMS):
+            model += lpSum(subject_vars[(j, k, m)] for (j, m) in timeclasses[k]) <= len(ROOMS)
 
     #Number of rooms that need projectors less than the number that have projectors. Want to make this a soft constraint so
     #that it will not affect the feasibility of the model. We'll have a large penalty for exceeding the number of rooms with
     #projectors.
-    for k in TIMES:
-        model += projectortime[(k)]==(lpSum(subject_vars[(j,k,m)] for m in TEACHERS for j in TEACHERMAPPING[m] if j in PROJECTORS)-numroomsprojector)
+    for k in projectortimes:
+        model += projectortime[(k)] == (lpSum(subject_vars[(j, k, m)] for (j, m) in projectorclasses[k]) - numroomsprojector)
         model += projectorpositive[(k)] >= projectortime[(k)]
         model += projectorpositive[(k)] >= 0
 
     # Teachers can only teach one class at a time
-    for k in TIMES:
-        for m in TEACHERS:
-            model += lpSum(subject_vars[(j, k, m)] for j in TEACHERMAPPING[m]) <= 1
+    for m in TEACHERS:
+        if len(TEACHERMAPPING[m]) > 1:
+            for k in tutortimes[m]:
+                model += lpSum(subject_vars[(j, k, m)] for j in TEACHERMAPPING[m]) <= 1
     print("Constraint: Minimize student clashes")
     # STUDENT CLASHES
-    for i in STUDENTS:
-        for k in TIMES:
-            model += studenttime[(i, k)] <= lpSum(
-                assign_vars[(i, j, k, m)] for m in TEACHERS for j in TEACHERMAPPING[m] if i in SUBJECTMAPPING[j]) / 2
-            model += studenttime[(i, k)] >= 0.3 * (0.5 * lpSum(
-                assign_vars[(i, j, k, m)] for m in TEACHERS for j in TEACHERMAPPING[m] if i in SUBJECTMAPPING[j]) - 0.5)
-    for i in STUDENTS:
-        model += studentsum[(i)] == lpSum(studenttime[(i, k)] for k in TIMES)
+    for i in units:
+        for k in clashtimes[i]:
+            attending = lpSum(assign_vars[(i, j, k, m)] for (j, m) in studentclasses[i] if (i, j, k, m) in assign_vars)
+            if cohorts is None and tight:
+                # A student clashes if any two of their classes run at this time
+                options = [assign_vars[(i, j, k, m)] for (j, m) in studentclasses[i] if (i, j, k, m) in assign_vars]
+                for a in range(len(options)):
+                    for b in range(a + 1, len(options)):
+                        model += studenttime[(i, k)] >= options[a] + options[b] - 1
+            elif cohorts is None:
+                model += studenttime[(i, k)] <= attending / 2
+                model += studenttime[(i, k)] >= 0.3 * (0.5 * attending - 0.5)
+            else:
+                # Each clashing member attends at most one class more than the cohort has members, so at least
+                # (attending - members) / (classes - 1) of the cohort must be clashing.
+                model += (clashclasses[i][k] - 1) * studenttime[(i, k)] >= attending - units[i]
+    for i in units:
+        model += studentsum[(i)] == lpSum(studenttime[(i, k)] for k in clashtimes[i])
 
     # This minimizes the number of 9:30 classes.
-    for i in TIMES:
-        if i in NONPREFERREDTIMES:
-            model += num930classes[(i)] == lpSum(subject_vars[(j, i, m)] for m in TEACHERS for j in TEACHERMAPPING[m])
-
-        else:
-            model += num930classes[(i)] == 0
+    for i in num930classes:
+        model += num930classes[(i)] == lpSum(subject_vars[(j, i, m)] for (j, m) in timeclasses[i])
 
     print("Setting objective function")
 
     # Class size constraint
+    for (j, m) in classes:
+        for k in tutortimes[m]:
+            classsize = lpSum(assign_vars[(i, j, k, m)] for i in unitsofsubject[j])
+            if minclasssize > 0:
+                model += classsize >= minclasssize * subject_vars[(j, k, m)]
+            if len(SUBJECTMAPPING[j]) > maxclasssize:
+                if tight:
+                    model += classsize <= maxclasssize * subject_vars[(j, k, m)]
+                else:
+                    model += classsize <= maxclasssize
+
+    # Students with the same subjects are interchangeable, so only keep the solutions where they are ordered by the
+    # time of their first class.
+    if tight and cohorts is None:
+        position = {k: n for n, k in enumerate(TIMES)}
+        for members in group_student_cohorts(STUDENTS, SUBJECTMAPPING).values():
+            if len(members) < 2 or not studentclasses[members[0]]:
+                continue
+            (j, m) = studentclasses[members[0]][0]
+            for a, b in zip(members, members[1:]):
+                model += (lpSum(position[k] * assign_vars[(a, j, k, m)] for k in tutortimes[m]) <=
+                          lpSum(position[k] * assign_vars[(b, j, k, m)] for k in tutortimes[m]))
+
+    weights = objective_weights(weights)
+    model += (weights['clash'] * lpSum(studentsum[(i)] for i in units) +
+              weights['nonpreferred'] * lpSum(num930classes[(i)] for i in num930classes) +
+              weights['tutorday'] * lpSum(daysforteacherssum[(m)] for m in TEACHERS) +
+              weights['projector'] * lpSum(projectorpositive[(k)] for k in projectortimes))
+
+    densevariables = {
+        'assign': sum(len(SUBJECTMAPPING[j]) for (j, m) in classes) * len(TIMES),
+        'subject': len(classes) * len(TIMES),
+        'clash': len(STUDENTS) * len(TIMES),
+        'tutorday': len(TEACHERS) * len(day),
+        'nonpreferred': len(TIMES),
+        'projector': 2 * len(TIMES),
+    }
+    variables = {
+        'assign': len(assign_vars),
+        'subject': len(subject_vars),
+        'clash': len(studenttime),
+        'tutorday': len(daysforteachers),
+        'nonpreferred': len(num930classes),
+        'projector': len(projectortime) + len(projectorpositive),
+    }
+    stats = report_model_reduction(densevariables, variables, len(model.constraints))
+    return model, assign_vars, subject_vars, stats
+
+
+def build_time_placement_model(STUDENTS, TIMES, day, DAYS, TEACHERS, SUBJECTMAPPING, REPEATS, TEACHERMAPPING,
+                               TUTORAVAILABILITY, ROOMS, PROJECTORS, numroomsprojector, NONPREFERREDTIMES,
+                               weights=None):
+    '''
+    Build a model which only places classes at times, leaving the students to section_students.
+
+    Student clashes are estimated from the number of students each pair of classes has in common. If both classes
+    run at the same time, the shared students are assumed to be spread evenly over the repeats of each subject, so
+    the expected number of clashes is the overlap divided by the product of the repeats. The rest of the objective
+    and the room, projector and tutor constraints are the same as build_timetable_model.
+
+    :param weights: Optional objective weights to use instead of some or all of the solver_weights config value.
+    :return: A tuple of the model, the subject variables indexed by (subject, time, tutor) and a dictionary of
+             statistics about the model size.
+    '''
+    indexes = index_timetable_data(STUDENTS, TIMES, day, DAYS, TEACHERS, SUBJECTMAPPING, TEACHERMAPPING,
+                                   TUTORAVAILABILITY)
+    classes = indexes['classes']
+    daytimes = indexes['daytimes']
+    if len(ROOMS) > 0:
+        tutortimes = indexes['tutortimes']
+    else:
+        tutortimes = {m: [] for m in TEACHERS}
+    timeclasses = {k: [] for k in TIMES}
+    for (j, m) in classes:
+        for k in tutortimes[m]:
+            timeclasses[k].append((j, m))
+    projectorclasses = {k: [(j, m) for (j, m) in timeclasses[k] if j in PROJECTORS] for k in TIMES}
+    projectortimes = [k for k in TIMES if len(projectorclasses[k]) > numroomsprojector]
+    tutordays = {m: [d for d in range(len(day)) if set(daytimes[d]).intersection(tutortimes[m])] for m in TEACHERS}
+    # Number of students shared by each pair of classes
+    overlap = {}
+    for i, studentclasses in indexes['studentclasses'].items():
+        for a in range(len(studentclasses)):
+            for b in range(a + 1, len(studentclasses)):
+                pair = (studentclasses[a], studentclasses[b])
+                overlap[pair] = overlap.get(pair, 0) + 1
+    clashpairs = []
+    for ((j1, m1), (j2, m2)), shared in overlap.items():
+        if m1 == m2:
+            # The tutor can only teach one class at a time anyway
+            continue
+        for k in set(tutortimes[m1]).intersection(tutortimes[m2]):
+            clashpairs.append(((j1, m1), (j2, m2), k, shared / (REPEATS[j1] * REPEATS[j2])))
+
+    model = LpProblem('TimePlacement', LpMinimize)
+    print("Creating Variables")
+    subject_vars = LpVariable.dicts("SubjectVariables", [(j, k, m) for (j, m) in classes for k in tutortimes[m]], 0, 1,
+                                    LpBinary)
+    overlap_vars = {}
+    for n, (a, b, k, weight) in enumerate(clashpairs):
+        overlap_vars[(a, b, k)] = LpVariable("Overlap_{}".format(n), 0, 1)
+    daysforteachers = LpVariable.dicts("numdaysforteachers", [(m, d) for m in TEACHERS for d in tutordays[m]], 0, 1,
+                                       LpBinary)
+    projectorpositive = LpVariable.dicts("ProjectorPositivePart", [(k) for k in projectortimes], 0, cat=LpInteger)
+
+    print("Constraining classes")
+    for (j, m) in classes:
+        model += lpSum(subject_vars[(j, k, m)] for k in tutortimes[m]) == REPEATS[j]
+    for m in TEACHERS:
+        if len(TEACHERMAPPING[m]) > 1:
+            for k in tutortimes[m]:
+                model += lpSum(subject_vars[(j, k, m)] for j in TEACHERMAPPING[m]) <= 1
+        for d in tutordays[m]:
+            for j in TEACHERMAPPING[m]:
+                for k in daytimes[d]:
+                    if (j, k, m) in subject_vars:
+                        model += daysforteachers[(m, d)] >= subject_vars[(j, k, m)]
+    for k in TIMES:
+        if len(set(m for (j, m) in timeclasses[k])) > len(ROOMS):
+            model += lpSum(subject_vars[(j, k, m)] for (j, m) in timeclasses[k]) <= len(ROOMS)
+    for k in projectortimes:
+        model += projectorpositive[(k)] >= (lpSum(subject_vars[(j, k, m)] for (j, m) in projectorclasses[k]) -
+                                            numroomsprojector)
+    for (a, b, k), var in overlap_vars.items():
+        model += var >= subject_vars[(a[0], k, a[1])] + subject_vars[(b[0], k, b[1])] - 1
+
+    print("Setting objective function")
+    weights = objective_weights(weights)
+    model += (weights['clash'] * lpSum(weight * overlap_vars[(a, b, k)] for (a, b, k, weight) in clashpairs) +
+              weights['nonpreferred'] * lpSum(subject_vars[(j, k, m)] for k in TIMES if k in NONPREFERREDTIMES
+                                              for (j, m) in timeclasses[k]) +
+              weights['tutorday'] * lpSum(daysforteachers.values()) +
+              weights['projector'] * lpSum(projectorpositive.values()))
+
+    densevariables = {
+        'subject': len(classes) * len(TIMES),
+        'overlap': len(overlap) * len(TIMES),
+        'tutorday': len(TEACHERS) * len(day),
+        'projector': len(TIMES),
+    }
+    variables = {
+        'subject': len(subject_vars),
+        'overlap': len(overlap_vars),
+        'tutorday': len(daysforteachers),
+        'projector': len(projectorpositive),
+    }
+    stats = report_model_reduction(densevariables, variables, len(model.constraints))
+    return model, subject_vars, stats
+
+
+def report_model_reduction(densevariables, variables, numconstraints):
+    '''
+    Log how many variables each family has compared with the dense formulation.
+
+    :param densevariables: Dictionary of variable family -> count in the dense formulation
+    :param variables: Dictionary of variable family -> count actually created
+    :param numconstraints: The number of constraints in the model
+    :return: Dictionary of statistics.
+    '''
+    stats = {'dense': densevariables, 'variables': variables, 'constraints': numconstraints,
+             'densetotal': sum(densevariables.values()), 'total': sum(variables.values())}
+    for family in densevariables:
+        message = "Variables ({}): {} of {}".format(family, variables[family], densevariables[family])
+        print(message)
+        app.logger.info(message)
+    if stats['densetotal'] > 0:
+        stats['reduction'] = 1 - stats['total'] / stats['densetotal']
+    else:
+        stats['reduction'] = 0
+    message = "Model size: {} variables (dense {}, {:.1%} smaller), {} constraints".format(
+        stats['total'], stats['densetotal'], stats['reduction'], numconstraints)
+    print(message)
+    app.logger.info(message)
+    return stats
+
+
+def build_room_model(TEACHERS, TEACHERMAPPING, ROOMS, PROJECTORS, PROJECTORROOMS, CAPACITIES, classpop, weights=None):
+    '''
+    Build the second stage model which puts each running class into a room.
+
+    :param classpop: A dictionary indexed by the running (subject, time, tutor) classes with their populations
+    :return: A tuple of the model and the room allocation variables.
+    '''
+    running = list(classpop.keys())
+    runningbytutor = {m: [] for m in TEACHERS}
+    runningbytime = {}
+    for (j, k, m) in running:
+        runningbytutor.setdefault(m, []).append((j, k, m))
+        runningbytime.setdefault(k, []).append((j, k, m))
+    runningtimes = list(runningbytime.keys())
+
+    model2 = LpProblem('RoomAllocation', LpMinimize)
+    print("Defining Variables")
+    subject_vars_rooms = LpVariable.dicts("SubjectVariablesRooms",
+                                          [(j, k, m, n) for (j, k, m) in running for n in ROOMS], 0, 1, LpBinary)
+
+    teacher_number_rooms = LpVariable.dicts("NumberRoomsTeacher", [(m, n) for m in TEACHERS for n in ROOMS], 0, 1,
+                                            LpBinary)
+    teacher_number_rooms_sum = LpVariable.dicts("NumberRoomsTeacherSum", [(m) for m in TEACHERS], 0)
+
+    projector_rooms_sum = LpVariable.dicts("ProjectorRooms", [(j) for j in PROJECTORS])
+
+    populationovershoot = LpVariable.dicts("PopulationOvershoot", [(k, n) for k in runningtimes for n in ROOMS])
+
+    poppositive = LpVariable.dicts("PopulationPositivePart", [(k, n) for k in runningtimes for n in ROOMS])
+
+    print("Minimizing number of rooms for each tutor")
+    for m in TEACHERS:
+        for n in ROOMS:
+            roomsum = lpSum(subject_vars_rooms[(j, k, m, n)] for (j, k, m) in runningbytutor[m])
+            model2 += teacher_number_rooms[(m, n)] >= 0.01 * roomsum
+            model2 += teacher_number_rooms[(m, n)] <= roomsum
+    for m in TEACHERS:
+        model2 += teacher_number_rooms_sum[(m)] == lpSum(teacher_number_rooms[(m, n)] for n in ROOMS)
+
+    # Rooms must be allocated at times when the classes are running
+    print("Constraining Times")
+    for (j, k, m) in running:
+        model2 += lpSum(subject_vars_rooms[(j, k, m, n)] for n in ROOMS) == 1
+
     for m in TEACHERS:
         for j in TEACHERMAPPING[m]:
-            for k in TIMES:
-                model += lpSum(assign_vars[(i, j, k, m)] for i in SUBJECTMAPPING[j]) >= minclasssize * subject_vars[
-                    (j, k, m)]
-                model += lpSum(assign_vars[(i, j, k, m)] for i in SUBJECTMAPPING[j]) <= maxclasssize
-
-    # Solving the model
-    model += (100 * lpSum(studentsum[(i)] for i in STUDENTS) + lpSum(num930classes[(i)] for i in TIMES) + 500 * lpSum(
-        daysforteacherssum[(m)] for m in TEACHERS)+5000*lpSum(projectorpositive[(k)] for k in TIMES))
+            if j in PROJECTORS:
+                model2 += projector_rooms_sum[(j)] == lpSum(
+                    subject_vars_rooms[(j2, k, m2, n)] for (j2, k, m2) in runningbytutor[m] if j2 == j
+                    for n in PROJECTORROOMS)
+
+    print("Ensuring Uniqueness")
+    # Can only have one class in each room at a time.
+    for k in runningtimes:
+        for n in ROOMS:
+            model2 += lpSum(subject_vars_rooms[(j, k, m, n)] for (j, k, m) in runningbytime[k]) <= 1
+
+    print("Accomodating Capacities")
+    for k in runningtimes:
+        for n in ROOMS:
+            model2 += populationovershoot[(k, n)] == (lpSum(
+                classpop[(j, k, m)] * subject_vars_rooms[(j, k, m, n)] for (j, k, m) in runningbytime[k]) - CAPACITIES[n])
+            model2 += poppositive[(k, n)] >= populationovershoot[(k, n)]
+            model2 += poppositive[(k, n)] >= 0
+
+    print("Setting Objective Function")
+    weights = objective_weights(weights)
+    model2 += (weights['tutorroom'] * lpSum(teacher_number_rooms_sum[(m)] for m in TEACHERS) -
+               weights['projectorroom'] * lpSum(projector_rooms_sum[(j)] for j in PROJECTORS) +
+               weights['overcapacity'] * lpSum(poppositive[key] for key in poppositive))
+    return model2, subject_vars_rooms
+
+
+def allocate_rooms(TEACHERS, TEACHERMAPPING, ROOMS, PROJECTORS, PROJECTORROOMS, CAPACITIES, classpop, settings=None):
+    '''
+    Put each running class into a room with the engine chosen in the settings: "milp" solves the room allocation
+    model with CBC and "heuristic" uses allocate_rooms_heuristic.
+
+    :param classpop: A dictionary indexed by the running (subject, time, tutor) classes with their populations
+    :param settings: CBC settings for the room stage as returned by get_solver_settings()['rooms'], or None. It can
+                     also have the objective 'weights'.
+    :return: Dictionary of status, engine, objective, bound, gap and time taken, and the allocation of
+             (subject, time, tutor) -> room. The objective is worked out with room_allocation_objective for both
+             engines so they can be compared.
+    '''
+    settings = settings or {}
+    engine = settings.get('engine') or 'milp'
+    started = time.time()
+    if engine == 'heuristic':
+        print("Allocating Rooms Heuristically")
+        rooms = allocate_rooms_heuristic(TEACHERS, ROOMS, PROJECTORS, PROJECTORROOMS, CAPACITIES, classpop,
+                                         weights=settings.get('weights'))
+    else:
+        model2, subject_vars_rooms = build_room_model(TEACHERS, TEACHERMAPPING, ROOMS, PROJECTORS, PROJECTORROOMS,
+                                                      CAPACITIES, classpop, weights=settings.get('weights'))
+        print("Solve Room Allocation")
+        rooms = solve_model(model2, settings)
+        rooms['allocation'] = {}
+        if rooms['status'] in SOLVED_STATUSES:
+            for (j, k, m, n) in subject_vars_rooms:
+                if subject_vars_rooms[(j, k, m, n)].varValue == 1:
+                    rooms['allocation'][(j, k, m)] = n
+    rooms['engine'] = engine
+    rooms['time'] = time.time() - started
+    if rooms['status'] in SOLVED_STATUSES:
+        rooms['objective'] = room_allocation_objective(rooms['allocation'], PROJECTORS, PROJECTORROOMS, CAPACITIES,
+                                                       classpop, weights=settings.get('weights'))
+    message = "Room allocation ({}): {} objective {} in {:.3f}s".format(engine, rooms['status'], rooms['objective'],
+                                                                       rooms['time'])
+    print(message)
+    app.logger.info(message)
+    return rooms
+
+
+def room_allocation_objective(allocation, PROJECTORS, PROJECTORROOMS, CAPACITIES, classpop, weights=None):
+    '''
+    Work out the room allocation objective of the second stage model for an allocation: the number of rooms each
+    tutor uses, less 50 for each projector class in a projector room, plus 10 for each student over a room's
+    capacity, or the same terms with the given weights.
+
+    :param allocation: Dictionary of (subject, time, tutor) -> room.
+    :param weights: Optional objective weights to use instead of some or all of the solver_weights config value.
+    :return: The objective value.
+    '''
+    weights = objective_weights(weights)
+    tutorrooms = {}
+    objective = 0
+    for (j, k, m), n in allocation.items():
+        tutorrooms.setdefault(m, set()).add(n)
+        objective += room_class_cost(j, k, m, n, PROJECTORS, PROJECTORROOMS, CAPACITIES, classpop, weights)
+    return objective + weights['tutorroom'] * sum(len(rooms) for rooms in tutorrooms.values())
+
+
+def room_class_cost(j, k, m, n, PROJECTORS, PROJECTORROOMS, CAPACITIES, classpop, weights):
+    '''
+    The part of the room allocation objective from putting one class in a room.
+    '''
+    cost = weights['overcapacity'] * max(0, classpop[(j, k, m)] - CAPACITIES[n])
+    if j in PROJECTORS and n in PROJECTORROOMS:
+        cost -= weights['projectorroom']
+    return cost
+
+
+def allocate_rooms_heuristic(TEACHERS, ROOMS, PROJECTORS, PROJECTORROOMS, CAPACITIES, classpop, weights=None):
+    '''
+    Allocate rooms without a MILP. Each timeslot is an assignment of its classes to rooms, so the busiest timeslots
+    are filled first, each class taking the cheapest free room with a preference for rooms its tutor already uses.
+    A local search then swaps rooms between classes in the same timeslot, or moves a class to a free room, while
+    that lowers room_allocation_objective.
+
+    :param classpop: A dictionary indexed by the running (subject, time, tutor) classes with their populations
+    :param weights: Optional objective weights to use instead of some or all of the solver_weights config value.
+    :return: Dictionary of status, objective, bound and gap and the allocation of (subject, time, tutor) -> room.
+             The status is "Feasible" as the allocation is not proven optimal, or "Infeasible" if a timeslot has more
+             classes than there are rooms.
+    '''
+    result = {'status': "Feasible", 'objective': None, 'bound': None, 'gap': None, 'allocation': {}}
+    bytime = {}
+    for (j, k, m) in classpop:
+        bytime.setdefault(k, []).append((j, k, m))
+    if any(len(classes) > len(ROOMS) for classes in bytime.values()):
+        result['status'] = "Infeasible"
+        return result
+
+    weights = objective_weights(weights)
+
+    def cost(c, n):
+        return room_class_cost(c[0], c[1], c[2], n, PROJECTORS, PROJECTORROOMS, CAPACITIES, classpop, weights)
+
+    allocation = result['allocation']
+    tutorrooms = {m: {} for m in TEACHERS}
+    for k in sorted(bytime, key=lambda k: len(bytime[k]), reverse=True):
+        free = list(ROOMS)
+        # Projector classes and big classes have the most to lose, so they choose first
+        for c in sorted(bytime[k], key=lambda c: (c[0] not in PROJECTORS, -classpop[c])):
+            n = min(free, key=lambda n: (cost(c, n) + (0 if n in tutorrooms[c[2]] else weights['tutorroom']),
+                                         -CAPACITIES[n]))
+            free.remove(n)
+            allocation[c] = n
+            tutorrooms[c[2]][n] = tutorrooms[c[2]].get(n, 0) + 1
+
+    def move(c, old, new):
+        # Change in the objective from moving class c from room old to room new
+        rooms = tutorrooms[c[2]]
+        delta = cost(c, new) - cost(c, old)
+        if rooms[old] == 1:
+            delta -= weights['tutorroom']
+        if new not in rooms:
+            delta += weights['tutorroom']
+        return delta
+
+    def assign(c, old, new):
+        rooms = tutorrooms[c[2]]
+        rooms[old] -= 1
+        if rooms[old] == 0:
+            del rooms[old]
+        rooms[new] = rooms.get(new, 0) + 1
+        allocation[c] = new
+
+    improved = True
+    while improved:
+        improved = False
+        for k, classes in bytime.items():
+            for a in classes:
+                for n in ROOMS:
+                    old = allocation[a]
+                    if n == old:
+                        continue
+                    other = [b for b in classes if allocation[b] == n]
+                    if not other:
+                        if move(a, old, n) < 0:
+                            assign(a, old, n)
+                            improved = True
+                        continue
+                    b = other[0]
+                    delta = move(a, old, n)
+                    assign(a, old, n)
+                    delta += move(b, n, old)
+                    if delta < 0:
+                        assign(b, n, old)
+                        improved = True
+                    else:
+                        assign(a, n, old)
+    return result
+
+
+def section_students(SUBJECTMAPPING, running, maxclasssize, minclasssize, rounds=20):
+    '''
+    Put the students of each class into one of its running times, keeping within the class sizes and with as few
+    clashes as possible.
+
+    Each class is sectioned in turn with assign_sections, where a student's cost for a time is one if it makes
+    them clash with one of their other classes. This repeats until a round makes no change, so the number of
+    clashes never goes up.
+
+    :param running: List of the running (subject, time, tutor) classes.
+    :param rounds: The most rounds to make over the classes.
+    :return: Dictionary of status, number of clashes and rounds made and the students in each running class. The
+             status is "Infeasible" if the students of a class cannot be split within the class sizes.
+    '''
+    sections = {}
+    for (j, k, m) in running:
+        sections.setdefault((j, m), []).append(k)
+    attending = {}
+    choice = {}
+    result = {'status': "Feasible", 'clashes': 0, 'rounds': 0, 'classstudents': {c: [] for c in running}}
+    for n in range(rounds):
+        result['rounds'] = n + 1
+        changed = False
+        for (j, m), times in sections.items():
+            students = sorted(SUBJECTMAPPING[j])
+            upper = maxclasssize if len(students) > maxclasssize else len(students)
+            cost = {}
+            for i in students:
+                counts = attending.setdefault(i, {})
+                if (i, j, m) in choice:
+                    counts[choice[(i, j, m)]] -= 1
+                cost[i] = {k: 1 if counts.get(k, 0) == 1 else 0 for k in times}
+            assignment = assign_sections(students, times, cost, minclasssize, upper)
+            if assignment is None:
+                result['status'] = "Infeasible"
+                return result
+            for i in students:
+                if choice.get((i, j, m)) != assignment[i]:
+                    changed = True
+                choice[(i, j, m)] = assignment[i]
+                attending[i][assignment[i]] = attending[i].get(assignment[i], 0) + 1
+        if not changed:
+            break
+    for (i, j, m), k in choice.items():
+        result['classstudents'][(j, k, m)].append(i)
+    result['clashes'] = sum(1 for counts in attending.values() for k in counts if counts[k] >= 2)
+    for sectioned in result['classstudents'].values():
+        sectioned.sort()
+    return result
+
+
+def assign_sections(students, times, cost, lower, upper):
+    '''
+    Assign each student to one of the times with the least total cost, with between lower and upper students at
+    each time, as a min cost flow.
+
+    Students are added one at a time along the cheapest path, which can move other students between times. As there
+    are only a few times, the paths are found between the times: moving from one time to another costs the least
+    extra that any student there would pay to move. A time is a place to stop if it has room, and filling a time
+    that is below the lower limit is worth more than any cost a student can add.
+
+    :param cost: Dictionary of student -> dictionary of time -> cost.
+    :return: Dictionary of student -> time, or None if the students cannot be split within the limits.
+    '''
+    if len(students) > upper * len(times):
+        return None
+    bonus = len(students) * max([max(c.values()) for c in cost.values()] + [0]) + 1
+    assignment = {}
+    members = {k: set() for k in times}
+    for i in students:
+        # The cheapest student to move between each pair of times
+        moves = {}
+        for k in times:
+            for other in members[k]:
+                for k2 in times:
+                    extra = cost[other][k2] - cost[other][k]
+                    if k2 != k and ((k, k2) not in moves or extra < moves[(k, k2)][0]):
+                        moves[(k, k2)] = (extra, other)
+        # Bellman-Ford from the new student over the times
+        distance = {k: cost[i][k] for k in times}
+        previous = {k: None for k in times}
+        for n in range(len(times)):
+            updated = False
+            for (k, k2), (extra, other) in moves.items():
+                if distance[k] + extra < distance[k2]:
+                    distance[k2] = distance[k] + extra
+                    previous[k2] = (k, other)
+                    updated = True
+            if not updated:
+                break
+        best = None
+        for k in times:
+            if len(members[k]) < upper:
+                total = distance[k] - (bonus if len(members[k]) < lower else 0)
+                if best is None or total < best[0]:
+                    best = (total, k)
+        if best is None:
+            return None
+        k = best[1]
+        while previous[k] is not None:
+            (k0, other) = previous[k]
+            members[k0].remove(other)
+            members[k].add(other)
+            assignment[other] = k
+            k = k0
+        members[k].add(i)
+        assignment[i] = k
+    if any(len(members[k]) < lower for k in times):
+        return None
+    return assignment
+
+
+def solve_first_stage(STUDENTS, SUBJECTS, TIMES, day, DAYS, TEACHERS, SUBJECTMAPPING, REPEATS, TEACHERMAPPING,
+                      TUTORAVAILABILITY, maxclasssize, minclasssize, ROOMS, PROJECTORS, PROJECTORROOMS,
+                      numroomsprojector, NONPREFERREDTIMES, CAPACITIES, settings=None, warmstart=None, fixed=None):
+    '''
+    Build and solve the first stage model which places classes at times and students in classes.
+
+    :param settings: CBC settings for the stage as returned by get_solver_settings()['timetable'], or None. It can
+                     also have the objective 'weights'.
+    :param warmstart: Optional list of classes from a previous timetable, as returned by get_timetable_solution, to
+                      use as a starting solution.
+    :param fixed: Optional dictionary of the 'subjects' whose classes and the 'students' whose placements are kept
+                  as they are in warmstart, as returned by find_unchanged. If the model cannot be solved with them
+                  fixed it is solved again with nothing fixed.
+    :return: A dictionary with the solver status, the model statistics, the objective, bound and gap and the
+             students in each running (subject, time, tutor) class. With cohorts the objective is that of the students
+             as they were placed, and the status is Feasible rather than Optimal if they clash more than the model
+             counted.
+    '''
+    data = (STUDENTS, SUBJECTS, TIMES, day, DAYS, TEACHERS, SUBJECTMAPPING, REPEATS, TEACHERMAPPING, TUTORAVAILABILITY,
+            maxclasssize, minclasssize, ROOMS, PROJECTORS, PROJECTORROOMS, numroomsprojector, NONPREFERREDTIMES,
+            CAPACITIES)
+    cachekey = None
+    if appcfg.get("solver_cache", False) and not warmstart:
+        cachekey = solver_cache_key(data, 'timetable', settings)
+        cached = read_solver_cache(cachekey, 'firststage')
+        if cached is not None:
+            cached['classstudents'] = {(j, k, m): students for (j, k, m, students) in cached['classstudents']}
+            return cached
+    cohorts = None
+    if appcfg.get("solver_cohorts", False):
+        cohorts = group_student_cohorts(STUDENTS, SUBJECTMAPPING)
+    model, assign_vars, subject_vars, stats = build_timetable_model(STUDENTS, TIMES, day, DAYS, TEACHERS,
+                                                                    SUBJECTMAPPING, REPEATS, TEACHERMAPPING,
+                                                                    TUTORAVAILABILITY, maxclasssize, minclasssize,
+                                                                    ROOMS, PROJECTORS, numroomsprojector,
+                                                                    NONPREFERREDTIMES, cohorts=cohorts,
+                                                                    tight=appcfg.get("solver_tight_formulation", False),
+                                                                    weights=(settings or {}).get('weights'))
+    saved = []
+    if warmstart and fixed is not None:
+        classbounds, studentbounds, stats['fixed'] = solution_bounds(assign_vars, subject_vars, warmstart, REPEATS,
+                                                                     cohorts=cohorts, subjects=set(fixed['subjects']),
+                                                                     students=set(fixed['students']))
+        saved = set_bounds(classbounds + studentbounds)
+        message = "Incremental solve: {} classes and {} students fixed".format(stats['fixed']['classes'],
+                                                                            stats['fixed']['students'])
+        print(message)
+        app.logger.info(message)
+    started = False
+    if warmstart:
+        stats['warmstart'] = warm_start_model(model, assign_vars, subject_vars, warmstart, REPEATS, cohorts=cohorts)
+        started = stats['warmstart']['objective'] is not None
     print("Solving Model")
-    model.solve()
-    print("Status:", LpStatus[model.status])
-    print("Completed Timetable")
+    solved = solve_model(model, settings, warmstart=started)
+    if saved and solved['status'] not in SOLVED_STATUSES:
+        message = "Incremental solve was {}, solving everything".format(solved['status'])
+        print(message)
+        app.logger.info(message)
+        set_bounds(saved)
+        stats['fixed'] = None
+        solved = solve_model(model, settings)
+    print("Status:", solved['status'])
+    result = dict(solved, stats=stats, classstudents={})
+    if result['status'] in SOLVED_STATUSES:
+        running = [(j, k, m) for (j, k, m) in subject_vars if subject_vars[(j, k, m)].varValue == 1]
+        if cohorts is None:
+            for (j, k, m) in running:
+                result['classstudents'][(j, k, m)] = [i for i in SUBJECTMAPPING[j]
+                                                      if assign_vars[(i, j, k, m)].varValue == 1]
+        else:
+            stats['cohorts'] = len(cohorts)
+            result['classstudents'] = expand_cohorts(cohorts, assign_vars, running)
+            # The cohort model only bounds the clashes at each time on its own, so the students as they were placed
+            # can clash more than it counted. Report what they actually got.
+            stats['cohortobjective'] = result['objective']
+            result['objective'] = timetable_objective(result['classstudents'], TIMES, day, DAYS, PROJECTORS,
+                                                      numroomsprojector, NONPREFERREDTIMES,
+                                                      weights=(settings or {}).get('weights'))
+            if result['status'] == "Optimal" and result['objective'] > stats['cohortobjective'] + 1e-6:
+                result['status'] = "Feasible"
+            result['gap'] = calculate_gap(result['objective'], result['bound'])
+        if cachekey is not None:
+            cached = dict(result, classstudents=[(j, k, m, students)
+                                                 for (j, k, m), students in result['classstudents'].items()])
+            write_solver_cache(cachekey, 'firststage', cached)
+    return result
+
+
+def solve_first_stage_sectioned(STUDENTS, SUBJECTS, TIMES, day, DAYS, TEACHERS, SUBJECTMAPPING, REPEATS,
+                                TEACHERMAPPING, TUTORAVAILABILITY, maxclasssize, minclasssize, ROOMS, PROJECTORS,
+                                PROJECTORROOMS, numroomsprojector, NONPREFERREDTIMES, CAPACITIES, settings=None):
+    '''
+    Do the first stage in two steps: place the classes at times with build_time_placement_model and then put the
+    students into the running classes with section_students. Room allocation is then the third step as usual.
+
+    :param settings: CBC settings for the placement model as returned by get_solver_settings()['timetable'], or None.
+                     It can also have the objective 'weights'.
+    :return: A dictionary in the same form as solve_first_stage. The objective is worked out with
+             timetable_objective so it can be compared with the single model, and the bound and gap are those of
+             the placement model.
+    '''
+    model, subject_vars, stats = build_time_placement_model(STUDENTS, TIMES, day, DAYS, TEACHERS, SUBJECTMAPPING,
+                                                            REPEATS, TEACHERMAPPING, TUTORAVAILABILITY, ROOMS,
+                                                            PROJECTORS, numroomsprojector, NONPREFERREDTIMES,
+                                                            weights=(settings or {}).get('weights'))
+    print("Solving Time Placement")
+    started = time.time()
+    placement = solve_model(model, settings)
+    placement['time'] = time.time() - started
+    stats['placement'] = placement
+    result = dict(placement, stats=stats, classstudents={})
+    if placement['status'] not in SOLVED_STATUSES:
+        return result
+    running = [(j, k, m) for (j, k, m) in subject_vars if subject_vars[(j, k, m)].varValue == 1]
+    print("Sectioning Students")
+    started = time.time()
+    sections = section_students(SUBJECTMAPPING, running, maxclasssize, minclasssize)
+    stats['sectioning'] = {'status': sections['status'], 'clashes': sections['clashes'],
+                           'rounds': sections['rounds'], 'time': time.time() - started}
+    message = "Sectioning: {} with {} clashes after {} rounds in {:.3f}s".format(
+        sections['status'], sections['clashes'], sections['rounds'], stats['sectioning']['time'])
+    print(message)
+    app.logger.info(message)
+    if sections['status'] not in SOLVED_STATUSES:
+        result['status'] = sections['status']
+        return result
+    if placement['status'] == "Optimal":
+        # The students are placed heuristically, so the timetable as a whole is not proven optimal
+        result['status'] = "Feasible"
+    result['classstudents'] = sections['classstudents']
+    result['objective'] = timetable_objective(result['classstudents'], TIMES, day, DAYS, PROJECTORS,
+                                              numroomsprojector, NONPREFERREDTIMES,
+                                              weights=(settings or {}).get('weights'))
+    result['gap'] = calculate_gap(result['objective'], result['bound'])
+    return result
+
+
+def timetable_objective(classstudents, TIMES, day, DAYS, PROJECTORS, numroomsprojector, NONPREFERREDTIMES,
+                        weights=None):
+    '''
+    Work out the first stage objective of build_timetable_model for a set of classes: 100 for each student clash,
+    one for each class at a non-preferred time, 500 for each day a tutor works and 5000 for each projector class
+    more than there are projector rooms at a time, or the same terms with the given weights.
+
+    :param classstudents: Dictionary of the running (subject, time, tutor) classes -> their students.
+    :param weights: Optional objective weights to use instead of some or all of the solver_weights config value.
+    :return: The objective value.
+    '''
+    weights = objective_weights(weights)
+    tutordays = set()
+    projectors = {}
+    nonpreferred = 0
+    for (j, k, m), students in classstudents.items():
+        tutordays.update((m, d) for d in day if k in DAYS[d])
+        if j in PROJECTORS:
+            projectors[k] = projectors.get(k, 0) + 1
+        if k in NONPREFERREDTIMES:
+            nonpreferred += 1
+    excess = sum(max(0, count - numroomsprojector) for count in projectors.values())
+    return (weights['clash'] * count_clashes(classstudents) + weights['nonpreferred'] * nonpreferred +
+            weights['tutorday'] * len(tutordays) + weights['projector'] * excess)
+
+
+def count_clashes(classstudents):
+    '''
+    Count the student clashes in a set of classes, i.e. the times at which a student has more than one class.
+
+    :param classstudents: Dictionary of the running (subject, time, tutor) classes -> their students.
+    :return: The number of clashes.
+    '''
+    attending = {}
+    for (j, k, m), students in classstudents.items():
+        for i in students:
+            attending[(i, k)] = attending.get((i, k), 0) + 1
+    return sum(1 for count in attending.values() if count >= 2)
+
+
+def solve_first_stage_local_search(STUDENTS, SUBJECTS, TIMES, day, DAYS, TEACHERS, SUBJECTMAPPING, REPEATS,
+                                   TEACHERMAPPING, TUTORAVAILABILITY, maxclasssize, minclasssize, ROOMS, PROJECTORS,
+                                   PROJECTORROOMS, numroomsprojector, NONPREFERREDTIMES, CAPACITIES, settings=None):
+    '''
+    Do the first stage without CBC, for timetables too big for the models. The classes are placed with
+    construct_timetable, the students are put into them with section_students and then improve_timetable moves
+    classes and students around until the time limit.
+
+    :param settings: Settings for the stage as returned by get_solver_settings()['timetable'], or None. Only the time
+                     limit, falling back to the solver_local_search_time_limit config value, and the objective
+                     'weights' are used.
+    :return: A dictionary in the same form as solve_first_stage. There is no bound as nothing is proven optimal.
+    '''
+    settings = settings or {}
+    timelimit = settings.get('timelimit') or appcfg.get("solver_local_search_time_limit", 60)
+    weights = objective_weights(settings.get('weights'))
+    started = time.time()
+    indexes = index_timetable_data(STUDENTS, TIMES, day, DAYS, TEACHERS, SUBJECTMAPPING, TEACHERMAPPING,
+                                   TUTORAVAILABILITY)
+    if len(ROOMS) == 0:
+        indexes['tutortimes'] = {m: [] for m in TEACHERS}
+    result = {'status': "Infeasible", 'objective': None, 'bound': None, 'gap': None, 'classstudents': {},
+              'stats': {'total': 0}}
+    print("Constructing Timetable")
+    running = construct_timetable(indexes, day, DAYS, SUBJECTMAPPING, REPEATS, ROOMS, PROJECTORS, numroomsprojector,
+                                  NONPREFERREDTIMES, weights)
+    if running is None:
+        return result
+    sections = section_students(SUBJECTMAPPING, running, maxclasssize, minclasssize)
+    if sections['status'] not in SOLVED_STATUSES:
+        result['status'] = sections['status']
+        return result
+    print("Improving Timetable")
+    classstudents, result['stats']['localsearch'] = improve_timetable(
+        sections['classstudents'], indexes, day, DAYS, SUBJECTMAPPING, ROOMS, PROJECTORS, numroomsprojector,
+        NONPREFERREDTIMES, maxclasssize, minclasssize, timelimit - (time.time() - started), weights=weights)
+    result['status'] = "Feasible"
+    result['classstudents'] = classstudents
+    result['objective'] = timetable_objective(classstudents, TIMES, day, DAYS, PROJECTORS, numroomsprojector,
+                                              NONPREFERREDTIMES, weights)
+    return result
+
+
+def construct_timetable(indexes, day, DAYS, SUBJECTMAPPING, REPEATS, ROOMS, PROJECTORS, numroomsprojector,
+                        NONPREFERREDTIMES, weights=None):
+    '''
+    Greedily place the classes at times, the biggest classes first. Each repeat goes at the time that adds the least
+    to the objective, counting the students of a class as spread evenly over its repeats.
+
+    :param indexes: The indexes from index_timetable_data.
+    :param weights: Optional objective weights to use instead of some or all of the solver_weights config value.
+    :return: List of the running (subject, time, tutor) classes, or None if a class could not be placed.
+    '''
+    weights = objective_weights(weights)
+    dayof = {k: d for d in day for k in DAYS[d]}
+    occupied = {}
+    tutorbusy = set()
+    tutordays = set()
+    roomsused = {}
+    projectors = {}
+    running = []
+    for (j, m) in sorted(indexes['classes'], key=lambda c: (-len(SUBJECTMAPPING[c[0]]), c)):
+        share = 1.0 / REPEATS[j]
+        for r in range(REPEATS[j]):
+            best = None
+            for k in indexes['tutortimes'][m]:
+                if (m, k) in tutorbusy or roomsused.get(k, 0) >= len(ROOMS):
+                    continue
+                cost = weights['clash'] * share * sum(occupied.get((i, k), 0) for i in SUBJECTMAPPING[j])
+                if (m, dayof[k]) not in tutordays:
+                    cost += weights['tutorday']
+                if k in NONPREFERREDTIMES:
+                    cost += weights['nonpreferred']
+                if j in PROJECTORS and projectors.get(k, 0) >= numroomsprojector:
+                    cost += weights['projector']
+                if best is None or cost < best[0]:
+                    best = (cost, k)
+            if best is None:
+                message = "Could not place {} with {}".format(j, m)
+                print(message)
+                app.logger.info(message)
+                return None
+            k = best[1]
+            running.append((j, k, m))
+            tutorbusy.add((m, k))
+            tutordays.add((m, dayof[k]))
+            roomsused[k] = roomsused.get(k, 0) + 1
+            if j in PROJECTORS:
+                projectors[k] = projectors.get(k, 0) + 1
+            for i in SUBJECTMAPPING[j]:
+                occupied[(i, k)] = occupied.get((i, k), 0) + share
+    return running
+
+
+def improve_timetable(classstudents, indexes, day, DAYS, SUBJECTMAPPING, ROOMS, PROJECTORS, numroomsprojector,
+                      NONPREFERREDTIMES, maxclasssize, minclasssize, timelimit, stale=200000, seed=0, weights=None):
+    '''
+    Improve a timetable with simulated annealing on the timetable_objective. A move either shifts one repeat of a
+    class and its students to another time, or moves a student to another repeat of the same class, swapping with a
+    student there if it is full. Moves that make the objective worse are accepted with a probability that falls as
+    the search cools over the time limit, and the best timetable found is returned.
+
+    :param classstudents: Dictionary of the running (subject, time, tutor) classes -> their students.
+    :param indexes: The indexes from index_timetable_data.
+    :param timelimit: Seconds to search for.
+    :param stale: Stop early after this many moves without finding a better timetable.
+    :param seed: Seed for the random moves.
+    :param weights: Optional objective weights to use instead of some or all of the solver_weights config value.
+    :return: A tuple of the improved classstudents and a dictionary of the starting and final objective and the
+             number of moves tried and accepted.
+    '''
+    rnd = random.Random(seed)
+    started = time.time()
+    weights = objective_weights(weights)
+    dayof = {k: d for d in day for k in DAYS[d]}
+    tutortimes = indexes['tutortimes']
+    sections = {}
+    members = {}
+    attending = {}
+    tutordays = {}
+    tutorbusy = set()
+    roomsused = {}
+    projectors = {}
+    clashing = []
+    position = {}
+    for (j, k, m), students in classstudents.items():
+        sections.setdefault((j, m), []).append(k)
+        members[(j, k, m)] = list(students)
+        tutordays[(m, dayof[k])] = tutordays.get((m, dayof[k]), 0) + 1
+        tutorbusy.add((m, k))
+        roomsused[k] = roomsused.get(k, 0) + 1
+        if j in PROJECTORS:
+            projectors[k] = projectors.get(k, 0) + 1
+
+    def attend(i, k, change):
+        # Keep the student's class count at time k and the list of clashing (student, time) pairs up to date
+        count = attending.get((i, k), 0) + change
+        attending[(i, k)] = count
+        if count >= 2 and (i, k) not in position:
+            position[(i, k)] = len(clashing)
+            clashing.append((i, k))
+        elif count < 2 and (i, k) in position:
+            last = clashing.pop()
+            n = position.pop((i, k))
+            if last != (i, k):
+                clashing[n] = last
+                position[last] = n
+
+    for (j, k, m), students in members.items():
+        for i in students:
+            attend(i, k, 1)
+    caps = {c: maxclasssize if len(SUBJECTMAPPING[c[0]]) > maxclasssize else None for c in sections}
+    classes = sorted(sections)
+    repeated = [c for c in classes if len(sections[c]) > 1]
+    current = timetable_objective(classstudents, list(dayof), day, DAYS, PROJECTORS, numroomsprojector,
+                                  NONPREFERREDTIMES, weights)
+    stats = {'start': current, 'moves': 0, 'accepted': 0}
+    best = current
+    snapshot = None
+    atbest = True
+    temperature = start = 100.0
+    lastbest = 0
+
+    def overflow(count):
+        return max(0, count - numroomsprojector)
+
+    def student_delta(i, k, k2):
+        return weights['clash'] * ((attending.get((i, k2), 0) == 1) - (attending[(i, k)] == 2))
+
+    while True:
+        stats['moves'] += 1
+        if stats['moves'] % 1000 == 0:
+            elapsed = time.time() - started
+            if elapsed >= timelimit or stats['moves'] - lastbest > stale:
+                break
+            temperature = start * (0.01 ** (elapsed / timelimit))
+        if not repeated or rnd.random() < 0.3:
+            # Shift a repeat of a class to another time
+            (j, m) = rnd.choice(classes)
+            k = rnd.choice(sections[(j, m)])
+            k2 = rnd.choice(tutortimes[m])
+            if k2 in sections[(j, m)] or (m, k2) in tutorbusy or roomsused.get(k2, 0) >= len(ROOMS):
+                continue
+            delta = 0
+            for i in members[(j, k, m)]:
+                delta += student_delta(i, k, k2)
+            delta += weights['nonpreferred'] * ((k2 in NONPREFERREDTIMES) - (k in NONPREFERREDTIMES))
+            if dayof[k] != dayof[k2]:
+                delta += weights['tutorday'] * ((tutordays.get((m, dayof[k2]), 0) == 0) - (tutordays[(m, dayof[k])] == 1))
+            if j in PROJECTORS:
+                delta += weights['projector'] * (overflow(projectors[k] - 1) - overflow(projectors[k]) +
+                                                 overflow(projectors.get(k2, 0) + 1) - overflow(projectors.get(k2, 0)))
+            move = ('class', j, k, m, k2)
+        else:
+            # Move a student to another repeat of the same class, favouring students with a clash
+            if clashing and rnd.random() < 0.5:
+                (i, k) = rnd.choice(clashing)
+                options = [(j, m) for (j, m) in indexes['studentclasses'][i]
+                           if len(sections.get((j, m), ())) > 1 and k in sections[(j, m)] and
+                           i in members[(j, k, m)]]
+                if not options:
+                    continue
+                (j, m) = rnd.choice(options)
+            else:
+                (j, m) = rnd.choice(repeated)
+                k = rnd.choice(sections[(j, m)])
+                if not members[(j, k, m)]:
+                    continue
+                i = rnd.choice(members[(j, k, m)])
+            k2 = rnd.choice(sections[(j, m)])
+            if k2 == k:
+                continue
+            delta = student_delta(i, k, k2)
+            other = None
+            if caps[(j, m)] is not None and len(members[(j, k2, m)]) >= caps[(j, m)]:
+                other = rnd.choice(members[(j, k2, m)])
+                delta += student_delta(other, k2, k)
+            elif len(members[(j, k, m)]) <= minclasssize:
+                continue
+            move = ('student', j, k, m, k2, i, other)
+        if delta > 0 and rnd.random() >= math.exp(-delta / temperature):
+            continue
+        if delta > 0 and atbest:
+            snapshot = {c: list(students) for c, students in members.items()}
+            atbest = False
+        stats['accepted'] += 1
+        if move[0] == 'class':
+            (kind, j, k, m, k2) = move
+            students = members.pop((j, k, m))
+            members[(j, k2, m)] = students
+            for i in students:
+                attend(i, k, -1)
+                attend(i, k2, 1)
+            sections[(j, m)][sections[(j, m)].index(k)] = k2
+            tutorbusy.remove((m, k))
+            tutorbusy.add((m, k2))
+            tutordays[(m, dayof[k])] -= 1
+            tutordays[(m, dayof[k2])] = tutordays.get((m, dayof[k2]), 0) + 1
+            roomsused[k] -= 1
+            roomsused[k2] = roomsused.get(k2, 0) + 1
+            if j in PROJECTORS:
+                projectors[k] -= 1
+                projectors[k2] = projectors.get(k2, 0) + 1
+        else:
+            (kind, j, k, m, k2, i, other) = move
+            members[(j, k, m)].remove(i)
+            members[(j, k2, m)].append(i)
+            attend(i, k, -1)
+            attend(i, k2, 1)
+            if other is not None:
+                members[(j, k2, m)].remove(other)
+                members[(j, k, m)].append(other)
+                attend(other, k2, -1)
+                attend(other, k, 1)
+        current += delta
+        if current < best:
+            best = current
+            atbest = True
+            lastbest = stats['moves']
+    if not atbest:
+        members = snapshot
+    stats['objective'] = best
+    stats['time'] = time.time() - started
+    message = "Local search: objective {} to {} with {} of {} moves accepted in {:.1f}s".format(
+        stats['start'], best, stats['accepted'], stats['moves'], stats['time'])
+    print(message)
+    app.logger.info(message)
+    return {c: sorted(students) for c, students in members.items()}, stats
+
+
+def solve_first_stage_lns(STUDENTS, SUBJECTS, TIMES, day, DAYS, TEACHERS, SUBJECTMAPPING, REPEATS, TEACHERMAPPING,
+                          TUTORAVAILABILITY, maxclasssize, minclasssize, ROOMS, PROJECTORS, PROJECTORROOMS,
+                          numroomsprojector, NONPREFERREDTIMES, CAPACITIES, settings=None, warmstart=None, seed=0):
+    '''
+    Improve a timetable with large neighbourhood search around the first stage model. Part of the timetable is
+    freed with choose_neighbourhood, everything else is fixed to the current timetable through the variable bounds
+    and CBC re-optimises the freed part starting from the current timetable. Better timetables are kept until the
+    time limit.
+
+    Cohorts are not used, as the neighbourhoods free individual students.
+
+    :param settings: Settings for the stage as returned by get_solver_settings()['timetable'], or None. The time limit
+                     falls back to the solver_lns_time_limit config value, the threads are passed on to CBC and the
+                     objective 'weights' are used in the model.
+    :param warmstart: Optional list of classes from a previous timetable, as returned by get_timetable_solution, to
+                      start from. Otherwise the local search engine makes the starting timetable.
+    :param seed: Seed for choosing the neighbourhoods.
+    :return: A dictionary in the same form as solve_first_stage.
+    '''
+    settings = settings or {}
+    timelimit = settings.get('timelimit') or appcfg.get("solver_lns_time_limit", 120)
+    started = time.time()
+    rnd = random.Random(seed)
+    data = (STUDENTS, SUBJECTS, TIMES, day, DAYS, TEACHERS, SUBJECTMAPPING, REPEATS, TEACHERMAPPING, TUTORAVAILABILITY,
+            maxclasssize, minclasssize, ROOMS, PROJECTORS, PROJECTORROOMS, numroomsprojector, NONPREFERREDTIMES,
+            CAPACITIES)
+    classes = warmstart
+    if not classes:
+        start = solve_first_stage_local_search(*data, settings={'timelimit': timelimit / 10,
+                                                                'weights': settings.get('weights')})
+        if start['status'] not in SOLVED_STATUSES:
+            return start
+        classes = [{'subject': j, 'time': k, 'tutor': m, 'students': students}
+                   for (j, k, m), students in start['classstudents'].items()]
+    model, assign_vars, subject_vars, stats = build_timetable_model(STUDENTS, TIMES, day, DAYS, TEACHERS,
+                                                                    SUBJECTMAPPING, REPEATS, TEACHERMAPPING,
+                                                                    TUTORAVAILABILITY, maxclasssize, minclasssize,
+                                                                    ROOMS, PROJECTORS, numroomsprojector,
+                                                                    NONPREFERREDTIMES,
+                                                                    tight=appcfg.get("solver_tight_formulation", False),
+                                                                    weights=settings.get('weights'))
+    stats['warmstart'] = warm_start_model(model, assign_vars, subject_vars, classes, REPEATS)
+    current = stats['warmstart']['objective']
+    result = {'status': "Not Solved", 'objective': None, 'bound': None, 'gap': None, 'stats': stats,
+              'classstudents': {}}
+    if current is None:
+        return result
+    variables = model.variablesDict()
+    incumbent = {name: var.varValue for name, var in variables.items()}
+    classstudents = first_stage_classes(assign_vars, subject_vars, SUBJECTMAPPING)
+    classes = [{'subject': j, 'time': k, 'tutor': m, 'students': students}
+               for (j, k, m), students in classstudents.items()]
+    stats['lns'] = {'start': current, 'iterations': 0, 'improvements': 0}
+    kinds = ('day', 'tutor', 'clash')
+    while True:
+        remaining = timelimit - (time.time() - started)
+        if remaining < 1:
+            break
+        kind = kinds[stats['lns']['iterations'] % len(kinds)]
+        stats['lns']['iterations'] += 1
+        freed = choose_neighbourhood(kind, classes, TEACHERS, TEACHERMAPPING, DAYS, rnd)
+        if freed is None:
+            continue
+        (subjects, students) = freed
+        classbounds, studentbounds, report = solution_bounds(assign_vars, subject_vars, classes, REPEATS,
+                                                             subjects=set(SUBJECTS) - subjects,
+                                                             students=set(STUDENTS) - students)
+        saved = set_bounds(classbounds + studentbounds)
+        try:
+            solved = solve_model(model, {'timelimit': min(appcfg.get("solver_lns_subproblem_time_limit", 10),
+                                                          remaining),
+                                         'threads': settings.get('threads'), 'acceptfeasible': True},
+                                 warmstart=True)
+        finally:
+            set_bounds(saved)
+        if solved['status'] in SOLVED_STATUSES and solved['objective'] < current - 0.5:
+            message = "LNS: freeing {} subjects and {} students by {} improved {} to {}".format(
+                len(subjects), len(students), kind, current, solved['objective'])
+            print(message)
+            app.logger.info(message)
+            current = solved['objective']
+            stats['lns']['improvements'] += 1
+            incumbent = {name: var.varValue for name, var in variables.items()}
+            classstudents = first_stage_classes(assign_vars, subject_vars, SUBJECTMAPPING)
+            classes = [{'subject': j, 'time': k, 'tutor': m, 'students': students}
+                       for (j, k, m), students in classstudents.items()]
+        else:
+            for name, var in variables.items():
+                var.varValue = incumbent[name]
+    stats['lns']['objective'] = current
+    stats['lns']['time'] = time.time() - started
+    message = "LNS: objective {} to {} with {} improvements in {} iterations".format(
+        stats['lns']['start'], current, stats['lns']['improvements'], stats['lns']['iterations'])
+    print(message)
+    app.logger.info(message)
+    result.update(status="Feasible", objective=current, classstudents=classstudents)
+    return result
+
+
+def choose_neighbourhood(kind, classes, TEACHERS, TEACHERMAPPING, DAYS, rnd):
+    '''
+    Pick the part of a timetable for solve_first_stage_lns to re-optimise.
+
+    :param kind: "day" frees the classes on a random day, "tutor" frees the classes of a random tutor and "clash"
+                 frees the classes a random clashing student has at the time of their clash, along with every student
+                 in those classes who has a clash somewhere.
+    :param classes: List of dictionaries of subject, time, tutor and students of the current timetable.
+    :param rnd: The random.Random to choose with.
+    :return: A tuple of the set of subjects whose classes are freed and the set of students whose placements in the
+             other subjects are freed, or None if there is nothing to free.
+    '''
+    if kind == 'day':
+        times = DAYS[rnd.choice(sorted(DAYS))]
+        subjects = set(timeclass['subject'] for timeclass in classes if timeclass['time'] in times)
+        return (subjects, set()) if subjects else None
+    if kind == 'tutor':
+        tutors = [m for m in TEACHERS if TEACHERMAPPING[m]]
+        if not tutors:
+            return None
+        return set(TEACHERMAPPING[rnd.choice(tutors)]), set()
+    attending = {}
+    for timeclass in classes:
+        for i in timeclass['students']:
+            attending[(i, timeclass['time'])] = attending.get((i, timeclass['time']), 0) + 1
+    clashes = sorted(key for key, count in attending.items() if count >= 2)
+    if not clashes:
+        return None
+    clashing = set(i for (i, k) in clashes)
+    (i, k) = rnd.choice(clashes)
+    clashclasses = [timeclass for timeclass in classes if timeclass['time'] == k and i in timeclass['students']]
+    subjects = set(timeclass['subject'] for timeclass in clashclasses)
+    students = set(s for timeclass in clashclasses for s in timeclass['students'] if s in clashing)
+    return subjects, students
+
+
+def first_stage_classes(assign_vars, subject_vars, SUBJECTMAPPING):
+    '''
+    Read the running classes and their students from a solved first stage model without cohorts.
+
+    :return: Dictionary of the running (subject, time, tutor) classes -> their students.
+    '''
+    classstudents = {}
+    for (j, k, m) in subject_vars:
+        if subject_vars[(j, k, m)].varValue is not None and subject_vars[(j, k, m)].varValue > 0.5:
+            classstudents[(j, k, m)] = [i for i in SUBJECTMAPPING[j] if assign_vars[(i, j, k, m)].varValue > 0.5]
+    return classstudents
+
+
+SOLVED_STATUSES = ("Optimal", "Feasible")
+
+
+def solve_model(model, settings=None, warmstart=False):
+    '''
+    Solve a model with CBC using the time limit, gap, threads and accept feasible settings for its stage.
+
+    When the time limit is reached with a timetable found but not proven optimal the status is "Feasible" if
+    acceptfeasible is set and "Not Solved" otherwise.
+
+    :param model: The PuLP model.
+    :param settings: Dictionary of timelimit, gap, threads and acceptfeasible, or None for the CBC defaults. It can
+                     also have a list of extra CBC command line options, e.g. ["cuts off"].
+    :param warmstart: Whether to pass the current variable values to CBC as a starting solution.
+    :return: Dictionary of status, objective, bound and gap. The objective, bound and gap are None if no solution
+             was found.
+    '''
+    settings = settings or {}
+    logfile = tempfile.NamedTemporaryFile(prefix='cbc', suffix='.log', delete=False)
+    logfile.close()
+    try:
+        model.solve(PULP_CBC_CMD(timeLimit=settings.get('timelimit'), gapRel=settings.get('gap'),
+                                 threads=settings.get('threads'), warmStart=warmstart, msg=False,
+                                 logPath=logfile.name, options=settings.get('options')))
+        with open(logfile.name) as f:
+            log = f.read()
+    finally:
+        os.remove(logfile.name)
+    result = {'status': LpStatus[model.status], 'objective': None, 'bound': None, 'gap': None}
+    if result['status'] != "Optimal":
+        return result
+    if model.sol_status == LpSolutionIntegerFeasible:
+        result['status'] = "Feasible" if settings.get('acceptfeasible') else "Not Solved"
+    result['objective'] = value(model.objective) or 0
+    result['bound'] = result['objective']
+    for line in log.splitlines():
+        if line.startswith('Lower bound:'):
+            result['bound'] = float(line.split(':')[1])
+    result['gap'] = calculate_gap(result['objective'], result['bound'])
+    message = "{}: objective {} bound {} gap {:.2%}".format(result['status'], result['objective'], result['bound'],
+                                                              result['gap'])
+    print(message)
+    app.logger.info(message)
+    return result
+
+
+def solution_bounds(assign_vars, subject_vars, classes, REPEATS, cohorts=None, subjects=None, students=None):
+    '''
+    Work out the variable bounds that fix the first stage model to the classes of a previous timetable.
+
+    Classes whose subject, tutor or time no longer exist in the model are skipped, as are extra repeats and students
+    who no longer take the subject.
+
+    :param classes: List of dictionaries of subject, time, tutor and students from get_timetable_solution.
+    :param cohorts: Dictionary of cohort name -> students if the model uses cohorts, otherwise None.
+    :param subjects: Optional set of subjects to fix. All subjects are fixed if None.
+    :param students: Optional set of students whose placements are fixed. All students are fixed if None.
+    :return: A tuple of the class bounds, the student bounds and a report of how many classes and students were used
+             and skipped. Each bound is a tuple of the variable, its lower bound and its upper bound.
+    '''
+    report = {'classes': 0, 'skippedclasses': 0, 'students': 0, 'skippedstudents': 0}
+    cohortof = {}
+    if cohorts is not None:
+        cohortof = {i: c for c, members in cohorts.items() for i in members}
+    placed = {}
+    for timeclass in sorted(classes, key=lambda timeclass: len(timeclass['students']), reverse=True):
+        (j, k, m) = (timeclass['subject'], timeclass['time'], timeclass['tutor'])
+        if subjects is not None and j not in subjects:
+            continue
+        if (j, k, m) not in subject_vars or len(placed.get((j, m), [])) >= REPEATS[j]:
+            report['skippedclasses'] += 1
+            continue
+        placed.setdefault((j, m), []).append((j, k, m, timeclass['students']))
+        report['classes'] += 1
+
+    classbounds = []
+    studentbounds = []
+    for (j, m), placements in placed.items():
+        for (j, k, m, classstudents) in placements:
+            classbounds.append((subject_vars[(j, k, m)], 1, 1))
+            counts = {}
+            for i in classstudents:
+                if students is not None and i not in students:
+                    continue
+                key = (cohortof.get(i, i), j, k, m)
+                if key in assign_vars and (cohorts is None or i in cohortof):
+                    counts[key] = counts.get(key, 0) + 1
+                    report['students'] += 1
+                else:
+                    report['skippedstudents'] += 1
+            for key, count in counts.items():
+                studentbounds.append((assign_vars[key], count, assign_vars[key].upBound))
+        if len(placements) == REPEATS[j]:
+            times = [k for (j2, k, m2, classstudents) in placements]
+            for (j2, k, m2) in subject_vars:
+                if j2 == j and m2 == m and k not in times:
+                    classbounds.append((subject_vars[(j2, k, m2)], 0, 0))
+    return classbounds, studentbounds, report
+
+
+def set_bounds(bounds):
+    '''
+    Set the bounds of model variables.
+    :param bounds: List of tuples of variable, lower bound and upper bound.
+    :return: The previous bounds in the same form so they can be restored.
+    '''
+    saved = [(var, var.lowBound, var.upBound) for (var, low, up) in bounds]
+    for (var, low, up) in bounds:
+        var.lowBound = low
+        var.upBound = up
+    return saved
+
+
+def warm_start_model(model, assign_vars, subject_vars, classes, REPEATS, cohorts=None):
+    '''
+    Set the variable values of the first stage model from the classes of a previous timetable so that CBC can start
+    from them.
+
+    The placements that are still valid are fixed and the model is solved once to fill in everything else, such as
+    new students and the clash and tutor day variables. If that is infeasible, for example because class sizes have
+    changed, it is tried again with only the class times fixed. If that also fails no starting solution is used.
+
+    :param classes: List of dictionaries of subject, time, tutor and students from get_timetable_solution.
+    :param cohorts: Dictionary of cohort name -> students if the model uses cohorts, otherwise None.
+    :return: Dictionary with the number of classes and students used and skipped and the objective of the starting
+             solution, which is None if no starting solution could be made.
+    '''
+    classbounds, studentbounds, report = solution_bounds(assign_vars, subject_vars, classes, REPEATS, cohorts=cohorts)
+    report['objective'] = None
+    for fixed in (classbounds + studentbounds, classbounds):
+        if not fixed:
+            break
+        saved = set_bounds(fixed)
+        try:
+            completed = solve_model(model, {'timelimit': appcfg.get("solver_warm_start_time_limit", 60),
+                                            'acceptfeasible': True})
+        finally:
+            set_bounds(saved)
+        if completed['status'] in SOLVED_STATUSES:
+            report['objective'] = completed['objective']
+            if fixed is classbounds:
+                report['skippedstudents'] += report['students']
+                report['students'] = 0
+            break
+    message = "Warm start: {} classes and {} students used, {} classes and {} students skipped, objective {}".format(
+        report['classes'], report['students'], report['skippedclasses'], report['skippedstudents'],
+        report['objective'])
+    print(message)
+    app.logger.info(message)
+    return report
+
+
+def calculate_gap(objective, bound):
+    '''
+    The relative gap between the incumbent objective and the best bound, as CBC calculates it.
+    :return: The gap as a fraction.
+    '''
+    if objective == bound:
+        return 0.0
+    return abs(objective - bound) / max(abs(objective), 1e-10)
+
+
+def group_student_cohorts(STUDENTS, SUBJECTMAPPING):
+    '''
+    Group together students who take exactly the same subjects. Students in a cohort are interchangeable in the
+    first stage model, so it only needs to decide how many of each cohort attend each class.
+
+    :param STUDENTS: should be an array of student names
+    :param SUBJECTMAPPING: should be a dictionary of subjects -> students
+    :return: Dictionary of cohort name -> list of students.
+    '''
+    enrolments = {i: [] for i in STUDENTS}
+    for j in SUBJECTMAPPING:
+        for i in SUBJECTMAPPING[j]:
+            enrolments.setdefault(i, []).append(j)
+    groups = {}
+    for i in STUDENTS:
+        groups.setdefault(frozenset(enrolments[i]), []).append(i)
+    cohorts = {}
+    for members in sorted(groups.values(), key=lambda members: members[0]):
+        cohorts["Cohort" + str(len(cohorts))] = members
+    message = "Grouped {} students into {} cohorts".format(len(STUDENTS), len(cohorts))
+    print(message)
+    app.logger.info(message)
+    return cohorts
+
+
+def expand_cohorts(cohorts, assign_vars, running):
+    '''
+    Turn the cohort counts from the first stage model back into individual students in each class.
+
+    Each student is placed in turn, choosing for each of their classes the time with places left where they have the
+    fewest classes already, so the realised clashes are as close as possible to what the model counted.
+
+    :param cohorts: Dictionary of cohort name -> list of students
+    :param assign_vars: The (cohort, subject, time, tutor) assignment variables of the solved model
+    :param running: List of the running (subject, time, tutor) classes
+    :return: Dictionary of running (subject, time, tutor) -> list of students.
+    '''
+    classstudents = {(j, k, m): [] for (j, k, m) in running}
+    places = {}
+    for (c, j, k, m) in assign_vars:
+        count = int(round(assign_vars[(c, j, k, m)].varValue or 0))
+        if count > 0:
+            places.setdefault(c, {}).setdefault((j, m), {})[k] = count
+    clashes = 0
+    for c, members in cohorts.items():
+        cohortplaces = places.get(c, {})
+        for i in members:
+            load = {}
+            # Place the classes with the fewest time options first
+            for (j, m) in sorted(cohortplaces, key=lambda jm: len([k for k in cohortplaces[jm]
+                                                                   if cohortplaces[jm][k] > 0])):
+                options = [k for k in cohortplaces[(j, m)] if cohortplaces[(j, m)][k] > 0]
+                k = min(options, key=lambda k: (load.get(k, 0), -cohortplaces[(j, m)][k]))
+                cohortplaces[(j, m)][k] -= 1
+                load[k] = load.get(k, 0) + 1
+                classstudents[(j, k, m)].append(i)
+            clashes += len([k for k in load if load[k] > 1])
+    message = "Expanded {} cohorts into students with {} clashes".format(len(cohorts), clashes)
+    print(message)
+    app.logger.info(message)
+    return classstudents
+
+
+def benchmark_formulations(STUDENTS, SUBJECTS, TIMES, day, DAYS, TEACHERS, SUBJECTMAPPING, REPEATS, TEACHERMAPPING,
+                           TUTORAVAILABILITY, maxclasssize, minclasssize, ROOMS, PROJECTORS, PROJECTORROOMS,
+                           numroomsprojector, NONPREFERREDTIMES, CAPACITIES):
+    '''
+    Build and solve the first stage model with the standard and the tightened formulation on the same data.
+
+    :return: List of dictionaries with the formulation, status, objective, model size and build and solve times.
+    '''
+    results = []
+    for formulation in ('standard', 'tight'):
+        start = time.time()
+        model, assign_vars, subject_vars, stats = build_timetable_model(STUDENTS, TIMES, day, DAYS, TEACHERS,
+                                                                        SUBJECTMAPPING, REPEATS, TEACHERMAPPING,
+                                                                        TUTORAVAILABILITY, maxclasssize, minclasssize,
+                                                                        ROOMS, PROJECTORS, numroomsprojector,
+                                                                        NONPREFERREDTIMES,
+                                                                        tight=(formulation == 'tight'))
+        built = time.time()
+        model.solve()
+        solved = time.time()
+        results.append({'formulation': formulation, 'status': LpStatus[model.status],
+                        'objective': value(model.objective), 'variables': stats['total'],
+                        'constraints': stats['constraints'], 'buildtime': built - start, 'solvetime': solved - built})
+        message = "Benchmark {}: {} objective {} in {:.1f}s".format(formulation, LpStatus[model.status],
+                                                                   value(model.objective), solved - built)
+        print(message)
+        app.logger.info(message)
+    return results
+
+
+def benchmark_room_allocators(STUDENTS, SUBJECTS, TIMES, day, DAYS, TEACHERS, SUBJECTMAPPING, REPEATS,
+                              TEACHERMAPPING, TUTORAVAILABILITY, maxclasssize, minclasssize, ROOMS, PROJECTORS,
+                              PROJECTORROOMS, numroomsprojector, NONPREFERREDTIMES, CAPACITIES):
+    '''
+    Solve the first stage once and allocate rooms for its classes with each room allocation engine.
+
+    :return: List of dictionaries with the engine, status, objective and time taken, or an empty list if the first
+             stage could not be solved.
+    '''
+    first = solve_first_stage(STUDENTS, SUBJECTS, TIMES, day, DAYS, TEACHERS, SUBJECTMAPPING, REPEATS, TEACHERMAPPING,
+                              TUTORAVAILABILITY, maxclasssize, minclasssize, ROOMS, PROJECTORS, PROJECTORROOMS,
+                              numroomsprojector, NONPREFERREDTIMES, CAPACITIES)
+    if first['status'] not in SOLVED_STATUSES:
+        return []
+    classpop = {key: len(students) for key, students in first['classstudents'].items()}
+    results = []
+    for engine in attendance.models.SOLVER_ENGINES['rooms']:
+        rooms = allocate_rooms(TEACHERS, TEACHERMAPPING, ROOMS, PROJECTORS, PROJECTORROOMS, CAPACITIES, classpop,
+                               {'engine': engine})
+        results.append({key: rooms[key] for key in ('engine', 'status', 'objective', 'time')})
+    return results
+
+
+def benchmark_pipelines(STUDENTS, SUBJECTS, TIMES, day, DAYS, TEACHERS, SUBJECTMAPPING, REPEATS, TEACHERMAPPING,
+                        TUTORAVAILABILITY, maxclasssize, minclasssize, ROOMS, PROJECTORS, PROJECTORROOMS,
+                        numroomsprojector, NONPREFERREDTIMES, CAPACITIES):
+    '''
+    Solve the same data with each timetable engine: the single first stage model, the sectioned pipeline, which
+    places the classes and then sections the students, the local search and the large neighbourhood search. Each is
+    followed by room allocation.
+
+    :return: List of dictionaries with the pipeline, status, first stage objective, number of clashes, number of
+             variables and the time taken by each stage.
+    '''
+    data = (STUDENTS, SUBJECTS, TIMES, day, DAYS, TEACHERS, SUBJECTMAPPING, REPEATS, TEACHERMAPPING, TUTORAVAILABILITY,
+            maxclasssize, minclasssize, ROOMS, PROJECTORS, PROJECTORROOMS, numroomsprojector, NONPREFERREDTIMES,
+            CAPACITIES)
+    results = []
+    for pipeline in attendance.models.SOLVER_ENGINES['timetable']:
+        started = time.time()
+        if pipeline == 'sectioned':
+            first = solve_first_stage_sectioned(*data)
+        elif pipeline == 'localsearch':
+            first = solve_first_stage_local_search(*data)
+        elif pipeline == 'lns':
+            first = solve_first_stage_lns(*data)
+        else:
+            first = solve_first_stage(*data)
+        row = {'pipeline': pipeline, 'status': first['status'], 'objective': None, 'clashes': None,
+               'variables': first['stats']['total'], 'firststage': time.time() - started, 'rooms': None}
+        if first['status'] in SOLVED_STATUSES:
+            row['objective'] = timetable_objective(first['classstudents'], TIMES, day, DAYS, PROJECTORS,
+                                                   numroomsprojector, NONPREFERREDTIMES)
+            row['clashes'] = count_clashes(first['classstudents'])
+            classpop = {key: len(students) for key, students in first['classstudents'].items()}
+            rooms = allocate_rooms(TEACHERS, TEACHERMAPPING, ROOMS, PROJECTORS, PROJECTORROOMS, CAPACITIES, classpop)
+            row['rooms'] = round(rooms['time'], 3)
+        results.append(row)
+        message = "Benchmark {}: {} objective {} in {:.1f}s".format(pipeline, row['status'], row['objective'],
+                                                                   time.time() - started)
+        print(message)
+        app.logger.info(message)
+    return results
+
+
+def find_independent_components(STUDENTS, SUBJECTS, TIMES, day, DAYS, TEACHERS, SUBJECTMAPPING, REPEATS,
+                                TEACHERMAPPING, TUTORAVAILABILITY, maxclasssize, minclasssize, ROOMS, PROJECTORS,
+                                PROJECTORROOMS, numroomsprojector, NONPREFERREDTIMES, CAPACITIES):
+    '''
+    Split the subjects into groups that can be timetabled independently of each other.
+
+    Subjects are linked when they share a student or a tutor. The room count and projector limits are shared by every
+    subject, so at any time where one of those limits could actually bind (more tutors could be teaching than there
+    are rooms, or more projector classes than projector rooms) all the subjects that could run at that time are
+    linked as well. Solving each group on its own then gives the same optimum as the full model.
+
+    :return: A list of sets of subject codes.
+    '''
+    parent = {j: j for (m, subjects) in TEACHERMAPPING.items() if m in TEACHERS for j in subjects}
+
+    def find(j):
+        while parent[j] != j:
+            parent[j] = parent[parent[j]]
+            j = parent[j]
+        return j
+
+    def union(subjects):
+        subjects = list(subjects)
+        for j in subjects[1:]:
+            root1, root2 = find(subjects[0]), find(j)
+            if root1 != root2:
+                parent[root2] = root1
 
-    classpop = {}
     for m in TEACHERS:
-        for j in TEACHERMAPPING[m]:
-            for k in TIMES:
-                if subject_vars[(j,k,m)].varValue == 1:
-                    classpop[(j,k,m)] = sum(assign_vars[(i,j,k,m)].varValue for i in SUBJECTMAPPING[j])
-
-    if LpStatus[model.status] == "Optimal":
-        print("Allocating Rooms")
-        model2 = LpProblem('RoomAllocation', LpMinimize)
-        print("Defining Variables")
-        subject_vars_rooms = LpVariable.dicts("SubjectVariablesRooms",
-                                              [(j, k, m, n) for m in TEACHERS for j in TEACHERMAPPING[m] for k in TIMES for
-                                               n in ROOMS if (j,k,m) in classpop.keys()], 0, 1, LpBinary)
-
-        teacher_number_rooms = LpVariable.dicts("NumberRoomsTeacher", [(m, n) for m in TEACHERS for n in ROOMS], 0, 1,
-                                                LpBinary)
-        teacher_number_rooms_sum = LpVariable.dicts("NumberRoomsTeacherSum", [(m) for m in TEACHERS], 0)
-
-        projector_rooms_sum = LpVariable.dicts("ProjectorRooms", [(j) for j in PROJECTORS])
-
-        populationovershoot = LpVariable.dicts("PopulationOvershoot", [(k,n) for k in TIMES for n in ROOMS])
-
-        poppositive = LpVariable.dicts("PopulationPositivePart", [(k, n) for k in TIMES for n in ROOMS])
-
-        print("Minimizing number of rooms for each tutor")
-        for m in TEACHERS:
-            for n in ROOMS:
-                model2 += teacher_number_rooms[(m, n)] >= 0.01 * lpSum(
-                    subject_vars_rooms[(j, k, m, n)] for j in TEACHERMAPPING[m] for k in TIMES if (j,k,m) in classpop.keys())
-                model2 += teacher_number_rooms[(m, n)] <= lpSum(
-                    subject_vars_rooms[(j, k, m, n)] for j in TEACHERMAPPING[m] for k in TIMES if (j,k,m) in classpop.keys())
-        for m in TEACHERS:
-            model2 += teacher_number_rooms_sum[(m)] == lpSum(teacher_number_rooms[(m, n)] for n in ROOMS)
-
-        # Rooms must be allocated at times when the classes are running
-        print("Constraining Times")
-        for m in TEACHERS:
-            for j in TEACHERMAPPING[m]:
-                for k in TIMES:
-                    if (j,k,m) in classpop.keys():
-                        model2 += lpSum(subject_vars_rooms[(j, k, m, n)] for n in ROOMS) == subject_vars[(j, k, m)].varValue
+        union(TEACHERMAPPING[m])
+    studentsubjects = {}
+    for j in parent:
+        for i in SUBJECTMAPPING[j]:
+            studentsubjects.setdefault(i, []).append(j)
+    for subjects in studentsubjects.values():
+        union(subjects)
+    for k in TIMES:
+        tutors = [m for m in TEACHERS if TEACHERMAPPING[m] and k in TUTORAVAILABILITY.get(m, set())]
+        if len(tutors) > len(ROOMS):
+            union(j for m in tutors for j in TEACHERMAPPING[m])
+        projectortutors = [m for m in tutors if any(j in PROJECTORS for j in TEACHERMAPPING[m])]
+        if len(projectortutors) > numroomsprojector:
+            union(j for m in projectortutors for j in TEACHERMAPPING[m] if j in PROJECTORS)
 
+    components = {}
+    for j in parent:
+        components.setdefault(find(j), set()).add(j)
+    return list(components.values())
 
 
-        for m in TEACHERS:
-            for j in TEACHERMAPPING[m]:
-                if j in PROJECTORS:
-                    model2 += projector_rooms_sum[(j)] == lpSum(subject_vars_rooms[(j,k,m,n)] for n in PROJECTORROOMS for k in TIMES if (j,k,m) in classpop.keys())
+def restrict_timetable_data(data, subjects):
+    '''
+    Restrict the timetable data to a group of subjects and the students and tutors attached to them.
 
-        print("Ensuring Uniqueness")
-        # Can only have one class in each room at a time.
-        for k in TIMES:
-            for n in ROOMS:
-                model2 += lpSum(subject_vars_rooms[(j, k, m, n)] for m in TEACHERS for j in TEACHERMAPPING[m] if (j,k,m) in classpop.keys()) <= 1
+    :param data: The timetable data tuple from get_timetable_data(rooms=True).
+    :param subjects: The set of subject codes to keep.
+    :return: A timetable data tuple for just those subjects.
+    '''
+    (STUDENTS, SUBJECTS, TIMES, day, DAYS, TEACHERS, SUBJECTMAPPING, REPEATS, TEACHERMAPPING, TUTORAVAILABILITY,
+     maxclasssize, minclasssize, ROOMS, PROJECTORS, PROJECTORROOMS, numroomsprojector, NONPREFERREDTIMES,
+     CAPACITIES) = data
+    students = set(i for j in subjects for i in SUBJECTMAPPING[j])
+    teachers = [m for m in TEACHERS if TEACHERMAPPING[m] & subjects]
+    return ([i for i in STUDENTS if i in students], [j for j in SUBJECTS if j in subjects], TIMES, day, DAYS, teachers,
+            {j: SUBJECTMAPPING[j] for j in subjects}, {j: REPEATS[j] for j in subjects},
+            {m: TEACHERMAPPING[m] for m in teachers}, {m: TUTORAVAILABILITY.get(m, set()) for m in teachers},
+            maxclasssize, minclasssize, ROOMS, [j for j in PROJECTORS if j in subjects], PROJECTORROOMS, numroomsprojector,
+            NONPREFERREDTIMES, CAPACITIES)
+
+
+def solve_component(instance, settings=None, warmstart=None, fixed=None):
+    '''
+    Solve the first stage for one independent component in a worker process.
 
+    :param instance: A problem instance from serialize_timetable_data.
+    :param settings: CBC settings for the first stage, or None.
+    :param warmstart: Optional list of classes from a previous timetable to start from.
+    :param fixed: Optional dictionary of the subjects and students to keep as they are in warmstart.
+    :return: A result dictionary as returned by solve_first_stage.
+    '''
+    return solve_first_stage(*deserialize_timetable_data(instance), settings=settings, warmstart=warmstart,
+                             fixed=fixed)
 
-        print("Accomodating Capacities")
 
-        for k in TIMES:
+def solve_first_stage_decomposed(data, processes=None, settings=None, warmstart=None, fixed=None):
+    '''
+    Solve the first stage by splitting it into independent components and solving them concurrently.
+
+    :param data: The timetable data tuple from get_timetable_data(rooms=True).
+    :param processes: The number of worker processes to use, or None to use one per CPU.
+    :param settings: CBC settings for the first stage, or None. The time limit applies to each component.
+    :param warmstart: Optional list of classes from a previous timetable to start from.
+    :param fixed: Optional dictionary of the subjects and students to keep as they are in warmstart.
+    :return: A result dictionary as returned by solve_first_stage with the components merged together.
+    '''
+    components = find_independent_components(*data)
+    message = "Split timetable into {} independent components".format(len(components))
+    print(message)
+    app.logger.info(message)
+    if len(components) <= 1:
+        return solve_first_stage(*data, settings=settings, warmstart=warmstart, fixed=fixed)
+
+    # Largest first so the long solves start straight away.
+    components.sort(key=lambda subjects: sum(len(data[6][j]) for j in subjects), reverse=True)
+    instances = [serialize_timetable_data(restrict_timetable_data(data, subjects)) for subjects in components]
+    processes = min(processes or os.cpu_count() or 1, len(instances))
+    with ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context('fork')) as pool:
+        results = list(pool.map(solve_component, instances, [settings] * len(instances),
+                                [warmstart] * len(instances), [fixed] * len(instances)))
+
+    merged = {'status': "Optimal", 'classstudents': {}, 'stats': {}, 'objective': 0, 'bound': 0, 'gap': None}
+    for result in results:
+        if result['status'] not in SOLVED_STATUSES:
+            merged['status'] = result['status']
+            merged['objective'] = None
+        else:
+            if result['status'] == "Feasible" and merged['status'] == "Optimal":
+                merged['status'] = "Feasible"
+            merged['classstudents'].update(result['classstudents'])
+            if merged['objective'] is not None:
+                merged['objective'] += result['objective']
+                merged['bound'] += result['bound']
+    merged['stats'] = merge_model_statistics([result['stats'] for result in results])
+    merged['stats']['components'] = len(components)
+    if merged['status'] not in SOLVED_STATUSES:
+        merged['classstudents'] = {}
+        merged['bound'] = None
+    else:
+        merged['gap'] = calculate_gap(merged['objective'], merged['bound'])
+    return merged
 
-            for n in ROOMS:
 
+def merge_model_statistics(allstats):
+    '''
+    Add up the model statistics from several sub-models.
+    :param allstats: List of statistics dictionaries from report_model_reduction.
+    :return: A combined statistics dictionary.
+    '''
+    merged = {'dense': {}, 'variables': {}, 'constraints': 0, 'densetotal': 0, 'total': 0}
+    for stats in allstats:
+        for family in ('dense', 'variables'):
+            for key, value in stats[family].items():
+                merged[family][key] = merged[family].get(key, 0) + value
+        for key in ('constraints', 'densetotal', 'total'):
+            merged[key] += stats[key]
+        for report in ('fixed', 'warmstart'):
+            if stats.get(report):
+                for key, value in stats[report].items():
+                    if value is not None:
+                        merged.setdefault(report, {})[key] = merged.get(report, {}).get(key, 0) + value
+    merged['reduction'] = 1 - merged['total'] / merged['densetotal'] if merged['densetotal'] > 0 else 0
+    return merged
+
+
+def solve_timetable(STUDENTS, SUBJECTS, TIMES, day, DAYS, TEACHERS, SUBJECTMAPPING, REPEATS, TEACHERMAPPING,
+                    TUTORAVAILABILITY, maxclasssize, minclasssize, ROOMS, PROJECTORS, PROJECTORROOMS, numroomsprojector,
+                    NONPREFERREDTIMES, CAPACITIES, cancelled=None, settings=None, warmstart=None, fixed=None):
+    '''
+    Solve both stages of the timetabling model without touching the database.
+
+    If "solver_decompose" is set in the config the first stage is split into independent components which are solved
+    in parallel before the rooms are allocated for all of them together.
+
+    :param cancelled: Optional function returning True if the run has been cancelled. It is checked between stages.
+    :param settings: CBC settings for each stage as returned by get_solver_settings(), or None for the CBC defaults.
+    :param warmstart: Optional list of classes from a previous timetable, as returned by get_timetable_solution, to
+                      start the first stage from.
+    :param fixed: Optional dictionary of the subjects and students to keep as they are in warmstart, as returned by
+                  find_unchanged.
+    :return: A dictionary with the solver status, the model statistics, the first stage objective and gap and the
+             chosen classes. Each class is a dictionary of subject, time, tutor, room and the students attending it.
+             The status is "Feasible" rather than "Optimal" if either stage stopped before proving optimality.
+    '''
+    settings = settings or {}
+    print("Running solver")
+    data = (STUDENTS, SUBJECTS, TIMES, day, DAYS, TEACHERS, SUBJECTMAPPING, REPEATS, TEACHERMAPPING, TUTORAVAILABILITY,
+            maxclasssize, minclasssize, ROOMS, PROJECTORS, PROJECTORROOMS, numroomsprojector, NONPREFERREDTIMES,
+            CAPACITIES)
+    if cancelled is not None and cancelled():
+        return {'status': "Cancelled", 'stats': {}, 'classes': []}
+    cachekey = None
+    if appcfg.get("solver_cache", False) and not warmstart:
+        cachekey = solver_cache_key(data, 'all', settings)
+        cached = read_solver_cache(cachekey, 'result')
+        if cached is not None:
+            cached['stats']['cache'] = cachekey
+            return cached
+    engine = (settings.get('timetable') or {}).get('engine')
+    if engine == 'sectioned':
+        first = solve_first_stage_sectioned(*data, settings=settings.get('timetable'))
+    elif engine == 'localsearch':
+        first = solve_first_stage_local_search(*data, settings=settings.get('timetable'))
+    elif engine == 'lns':
+        first = solve_first_stage_lns(*data, settings=settings.get('timetable'), warmstart=warmstart)
+    elif appcfg.get("solver_decompose", False):
+        first = solve_first_stage_decomposed(data, processes=appcfg.get("solver_processes"),
+                                             settings=settings.get('timetable'), warmstart=warmstart, fixed=fixed)
+    else:
+        first = solve_first_stage(*data, settings=settings.get('timetable'), warmstart=warmstart, fixed=fixed)
+    print("Completed Timetable")
+    result = {'status': first['status'], 'stats': first['stats'], 'objective': first['objective'],
+              'gap': first['gap'], 'classes': []}
+    result['stats']['stages'] = {'timetable': {key: first[key] for key in ('status', 'objective', 'bound', 'gap')}}
+    if result['status'] not in SOLVED_STATUSES:
+        return result
+
+    classstudents = first['classstudents']
+    classpop = {key: len(students) for key, students in classstudents.items()}
+
+    if cancelled is not None and cancelled():
+        result['status'] = "Cancelled"
+        return result
+    print("Allocating Rooms")
+    rooms = allocate_rooms(TEACHERS, TEACHERMAPPING, ROOMS, PROJECTORS, PROJECTORROOMS, CAPACITIES, classpop,
+                           settings.get('rooms'))
+    allocation = rooms.pop('allocation')
+    result['stats']['stages']['rooms'] = rooms
+    if rooms['status'] not in SOLVED_STATUSES:
+        result['status'] = "Room Allocation " + rooms['status']
+        return result
+    if rooms['status'] == "Feasible":
+        result['status'] = "Feasible"
+
+    for (j, k, m), n in allocation.items():
+        result['classes'].append({'subject': j, 'time': k, 'tutor': m, 'room': n,
+                                  'students': classstudents[(j, k, m)]})
+    if warmstart:
+        result['stats']['movedstudents'] = count_moved_students(warmstart, result['classes'])
+    if cachekey is not None:
+        write_solver_cache(cachekey, 'result', result)
+        evict_solver_cache()
+    print("Complete")
+    return result
 
 
-                model2 += populationovershoot[(k,n)] == (lpSum(classpop[(j,k,m)]*subject_vars_rooms[(j,k,m,n)] for m in TEACHERS for j in TEACHERMAPPING[m] if (j,k,m) in classpop.keys()) - CAPACITIES[n])
-                #print("Second")
-                model2 += poppositive[(k,n)] >= populationovershoot[(k,n)]
-                model2 += poppositive[(k,n)] >= 0
+def runtimetable_with_rooms_two_step(STUDENTS, SUBJECTS, TIMES, day, DAYS, TEACHERS, SUBJECTMAPPING, REPEATS,
+                                     TEACHERMAPPING,
+                                     TUTORAVAILABILITY, maxclasssize, minclasssize, ROOMS, PROJECTORS, PROJECTORROOMS, numroomsprojector, NONPREFERREDTIMES, CAPACITIES,
+                                     job=None, settings=None):
+    '''
+    Run the timetabling process and input into the database.
 
+    This process calls the CBCSolver using the PuLP package and then adds the classes to the database.
 
 
-        print("Setting Objective Function")
-        model2 += lpSum(teacher_number_rooms_sum[(m)] for m in TEACHERS) - 50 * lpSum(projector_rooms_sum[(j)] for j in PROJECTORS) +10 * lpSum(poppositive[(k,n)] for k in TIMES for n in ROOMS)
-        print("Solve Room Allocation")
-        model2.solve()
-        print(LpStatus[model2.status])
-        if LpStatus[model2.status] == 'Optimal':
-            print("Complete")
-            print("Adding to Database")
-            attendance.models.add_classes_to_timetable_twostep(TEACHERS, TEACHERMAPPING, SUBJECTMAPPING, TIMES,
-                                                               subject_vars_rooms, assign_vars, ROOMS, classpop)
-            print("Status:", LpStatus[model2.status])
-    return LpStatus[model.status]
+    :param STUDENTS: should be an array of student names
+    :param SUBJECTS: should be an array of subject codes
+    :param TIMES: an array of strings representing possible timeslots
+    :param day:
+    :param DAYS: the days corresponding to the timeslots above
+    :param TEACHERS: an array of the names of the tutors
+    :param SUBJECTMAPPING: This is a dictionary representing the subjects
+                            each tutor is taking
+    :param REPEATS: A dictionary of how many repeats each subject has
+    :param TEACHERMAPPING: A dictionary of what subject each tutor teachers
+    :param TUTORAVAILABILITY:
+    :param maxclasssize: An integer representing the maximum class size
+    :param minclasssize: An integer representing the minimum class size
+    :param nrooms: An integer representing the max allowable concurrent classes
+    :param CAPACITIES: A dictionary indexed by room name with the amount of people that each room can contain
+    :param job: The SolverJob this run belongs to, if any. It is checked for cancellation between stages.
+    :param settings: CBC settings for each stage as returned by get_solver_settings(), or None.
+    :return: A string representing model status.
+    '''
+    cancelled = job.is_cancelled if job is not None else None
+    result = solve_timetable(STUDENTS, SUBJECTS, TIMES, day, DAYS, TEACHERS, SUBJECTMAPPING, REPEATS, TEACHERMAPPING,
+                             TUTORAVAILABILITY, maxclasssize, minclasssize, ROOMS, PROJECTORS, PROJECTORROOMS,
+                             numroomsprojector, NONPREFERREDTIMES, CAPACITIES, cancelled=cancelled, settings=settings)
+    return write_solver_result(result, job)
+
 
+def write_solver_result(result, job=None):
+    '''
+    Publish the classes from a solver result as a new version of the timetable the solver ran against.
 
+    The classes are written into a staging timetable which only becomes the current timetable once they are all
+    there, so the timetable pages never show a half written timetable.
 
-def preparetimetable(addtonewtimetable=False):
+    :param result: A result dictionary from solve_timetable.
+    :param job: The SolverJob the result belongs to, if any. Nothing is written if it has been cancelled.
+    :return: The solver status.
     '''
-    Get timetable data and then execute the timetabling program.
+    if job is not None:
+        job.update(stats=json.dumps(result['stats']), objective=result.get('objective'), gap=result.get('gap'))
+        if job.is_cancelled():
+            return "Cancelled"
+    if result['status'] in SOLVED_STATUSES:
+        print("Adding to Database")
+        base = attendance.models.Timetable.query.get(job.timetable if job is not None else
+                                                     attendance.models.get_current_timetable_id())
+        timetable = attendance.models.create_timetable_version(timetable_version_key(base.key), result['classes'],
+                                                               base=base.id)
+        result['stats']['writeback'] = timetable.writeback
+        if job is not None:
+            job.update(stats=json.dumps(result['stats']), published=timetable.id)
+    return result['status']
+
+
+def timetable_version_key(key):
+    '''
+    Name a new version of a timetable after the timetable and the time it was made.
 
-    :param addtonewtimetable: Whether this should be added to a new timetable and set as default.
-    :return: The view timetable page.
+    :param key: The name of the timetable the version is made from.
+    :return: The name for the new version.
+    '''
+    key = re.sub(r' \(\d{4}-\d\d-\d\d \d\d:\d\d\)$', '', key or "")
+    return "{} ({})".format(key[:31], time.strftime("%Y-%m-%d %H:%M"))
 
-    TESTED
+
+def find_unchanged(previous, data):
     '''
-    print("Preparing Timetable")
+    Compare the timetable data with the data of a previous run to find the subjects and students that have not
+    changed and can keep their classes.
+
+    A subject has changed if it is new, its repeats, students, tutor or projector requirement changed, or its tutor's
+    availability or subjects changed. A student has changed if their subjects changed or they take a changed subject.
+    If the times, class sizes or rooms changed everything has changed.
+
+    :param previous: The problem instance from serialize_timetable_data for the previous run.
+    :param data: The current timetable data tuple.
+    :return: Dictionary of the unchanged 'subjects' and 'students' and the changed 'changedsubjects',
+             'changedtutors' and 'changedstudents'.
+    '''
+    current = serialize_timetable_data(data)
+    previous = dict(previous)
+    for name in ('TIMES', 'NONPREFERREDTIMES', 'ROOMS', 'PROJECTORROOMS'):
+        previous[name] = sorted(previous[name])
+        current[name] = sorted(current[name])
+    globalfields = ('TIMES', 'DAYS', 'maxclasssize', 'minclasssize', 'ROOMS', 'PROJECTORROOMS', 'numroomsprojector',
+                    'NONPREFERREDTIMES')
+    if any(previous[name] != current[name] for name in globalfields):
+        changedtutors = set(current['TEACHERS'])
+        changedsubjects = set(current['SUBJECTS'])
+    else:
+        changedtutors = set(m for m in current['TEACHERS']
+                            if previous['TUTORAVAILABILITY'].get(m) != current['TUTORAVAILABILITY'].get(m) or
+                            previous['TEACHERMAPPING'].get(m) != current['TEACHERMAPPING'].get(m))
+        tutorof = {j: m for m, subjects in current['TEACHERMAPPING'].items() for j in subjects}
+        previoustutorof = {j: m for m, subjects in previous['TEACHERMAPPING'].items() for j in subjects}
+        changedsubjects = set(j for j in current['SUBJECTS']
+                              if previous['REPEATS'].get(j) != current['REPEATS'][j] or
+                              previous['SUBJECTMAPPING'].get(j) != current['SUBJECTMAPPING'][j] or
+                              previoustutorof.get(j) != tutorof.get(j) or tutorof.get(j) in changedtutors or
+                              (j in previous['PROJECTORS']) != (j in current['PROJECTORS']))
+
+    enrolments = {}
+    previousenrolments = {}
+    for mapping, result in ((current['SUBJECTMAPPING'], enrolments), (previous['SUBJECTMAPPING'], previousenrolments)):
+        for j, students in mapping.items():
+            for i in students:
+                result.setdefault(i, set()).add(j)
+    changedstudents = set(i for i in current['STUDENTS'] if enrolments.get(i) != previousenrolments.get(i) or
+                          enrolments.get(i, set()) & changedsubjects)
+    unchanged = {'subjects': [j for j in current['SUBJECTS'] if j not in changedsubjects],
+                 'students': [i for i in current['STUDENTS'] if i not in changedstudents],
+                 'changedsubjects': sorted(changedsubjects), 'changedtutors': sorted(changedtutors),
+                 'changedstudents': sorted(changedstudents)}
+    message = "Changes since the last run: {} subjects, {} tutors and {} students".format(
+        len(changedsubjects), len(changedtutors), len(changedstudents))
+    print(message)
+    app.logger.info(message)
+    return unchanged
+
+
+def count_moved_students(previous, classes):
+    '''
+    Count the students whose classes are different from a previous timetable.
+    :param previous: List of class dictionaries of the previous timetable.
+    :param classes: List of class dictionaries of the new timetable.
+    :return: The number of students whose subjects, times or tutors changed.
+    '''
+    placements = [{}, {}]
+    for timetable, result in zip((previous, classes), placements):
+        for timeclass in timetable:
+            for i in timeclass['students']:
+                result.setdefault(i, set()).add((timeclass['subject'], timeclass['time'], timeclass['tutor']))
+    return len([i for i in set(placements[0]) | set(placements[1]) if placements[0].get(i) != placements[1].get(i)])
+
+
+SOLVER_CACHE_VERSION = 2
+# Config values that change the model or how it is solved, and so are part of every cache key
+SOLVER_CACHE_CONFIG = ("solver_tight_formulation", "solver_cohorts", "solver_decompose", "max_class_size",
+                       "min_class_size", "solver_local_search_time_limit", "solver_lns_time_limit")
+
+
+def solver_cache_key(data, stage, settings=None):
+    '''
+    Hash the timetable data and everything else that changes the solver's answer into a cache key.
+
+    The data is put into a canonical form first, so the key does not depend on the order the database returned
+    students, subjects or times in.
+
+    :param data: The timetable data tuple.
+    :param stage: The name of what is being cached, e.g. "timetable" for the first stage or "all" for both stages.
+    :param settings: The CBC settings used for the solve.
+    :return: The key as a hex string.
+    '''
+    instance = serialize_timetable_data(data)
+    for name, value in instance.items():
+        if isinstance(value, list):
+            instance[name] = sorted(value)
+    options = {'version': SOLVER_CACHE_VERSION, 'stage': stage, 'settings': settings, 'weights': objective_weights(),
+               'config': {name: appcfg.get(name) for name in SOLVER_CACHE_CONFIG}}
+    canonical = json.dumps({'data': instance, 'options': options}, sort_keys=True)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
 
-    (STUDENTS, SUBJECTS, TIMES, day, DAYS, TEACHERS, SUBJECTMAPPING, REPEATS, TEACHERMAPPING,
-     TUTORAVAILABILITY, maxclasssize, minclasssize, ROOMS,PROJECTORS, PROJECTORROOMS, numroomsprojector, NONPREFERREDTIMES, CAPACITIES) = attendance.models.get_timetable_data(rooms=True)
+
+def solver_cache_path(key, filename=None):
+    '''
+    Get the directory for a cache entry, creating it if needed.
+    :param key: The cache key from solver_cache_key.
+    :param filename: Optional name of a file in the entry.
+    :return: The path to the entry directory or to the file in it.
+    '''
+    directory = appcfg.get("solver_cache_dir") or os.path.join(appcfg["upload"], "solvercache")
+    path = os.path.join(directory, key)
+    os.makedirs(path, exist_ok=True)
+    if filename is not None:
+        return os.path.join(path, filename)
+    return path
+
+
+def read_solver_cache(key, name):
+    '''
+    Read a cached solver result.
+    :param key: The cache key from solver_cache_key.
+    :param name: The name of the cached result.
+    :return: The result dictionary, or None if it is not cached.
+    '''
+    path = solver_cache_path(key, name + '.json')
+    try:
+        with open(path) as f:
+            result = json.load(f)
+    except (OSError, ValueError):
+        return None
+    # Eviction is by last use, so mark the entry as used.
+    os.utime(os.path.dirname(path))
+    message = "Using cached {} for {}".format(name, key)
+    print(message)
+    app.logger.info(message)
+    return result
+
+
+def write_solver_cache(key, name, result):
+    '''
+    Cache a solver result. Only optimal results are cached: a timetable that was only feasible when the time limit
+    ran out could be improved on by solving again with a longer limit.
+    :param key: The cache key from solver_cache_key.
+    :param name: The name of the cached result.
+    :param result: A JSON serialisable result dictionary with a status.
+    :return: Nil.
+    '''
+    if result['status'] != "Optimal":
+        return
+    path = solver_cache_path(key, name + '.json')
+    with open(path + '.tmp', 'w') as f:
+        json.dump(result, f)
+    os.replace(path + '.tmp', path)
+
+
+def evict_solver_cache():
+    '''
+    Remove cache entries that have not been used for longer than "solver_cache_max_age" days, then remove the least
+    recently used entries until the cache is smaller than "solver_cache_max_size" megabytes.
+    :return: The number of entries removed.
+    '''
+    directory = appcfg.get("solver_cache_dir") or os.path.join(appcfg["upload"], "solvercache")
+    if not os.path.isdir(directory):
+        return 0
+    entries = []
+    for key in os.listdir(directory):
+        path = os.path.join(directory, key)
+        try:
+            size = sum(os.path.getsize(os.path.join(path, filename)) for filename in os.listdir(path))
+            entries.append((os.path.getmtime(path), size, path))
+        except OSError:
+            continue
+    entries.sort()
+    maxage = appcfg.get("solver_cache_max_age", 30) * 24 * 60 * 60
+    maxsize = appcfg.get("solver_cache_max_size", 500) * 1024 * 1024
+    totalsize = sum(size for (modified, size, path) in entries)
+    removed = 0
+    for (modified, size, path) in entries:
+        if time.time() - modified <= maxage and totalsize <= maxsize:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        totalsize -= size
+        removed += 1
+    if removed:
+        message = "Removed {} solver cache entries".format(removed)
+        print(message)
+        app.logger.info(message)
+    return removed
+
+
+def serialize_timetable_data(data):
+    '''
+    Turn the timetable data tuple into a dictionary of plain lists and dictionaries so that it can be sent to a worker
+    process.
+
+    :param data: The timetable data tuple from get_timetable_data(rooms=True).
+    :return: A dictionary representing the problem instance.
+    '''
+    instance = {}
+    for name, value in zip(TIMETABLE_DATA_FIELDS, data):
+        if isinstance(value, dict):
+            value = {key: sorted(item) if isinstance(item, set) else item for key, item in value.items()}
+        elif isinstance(value, set):
+            value = sorted(value)
+        instance[name] = value
+    return instance
+
+
+def deserialize_timetable_data(instance):
+    '''
+    Rebuild the timetable data tuple from a problem instance made by serialize_timetable_data.
+
+    :param instance: A dictionary representing the problem instance.
+    :return: The timetable data tuple.
+    '''
+    data = []
+    for name in TIMETABLE_DATA_FIELDS:
+        value = instance[name]
+        if name in TIMETABLE_DATA_SET_FIELDS:
+            value = {key: set(item) for key, item in value.items()}
+        data.append(value)
+    return tuple(data)
+
+
+TIMETABLE_DATA_FIELDS = ('STUDENTS', 'SUBJECTS', 'TIMES', 'day', 'DAYS', 'TEACHERS', 'SUBJECTMAPPING', 'REPEATS',
+                         'TEACHERMAPPING', 'TUTORAVAILABILITY', 'maxclasssize', 'minclasssize', 'ROOMS', 'PROJECTORS',
+                         'PROJECTORROOMS', 'numroomsprojector', 'NONPREFERREDTIMES', 'CAPACITIES')
+TIMETABLE_DATA_SET_FIELDS = ('DAYS', 'SUBJECTMAPPING', 'TEACHERMAPPING', 'TUTORAVAILABILITY')
+
+
+def solver_worker(instance, settings, warmstart, fixed, memorylimit, conn, configuration=None):
+    '''
+    Entry point for the solver worker process. Builds and solves the model and sends the result back down the pipe.
+
+    :param instance: A problem instance from serialize_timetable_data.
+    :param settings: CBC settings for each stage, or None.
+    :param warmstart: Optional list of classes from a previous timetable to start from.
+    :param fixed: Optional dictionary of the subjects and students to keep as they are in warmstart.
+    :param memorylimit: Maximum address space in megabytes for the worker and the CBC process, or None.
+    :param conn: The child end of a multiprocessing Pipe.
+    :param configuration: Optional portfolio configuration from the solver_portfolio_configurations config value. Its
+                          "options" are passed to CBC for the timetable stage and its other values, apart from the
+                          name, replace the config values of the same name in this process.
+    :return: Nil.
+    '''
+    # Put the worker in its own process group so the parent can kill CBC along with it.
+    os.setpgrp()
+    if configuration:
+        appcfg.update({key: value for key, value in configuration.items() if key not in ('name', 'options')})
+        if configuration.get('options'):
+            settings = dict(settings or {})
+            settings['timetable'] = dict(settings.get('timetable') or {}, options=configuration['options'])
+    if memorylimit:
+        limit = int(memorylimit) * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    try:
+        result = solve_timetable(*deserialize_timetable_data(instance), settings=settings, warmstart=warmstart,
+                                 fixed=fixed)
+    except MemoryError:
+        result = {'status': "Failed", 'error': "The solver ran out of memory", 'stats': {}, 'classes': []}
+    except Exception as e:
+        result = {'status': "Failed", 'error': str(e), 'stats': {}, 'classes': []}
+    conn.send(result)
+    conn.close()
+
+
+def solve_in_worker_process(instance, settings=None, warmstart=None, fixed=None, memorylimit=None, timeout=None,
+                            cancelled=None):
+    '''
+    Solve a problem instance in a separate process so that model construction does not hold the web server's GIL
+    and the model's memory is returned to the operating system when it finishes.
+
+    :param instance: A problem instance from serialize_timetable_data.
+    :param settings: CBC settings for each stage, or None.
+    :param warmstart: Optional list of classes from a previous timetable to start from.
+    :param fixed: Optional dictionary of the subjects and students to keep as they are in warmstart.
+    :param memorylimit: Maximum address space in megabytes for the worker, or None for no limit.
+    :param timeout: Wall clock limit in seconds, or None for no limit.
+    :param cancelled: Optional function returning True if the run has been cancelled. It is polled every second.
+    :return: A result dictionary as returned by solve_timetable.
+    '''
+    process, parentconn = start_solver_process(instance, settings, warmstart, fixed, memorylimit)
+    started = time.time()
+    result = None
+    try:
+        while result is None:
+            if parentconn.poll(1):
+                result = parentconn.recv()
+            elif not process.is_alive():
+                result = solver_process_failure(process)
+            elif cancelled is not None and cancelled():
+                result = {'status': "Cancelled", 'stats': {}, 'classes': []}
+            elif timeout and time.time() - started > timeout:
+                result = {'status': "Timed Out", 'stats': {}, 'classes': [],
+                          'error': "The solver did not finish within {} seconds".format(timeout)}
+    except EOFError:
+        process.join(1)
+        result = solver_process_failure(process)
+    finally:
+        stop_solver_process(process, parentconn)
+    return result
+
+
+def start_solver_process(instance, settings, warmstart, fixed, memorylimit, configuration=None):
+    '''
+    Start a solver_worker process.
+
+    :return: A tuple of the process and the parent end of its pipe.
+    '''
+    context = multiprocessing.get_context('fork')
+    parentconn, childconn = context.Pipe(duplex=False)
+    process = context.Process(target=solver_worker,
+                              args=(instance, settings, warmstart, fixed, memorylimit, childconn, configuration))
+    process.start()
+    childconn.close()
+    return process, parentconn
+
+
+def stop_solver_process(process, parentconn, wait=1):
+    '''
+    Wait briefly for a solver worker to exit, then kill it along with its CBC process, and close its pipe.
+
+    :param wait: Seconds to wait for the worker to exit by itself.
+    '''
+    if process.is_alive():
+        process.join(wait)
+    if process.is_alive():
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        process.join()
+    parentconn.close()
+
+
+def solver_process_failure(process):
+    '''
+    Make the result for a solver worker that exited without sending one.
+    '''
+    return {'status': "Failed", 'stats': {}, 'classes': [],
+            'error': "The solver process exited unexpectedly with code {}".format(process.exitcode)}
+
+
+def solve_portfolio(instance, configurations, settings=None, warmstart=None, fixed=None, memorylimit=None,
+                    timeout=None, cancelled=None):
+    '''
+    Race several solver configurations against each other, each in its own worker process, and take the first
+    optimal timetable. The other workers are killed as soon as one is found. If none is optimal the best feasible
+    timetable is used, or the first result if there is none.
+
+    Each worker gets an equal share of the CPUs as its solver_processes, so workers that decompose the timetable do
+    not start a full pool each.
+
+    :param instance: A problem instance from serialize_timetable_data.
+    :param configurations: List of configurations as described for solver_worker, each with a name.
+    :param memorylimit: Maximum address space in megabytes for each worker, or None for no limit.
+    :param timeout: Wall clock limit in seconds for the whole race, or None for no limit.
+    :param cancelled: Optional function returning True if the run has been cancelled. It is polled every second.
+    :return: A result dictionary as returned by solve_timetable, with the status, objective and time of each
+             configuration in stats['portfolio'] and the winning configuration in stats['portfolio']['winner'].
+    '''
+    started = time.time()
+    workers = {}
+    # A worker that decomposes the timetable starts its own pool, so the CPUs are shared out between the workers
+    share = max(1, (os.cpu_count() or 1) // len(configurations))
+    for configuration in configurations:
+        processes = min(configuration.get('solver_processes') or appcfg.get("solver_processes") or share, share)
+        process, parentconn = start_solver_process(instance, settings, warmstart, fixed, memorylimit,
+                                                   dict(configuration, solver_processes=processes))
+        workers[parentconn] = (configuration['name'], process)
+    timings = {}
+    results = {}
+    winner = None
+    try:
+        while winner is None and len(results) < len(configurations):
+            for parentconn in multiprocessing.connection.wait(
+                    [conn for conn, (name, process) in workers.items() if name not in results], timeout=1):
+                (name, process) = workers[parentconn]
+                try:
+                    results[name] = parentconn.recv()
+                except EOFError:
+                    process.join(1)
+                    results[name] = solver_process_failure(process)
+                timings[name] = {'status': results[name]['status'], 'objective': results[name].get('objective'),
+                                 'time': time.time() - started}
+                message = "Portfolio {}: {} objective {} in {:.1f}s".format(name, timings[name]['status'],
+                                                                          timings[name]['objective'],
+                                                                          timings[name]['time'])
+                print(message)
+                app.logger.info(message)
+                if results[name]['status'] == "Optimal" and winner is None:
+                    winner = name
+            if winner is None and cancelled is not None and cancelled():
+                return {'status': "Cancelled", 'stats': {'portfolio': timings}, 'classes': []}
+            if winner is None and timeout and time.time() - started > timeout:
+                return {'status': "Timed Out", 'stats': {'portfolio': timings}, 'classes': [],
+                        'error': "The solver did not finish within {} seconds".format(timeout)}
+    finally:
+        for parentconn, (name, process) in workers.items():
+            if name not in timings:
+                timings[name] = {'status': "Stopped", 'objective': None, 'time': time.time() - started}
+            stop_solver_process(process, parentconn, wait=0 if name not in results else 1)
+    if winner is None:
+        feasible = [name for name in results if results[name]['status'] in SOLVED_STATUSES]
+        if feasible:
+            winner = min(feasible, key=lambda name: results[name]['objective'])
+        else:
+            winner = configurations[0]['name']
+    result = results[winner]
+    result['stats']['portfolio'] = dict(timings, winner=winner)
+    message = "Portfolio winner: {} in {:.1f}s".format(winner, timings[winner]['time'])
+    print(message)
+    app.logger.info(message)
+    return result
+
+
+def execute_solver(data, settings=None, cancelled=None, warmstart=None, fixed=None):
+    '''
+    Solve the timetable data using the configured execution mode.
+
+    The "process" mode solves in a worker process with the configured memory limit and timeout, or races the
+    solver_portfolio_configurations in several worker processes if solver_portfolio is set. The "thread" mode solves
+    on the calling thread.
+
+    :param data: The timetable data tuple from get_timetable_data(rooms=True).
+    :param settings: CBC settings for each stage as returned by get_solver_settings(), or None.
+    :param cancelled: Optional function returning True if the run has been cancelled.
+    :param warmstart: Optional list of classes from a previous timetable to start from.
+    :param fixed: Optional dictionary of the subjects and students to keep as they are in warmstart.
+    :return: A result dictionary as returned by solve_timetable.
+    '''
+    if appcfg.get("solver_mode", "process") == "process" and appcfg.get("solver_portfolio", False):
+        return solve_portfolio(serialize_timetable_data(data), appcfg["solver_portfolio_configurations"],
+                               settings=settings, warmstart=warmstart, fixed=fixed,
+                               memorylimit=appcfg.get("solver_memory_limit"), timeout=appcfg.get("solver_timeout"),
+                               cancelled=cancelled)
+    if appcfg.get("solver_mode", "process") == "process":
+        return solve_in_worker_process(serialize_timetable_data(data), settings=settings, warmstart=warmstart,
+                                       fixed=fixed, memorylimit=appcfg.get("solver_memory_limit"),
+                                       timeout=appcfg.get("solver_timeout"), cancelled=cancelled)
+    return solve_timetable(*data, cancelled=cancelled, settings=settings, warmstart=warmstart, fixed=fixed)
+
+
+def preparetimetable(addtonewtimetable=False, warmstart=None, incremental=False, engine=None):
+    '''
+    Get timetable data and then queue the timetabling program as a solver job.
+
+    Only one job can be queued or running for a timetable at a time. If solver_feasibility_check is set the data is
+    checked with check_timetable_feasibility first and the job fails straight away if it cannot be solved.
+
+    :param addtonewtimetable: Whether this should be added to a new timetable and set as default.
+    :param warmstart: Optional id of a previous timetable whose classes the solver should start from.
+    :param incremental: Keep the classes and students from the warmstart timetable that have not changed since its
+                        last run and only re-solve the rest.
+    :param engine: Optional timetable engine to use for this run instead of the one in the solver settings.
+    :return: A tuple of the SolverJob and whether it was newly created. If a job was already active for the current
+             timetable that job is returned instead.
+    '''
+    print("Preparing Timetable")
+    attendance.models.collect_staging_timetables()
+    timetable = attendance.models.get_current_timetable_id()
+    activejob = attendance.models.SolverJob.get_active(timetable)
+    if activejob is not None:
+        print("A solver job is already active for this timetable")
+        return activejob, False
+    try:
+        job = attendance.models.SolverJob.create(timetable=timetable)
+    except IntegrityError:
+        # Another request queued a job for this timetable between the check above and the insert
+        db.session.rollback()
+        print("A solver job is already active for this timetable")
+        return attendance.models.SolverJob.get_active(timetable), False
+
+    try:
+        data = attendance.models.get_timetable_data(rooms=True)
+        job.update(snapshot=json.dumps(serialize_timetable_data(data)))
+        if appcfg.get("solver_feasibility_check", True):
+            report = check_timetable_feasibility(*data)
+            if not report['feasible']:
+                job.update(stats=json.dumps({'feasibility': report}))
+                job.finish(attendance.models.SolverJob.FAILED, solverstatus="Infeasible",
+                           message=" ".join(error['message'] + "." for error in report['errors']))
+                return job, True
+        settings = attendance.models.get_solver_settings()
+        if engine is not None:
+            settings['timetable']['engine'] = engine
+        fixed = None
+        if warmstart is not None:
+            previous = attendance.models.SolverJob.get_last_run(warmstart)
+            warmstart = attendance.models.get_timetable_solution(warmstart)
+            if incremental and previous is not None:
+                fixed = find_unchanged(json.loads(previous.snapshot), data)
+            elif incremental:
+                message = "No previous run for that timetable, solving everything"
+                print(message)
+                app.logger.info(message)
+    except Exception as e:
+        # Never leave the job queued, or it would block every later run for this timetable
+        app.logger.exception(e)
+        db.session.rollback()
+        job.finish(attendance.models.SolverJob.FAILED, message="Could not prepare the solver: " + str(e))
+        return job, True
 
     print("Everything ready")
-    executor.submit(runtimetable_with_rooms_two_step, STUDENTS, SUBJECTS, TIMES, day, DAYS, TEACHERS, SUBJECTMAPPING,
-                    REPEATS, TEACHERMAPPING,
-                    TUTORAVAILABILITY, maxclasssize, minclasssize, ROOMS,PROJECTORS, PROJECTORROOMS, numroomsprojector, NONPREFERREDTIMES,CAPACITIES)
+    executor.submit(run_solver_job, job.id, data, settings, warmstart, fixed)
+    return job, True
+
+
+def run_solver_job(jobid, data, settings=None, warmstart=None, fixed=None):
+    '''
+    Run the timetabling program for a queued solver job and record how it went.
+
+    This runs on the executor thread so it needs its own application context.
 
+    :param jobid: The id of the SolverJob to run.
+    :param data: The timetable data tuple from get_timetable_data(rooms=True).
+    :param settings: CBC settings for each stage as returned by get_solver_settings(), or None.
+    :param warmstart: Optional list of classes from a previous timetable to start from.
+    :param fixed: Optional dictionary of the subjects and students to keep as they are in warmstart.
+    :return: The solver status.
+    '''
+    with app.app_context():
+        job = attendance.models.SolverJob.query.get(jobid)
+        if job is None or job.is_cancelled():
+            return "Cancelled"
+        job.start()
+        try:
+            result = execute_solver(data, settings=settings, cancelled=job.is_cancelled, warmstart=warmstart,
+                                    fixed=fixed)
+            status = write_solver_result(result, job)
+        except Exception as e:
+            app.logger.exception(e)
+            db.session.rollback()
+            job.finish(attendance.models.SolverJob.FAILED, message=str(e))
+            return "Failed"
+        if job.is_cancelled():
+            return status
+        if status in SOLVED_STATUSES:
+            job.finish(attendance.models.SolverJob.SUCCEEDED, solverstatus=status)
+        elif 'error' in result:
+            job.finish(attendance.models.SolverJob.FAILED, solverstatus=status, message=result['error'])
+        else:
+            job.finish(attendance.models.SolverJob.FAILED, solverstatus=status,
+                       message="The solver could not find a timetable. Check that tutors have enough availabilities.")
+        return status
 
-    form = AddTimetableForm()
-    return render_template("viewtimetable.html", form=form)
+
+def timetable_metrics(classes, data, weights=None):
+    '''
+    Measure a solved timetable so that scenarios with different weights can be compared on the same terms.
+
+    :param classes: List of class dictionaries as returned by solve_timetable.
+    :param data: The timetable data tuple the classes were solved from.
+    :param weights: The objective weights the timetable was solved with.
+    :return: Dictionary of the number of classes, student clashes, classes at non-preferred times, tutor days,
+             projector classes without a projector room, students over room capacity, rooms used by tutors, the
+             largest and smallest class and the timetable objective.
+    '''
+    (STUDENTS, SUBJECTS, TIMES, day, DAYS, TEACHERS, SUBJECTMAPPING, REPEATS, TEACHERMAPPING, TUTORAVAILABILITY,
+     maxclasssize, minclasssize, ROOMS, PROJECTORS, PROJECTORROOMS, numroomsprojector, NONPREFERREDTIMES,
+     CAPACITIES) = data
+    classstudents = {(c['subject'], c['time'], c['tutor']): c['students'] for c in classes}
+    sizes = [len(c['students']) for c in classes]
+    return {
+        'classes': len(classes),
+        'clashes': count_clashes(classstudents),
+        'nonpreferred': sum(1 for c in classes if c['time'] in NONPREFERREDTIMES),
+        'tutordays': len(set((c['tutor'], d) for c in classes for d in day if c['time'] in DAYS[d])),
+        'projectorclashes': sum(1 for c in classes if c['subject'] in PROJECTORS and c['room'] not in PROJECTORROOMS),
+        'overcapacity': sum(max(0, len(c['students']) - CAPACITIES.get(c['room'], 0)) for c in classes),
+        'tutorrooms': len(set((c['tutor'], c['room']) for c in classes)),
+        'largestclass': max(sizes) if sizes else 0,
+        'smallestclass': min(sizes) if sizes else 0,
+        'objective': timetable_objective(classstudents, TIMES, day, DAYS, PROJECTORS, numroomsprojector,
+                                         NONPREFERREDTIMES, weights),
+    }
+
+
+def solve_scenario(instance, scenario, settings=None):
+    '''
+    Solve one what-if scenario in a worker process. Nothing is written to the database.
+
+    :param instance: A problem instance from serialize_timetable_data.
+    :param scenario: A scenario dictionary from parse_scenarios.
+    :param settings: CBC settings for each stage as returned by get_solver_settings(), or None.
+    :return: A result dictionary as returned by solve_timetable with the timetable_metrics added.
+    '''
+    data = list(deserialize_timetable_data(instance))
+    data[10] = scenario['maxclasssize']
+    data[11] = scenario['minclasssize']
+    settings = {stage: dict(stagesettings or {}, weights=scenario['weights'])
+                for stage, stagesettings in (settings or {}).items()}
+    for stage in ('timetable', 'rooms'):
+        settings.setdefault(stage, {'weights': scenario['weights']})
+    result = solve_timetable(*data, settings=settings)
+    if result['status'] in SOLVED_STATUSES:
+        result['metrics'] = timetable_metrics(result['classes'], data, scenario['weights'])
+    return result
+
+
+def run_scenarios(data, scenarios, settings=None, processes=None):
+    '''
+    Solve what-if scenarios concurrently in a pool of worker processes.
+
+    :param data: The timetable data tuple from get_timetable_data(rooms=True).
+    :param scenarios: List of scenario dictionaries from parse_scenarios.
+    :param settings: CBC settings for each stage as returned by get_solver_settings(), or None.
+    :param processes: Number of worker processes, or None for one per CPU.
+    :return: List of the result dictionaries from solve_scenario, or of {'status': "Error", 'error': message} for
+             scenarios whose worker failed, in the same order as the scenarios.
+    '''
+    instance = serialize_timetable_data(data)
+    workers = min(len(scenarios), processes or os.cpu_count() or 1)
+    print("Solving {} scenarios in {} processes".format(len(scenarios), workers))
+    results = []
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork')) as pool:
+        futures = [pool.submit(solve_scenario, instance, scenario, settings) for scenario in scenarios]
+        for scenario, future in zip(scenarios, futures):
+            try:
+                results.append(future.result())
+            except Exception as e:
+                app.logger.exception(e)
+                results.append({'status': "Error", 'error': str(e), 'stats': {}, 'classes': []})
+            message = "Scenario {}: {}".format(scenario['name'], results[-1]['status'])
+            print(message)
+            app.logger.info(message)
+    return results
+
+
+def preparescenarios(scenarios):
+    '''
+    Get timetable data and then queue a batch of what-if scenarios against the current timetable.
+
+    :param scenarios: List of scenario dictionaries from parse_scenarios.
+    :return: The batch id.
+    '''
+    timetable = attendance.models.get_current_timetable_id()
+    batch = attendance.models.Scenario.next_batch()
+    ids = [attendance.models.Scenario.create(batch=batch, name=scenario['name'], timetable=timetable,
+                                             parameters=scenario).id for scenario in scenarios]
+    data = attendance.models.get_timetable_data(rooms=True)
+    settings = attendance.models.get_solver_settings()
+    executor.submit(run_scenario_batch, ids, data, scenarios, settings)
+    return batch
+
+
+def run_scenario_batch(ids, data, scenarios, settings=None):
+    '''
+    Solve a queued batch of scenarios and record each result.
+
+    This runs on the executor thread so it needs its own application context.
+
+    :param ids: The ids of the Scenario rows, in the same order as the scenarios.
+    :param data: The timetable data tuple from get_timetable_data(rooms=True).
+    :param scenarios: List of scenario dictionaries from parse_scenarios.
+    :param settings: CBC settings for each stage as returned by get_solver_settings(), or None.
+    :return: Nil.
+    '''
+    with app.app_context():
+        rows = [attendance.models.Scenario.query.get(id) for id in ids]
+        for row in rows:
+            row.update(status=attendance.models.Scenario.RUNNING)
+        try:
+            results = run_scenarios(data, scenarios, settings=settings, processes=appcfg.get("solver_processes"))
+        except Exception as e:
+            app.logger.exception(e)
+            db.session.rollback()
+            for row in rows:
+                row.finish(attendance.models.Scenario.FAILED, message=str(e))
+            return
+        for row, result in zip(rows, results):
+            if result['status'] in SOLVED_STATUSES:
+                row.finish(attendance.models.Scenario.SUCCEEDED, result)
+            else:
+                row.finish(attendance.models.Scenario.FAILED, result, message=result.get('error'))
 
 
 
@@ -313,6 +2818,102 @@ def upload(file):
         return path_to_file
 
 
+IMPORTERS = {'students': 'populate_students', 'tutors': 'populate_tutors', 'availabilities': 'populate_availabilities',
+             'classlists': 'populate_timetabledata'}
+
+
+def hash_file(path):
+    '''
+    Get the sha256 hash of a file's contents.
+
+    :param path: Path to the file.
+    :return: The hash as a hex string.
+    '''
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def read_upload(path, chunksize=None):
+    '''
+    Read an uploaded CSV or Excel file.
+
+    :param path: Path to the file.
+    :param chunksize: If given, read a CSV file lazily this many rows at a time. Excel files are always read whole.
+    :return: pandas dataframe, or an iterator of dataframes for a CSV file read in chunks
+    '''
+    if os.path.splitext(path)[1] == ".csv":
+        return read_csv(path, chunksize=chunksize)
+    return read_excel(path)
+
+
+def prepareimport(kind, path, filename=None, force=False):
+    '''
+    Queue an uploaded file to be imported in the background as an import job.
+
+    If the same file has already been imported, or is being imported, for the current study period the existing job is
+    returned instead and the new copy of the file is removed.
+
+    :param kind: One of ImportJob.KINDS.
+    :param path: Path of the uploaded file in the upload folder.
+    :param filename: The name the file was uploaded with.
+    :param force: Import the file even if it has been imported before.
+    :return: A tuple of the ImportJob and whether it was newly created.
+    '''
+    filehash = hash_file(path)
+    if not force:
+        duplicate = attendance.models.ImportJob.get_duplicate(kind, filehash)
+        if duplicate is not None:
+            message = "{} was already uploaded as import job {}".format(filename or path, duplicate.id)
+            print(message)
+            app.logger.info(message)
+            os.remove(path)
+            return duplicate, False
+    job = attendance.models.ImportJob.create(kind=kind, filename=filename or os.path.basename(path),
+                                             filehash=filehash)
+    import_executor.submit(run_import_job, job.id, path)
+    return job, True
+
+
+def run_import_job(jobid, path):
+    '''
+    Import an uploaded file for a queued import job and record how it went.
+
+    This runs on the import executor thread so it needs its own application context.
+
+    :param jobid: The id of the ImportJob to run.
+    :param path: Path of the uploaded file.
+    :return: The final job status.
+    '''
+    with app.app_context():
+        job = attendance.models.ImportJob.query.get(jobid)
+        if job is None:
+            return None
+        try:
+            importer = getattr(attendance.models, IMPORTERS[job.kind])
+            if job.kind == 'students':
+                chunksize = appcfg["enrolment_import_chunk_size"]
+                df = read_upload(path, chunksize=chunksize)
+                job.start(rows=len(df) if isinstance(df, pandas.DataFrame) else None)
+                report = importer(df, chunksize=chunksize, progress=job.progress)
+            else:
+                df = read_upload(path)
+                job.start(rows=len(df))
+                importer(df)
+                report = {'rows': len(df), 'errors': []}
+            job.progress(report)
+        except Exception as e:
+            app.logger.exception(e)
+            db.session.rollback()
+            job.finish(attendance.models.ImportJob.FAILED, message=str(e))
+            return job.status
+        job.finish(attendance.models.ImportJob.SUCCEEDED,
+                   message="{} rows could not be imported".format(len(report['errors'])) if report['errors'] else None)
+        return job.status
+
+
 def checkboxvalue(checkbox):
     '''
     Get value of checkbox.
@@ -339,14 +2940,15 @@ def read_excel(filename):
     df = xl.parse(xl.sheet_names[0])
     return df
 
-def read_csv(filename):
+def read_csv(filename, chunksize=None):
     '''
     Read CSV File provided by filename.
 
     :param filename - path to an CSV file:
-    :return: pandas dataframe
+    :param chunksize: If given, read the file lazily this many rows at a time.
+    :return: pandas dataframe, or an iterator of dataframes if chunksize is given
     '''
-    return pandas.read_csv(filename)
+    return pandas.read_csv(filename, chunksize=chunksize)
 
 
 def create_roll(students, subject, timeslot, room):
@@ -422,9 +3024,12 @@ def format_timetable_data_for_export():
 
 def format_student_timetable_data_for_export():
     students = attendance.models.Student.get_all()
+    current = attendance.models.get_current_timetable_id()
     timetable = []
     for student in students:
         for timeclass in student.timetabledclasses:
+            if timeclass.timetable != current:
+                continue
             if timeclass.room is not None:
                 room = timeclass.room.name
             else:
@@ -0,0 +1,193 @@
+import numpy
+
+
+def build_csr(groups, size):
+    '''
+    Pack lists of integer ids into compressed sparse row arrays.
+
+    :param groups: List of lists of ids, one list per row.
+    :param size: The number of possible ids, used to pick the smallest integer type.
+    :return: A tuple of the row pointer array, where row r is members[pointer[r]:pointer[r + 1]], and the members
+             array with each row sorted.
+    '''
+    pointer = numpy.zeros(len(groups) + 1, dtype=numpy.int64)
+    pointer[1:] = numpy.cumsum([len(group) for group in groups])
+    dtype = numpy.int32 if size < 2 ** 31 else numpy.int64
+    members = numpy.fromiter((i for group in groups for i in sorted(group)), dtype=dtype, count=int(pointer[-1]))
+    return pointer, members
+
+
+class ProblemInstance(object):
+    '''
+    A timetabling problem with every student, subject, time, tutor and room numbered from zero.
+
+    Memberships are held in arrays rather than dictionaries of names: the students of each subject and the subjects
+    of each tutor in compressed sparse row form, and the times each tutor is available as a tutor x time boolean
+    matrix. Labels map the numbers back to the names used in the timetable data tuple, and the database ids are kept
+    alongside when the instance was loaded from the database, so students or tutors who share a name stay apart.
+    '''
+
+    def __init__(self, students, subjects, times, days, timeday, tutors, rooms, subjectstudents, tutorsubjects,
+                 availability, repeats, projectors, nonpreferred, projectorrooms, capacities, maxclasssize,
+                 minclasssize, studentids=None, tutorids=None):
+        '''
+        :param students: List of student labels.
+        :param subjects: List of subject codes.
+        :param times: List of time labels, e.g. "Monday 19:30".
+        :param days: List of day names.
+        :param timeday: The day number of each time.
+        :param tutors: List of tutor labels.
+        :param rooms: List of room names.
+        :param subjectstudents: The student numbers of each subject.
+        :param tutorsubjects: The subject numbers of each tutor.
+        :param availability: Boolean tutor x time matrix of when each tutor is available.
+        :param repeats: The number of classes of each subject.
+        :param projectors: Whether each subject needs a projector.
+        :param nonpreferred: Whether each time is a non-preferred time.
+        :param projectorrooms: Whether each room has a projector.
+        :param capacities: The capacity of each room.
+        :param studentids: Optional database id of each student.
+        :param tutorids: Optional database id of each tutor.
+        '''
+        self.students = list(students)
+        self.subjects = list(subjects)
+        self.times = list(times)
+        self.days = list(days)
+        self.tutors = list(tutors)
+        self.rooms = list(rooms)
+        self.timeday = numpy.asarray(timeday, dtype=numpy.int32)
+        self.subject_pointer, self.subject_students = build_csr(subjectstudents, len(self.students))
+        self.tutor_pointer, self.tutor_subjects = build_csr(tutorsubjects, len(self.subjects))
+        self.availability = numpy.asarray(availability, dtype=bool).reshape(len(self.tutors), len(self.times))
+        self.repeats = numpy.asarray(repeats, dtype=numpy.int32)
+        self.projectors = numpy.asarray(projectors, dtype=bool)
+        self.nonpreferred = numpy.asarray(nonpreferred, dtype=bool)
+        self.projectorrooms = numpy.asarray(projectorrooms, dtype=bool)
+        self.capacities = numpy.asarray(capacities, dtype=numpy.int32)
+        self.maxclasssize = maxclasssize
+        self.minclasssize = minclasssize
+        self.studentids = None if studentids is None else numpy.asarray(studentids, dtype=numpy.int64)
+        self.tutorids = None if tutorids is None else numpy.asarray(tutorids, dtype=numpy.int64)
+        self._indexes = {}
+
+    @classmethod
+    def from_timetable_data(cls, data):
+        '''
+        Build an instance from the timetable data tuple of get_timetable_data(rooms=True). Subjects a tutor teaches
+        that are not in SUBJECTS are left out.
+
+        :param data: The timetable data tuple.
+        :return: The ProblemInstance.
+        '''
+        (STUDENTS, SUBJECTS, TIMES, day, DAYS, TEACHERS, SUBJECTMAPPING, REPEATS, TEACHERMAPPING, TUTORAVAILABILITY,
+         maxclasssize, minclasssize, ROOMS, PROJECTORS, PROJECTORROOMS, numroomsprojector, NONPREFERREDTIMES,
+         CAPACITIES) = data
+        student = {i: n for n, i in enumerate(STUDENTS)}
+        subject = {j: n for n, j in enumerate(SUBJECTS)}
+        timeday = numpy.full(len(TIMES), -1, dtype=numpy.int32)
+        for d, name in enumerate(day):
+            for n, k in enumerate(TIMES):
+                if k in DAYS[name]:
+                    timeday[n] = d
+        availability = numpy.zeros((len(TEACHERS), len(TIMES)), dtype=bool)
+        for m, tutor in enumerate(TEACHERS):
+            available = TUTORAVAILABILITY.get(tutor, ())
+            availability[m] = [k in available for k in TIMES]
+        projectors, nonpreferred, projectorrooms = set(PROJECTORS), set(NONPREFERREDTIMES), set(PROJECTORROOMS)
+        return cls(STUDENTS, SUBJECTS, TIMES, day, timeday, TEACHERS, ROOMS,
+                   [[student[i] for i in SUBJECTMAPPING[j]] for j in SUBJECTS],
+                   [[subject[j] for j in TEACHERMAPPING.get(m, ()) if j in subject] for m in TEACHERS],
+                   availability, [REPEATS[j] for j in SUBJECTS], [j in projectors for j in SUBJECTS],
+                   [k in nonpreferred for k in TIMES], [n in projectorrooms for n in ROOMS],
+                   [CAPACITIES[n] for n in ROOMS], maxclasssize, minclasssize)
+
+    def to_timetable_data(self):
+        '''
+        Get the timetable data tuple of get_timetable_data(rooms=True) for the engines that work on labels.
+
+        :return: The timetable data tuple.
+        '''
+        DAYS = {d: set() for d in self.days}
+        for n, k in enumerate(self.times):
+            if self.timeday[n] >= 0:
+                DAYS[self.days[self.timeday[n]]].add(k)
+        SUBJECTMAPPING = {j: set(self.students[i] for i in self.students_of(s)) for s, j in enumerate(self.subjects)}
+        TEACHERMAPPING = {m: set(self.subjects[j] for j in self.subjects_of(t)) for t, m in enumerate(self.tutors)}
+        TUTORAVAILABILITY = {m: set(self.times[k] for k in numpy.flatnonzero(self.availability[t]))
+                             for t, m in enumerate(self.tutors)}
+        REPEATS = {j: int(self.repeats[s]) for s, j in enumerate(self.subjects)}
+        PROJECTORS = [j for s, j in enumerate(self.subjects) if self.projectors[s]]
+        PROJECTORROOMS = [n for r, n in enumerate(self.rooms) if self.projectorrooms[r]]
+        NONPREFERREDTIMES = [k for n, k in enumerate(self.times) if self.nonpreferred[n]]
+        CAPACITIES = {n: int(self.capacities[r]) for r, n in enumerate(self.rooms)}
+        return (list(self.students), list(self.subjects), list(self.times), list(self.days), DAYS, list(self.tutors),
+                SUBJECTMAPPING, REPEATS, TEACHERMAPPING, TUTORAVAILABILITY, self.maxclasssize, self.minclasssize,
+                list(self.rooms), PROJECTORS, PROJECTORROOMS, len(PROJECTORROOMS), NONPREFERREDTIMES, CAPACITIES)
+
+    def index(self, kind, label):
+        '''
+        Look up the number of a student, subject, time, tutor or room from its label.
+
+        :param kind: One of 'students', 'subjects', 'times', 'tutors' or 'rooms'.
+        :param label: The label.
+        :return: The number.
+        '''
+        if kind not in self._indexes:
+            self._indexes[kind] = {name: n for n, name in enumerate(getattr(self, kind))}
+        return self._indexes[kind][label]
+
+    def students_of(self, subject):
+        return self.subject_students[self.subject_pointer[subject]:self.subject_pointer[subject + 1]]
+
+    def subjects_of(self, tutor):
+        return self.tutor_subjects[self.tutor_pointer[tutor]:self.tutor_pointer[tutor + 1]]
+
+    def enrolments(self):
+        '''
+        :return: The number of students in each subject.
+        '''
+        return numpy.diff(self.subject_pointer)
+
+    def student_loads(self):
+        '''
+        :return: The number of subjects each student takes.
+        '''
+        return numpy.bincount(self.subject_students, minlength=len(self.students))
+
+    def tutor_of_subjects(self):
+        '''
+        :return: For each entry of tutor_subjects, the tutor it belongs to.
+        '''
+        return numpy.repeat(numpy.arange(len(self.tutors)), numpy.diff(self.tutor_pointer))
+
+    def tutor_loads(self):
+        '''
+        :return: The number of classes each tutor teaches, counting every repeat.
+        '''
+        return numpy.bincount(self.tutor_of_subjects(), weights=self.repeats[self.tutor_subjects],
+                              minlength=len(self.tutors)).astype(numpy.int64)
+
+    def available_times(self):
+        '''
+        :return: The number of times each tutor is available.
+        '''
+        return self.availability.sum(axis=1)
+
+    def available_tutors(self):
+        '''
+        :return: The number of tutors available at each time.
+        '''
+        return self.availability.sum(axis=0)
+
+    def database_ids(self, kind, labels):
+        '''
+        Get the database ids of students or tutors from their labels.
+
+        :param kind: 'students' or 'tutors'.
+        :param labels: The labels.
+        :return: List of database ids, or None if the instance was not loaded from the database.
+        '''
+        ids = self.studentids if kind == 'students' else self.tutorids
+        if ids is None:
+            return None
+        return [int(ids[self.index(kind, label)]) for label in labels]
@@ -1,11 +1,15 @@
 from operator import attrgetter
-from flask import render_template
-from attendance import bcrypt, db
+from flask import render_template, g, has_request_context
+from sqlalchemy import event
+from attendance import app, bcrypt, db
 from attendance.helpers import *
 from pandas import isnull
 from datetime import time
 import datetime
+import numpy
 from attendance.config import appcfg
+from attendance.instance import ProblemInstance
+import json
 
 class CRUDMixin(db.Model):
     """A simple CRUD interface for other classes to inherit. Provides the basic functionality.
@@ -252,7 +256,7 @@ class Subject(Base):
         return render_template("subject.html", subject=self, students=self.students,
                                tutor=self.tutor, tutors=Tutor.get_all(),
                                msg=msg, times=self.find_possible_times(),
-                               timeslots=Timeslot.get_all(), rooms=Room.get_all(),
+                               timeslots=get_all_timeslots(), rooms=Room.get_all(),
                                timetabledclasses=self.timetabledclasses, form=form)
 
     def find_possible_times(self):
@@ -305,16 +309,46 @@ class Student(Base):
 
 
 class Timetable(Base):
+    '''
+    A version of the timetable for a study period. The Admin 'timetable' key points at the current one.
+
+    New versions are written while they are staging, where nobody looks at them, and only become published when the
+    pointer is moved to them. Staging versions left behind by a failed write are removed by
+    collect_staging_timetables.
+    '''
     __tablename__ = 'timetable'
+    PUBLISHED = 'published'
+    STAGING = 'staging'
+
     id = db.Column(db.Integer, primary_key=True)
     studyperiod = db.Column(db.String(50), nullable=False)
     year = db.Column(db.Integer, nullable=False)
     key = db.Column(db.String(50), nullable=True)
+    status = db.Column(db.String(20), nullable=False, default=PUBLISHED)
+    created = db.Column(db.DateTime)
     timeslots = db.relationship("Timeslot", single_parent=True, cascade='all,delete-orphan')
 
-    def __init__(self, key=""):
+    def __init__(self, key="", status=PUBLISHED):
         super().__init__()
         self.key = key
+        self.status = status
+        self.created = datetime.datetime.now()
+
+    @classmethod
+    def get(cls, **kwargs):
+        '''
+        Get a published timetable of the current year and studyperiod.
+        '''
+        kwargs.setdefault('status', cls.PUBLISHED)
+        return super().get(**kwargs)
+
+    @classmethod
+    def get_all(cls, **kwargs):
+        '''
+        Get the published timetables of the current year and studyperiod.
+        '''
+        kwargs.setdefault('status', cls.PUBLISHED)
+        return super().get_all(**kwargs)
 
 
 class Tutor(Base):
@@ -418,7 +452,7 @@ class Room(db.Model):
         return list
 
     def get_available_times(self):
-        timeslots = Timeslot.get_all()
+        timeslots = get_all_timeslots()
         engagedtimes = []
         for timeclass in self.timetabledclasses:
             engagedtimes.append(timeclass.timeslot)
@@ -441,18 +475,326 @@ class Timeslot(Base):
                                         cascade='all,delete-orphan')
     preferredtime = db.Column(db.Boolean)
 
-    def __init__(self, day, time, preferredtime=True):
+    def __init__(self, day, time, preferredtime=True, timetable=None):
         super().__init__()
-        self.timetable = get_current_timetable_id()
+        self.timetable = timetable if timetable is not None else get_current_timetable_id()
         self.day = day
         self.daynumeric = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"].index(day)
         self.time = time
         self.preferredtime = preferredtime
 
 
+class SolverJob(Base):
+    '''
+    This class represents one run of the timetabling solver against a timetable.
+
+    Jobs move from queued to running and then finish as succeeded, failed or cancelled. Only one job may be queued or
+    running for a timetable at a time: activetimetable holds the timetable id while the job is active and is cleared
+    when it finishes, and its unique constraint stops two requests from both queueing a job.
+    '''
+    __tablename__ = 'solverjobs'
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    SUCCEEDED = 'succeeded'
+    FAILED = 'failed'
+    CANCELLED = 'cancelled'
+    ACTIVE = (QUEUED, RUNNING)
+
+    timetable = db.Column(db.Integer, db.ForeignKey('timetable.id'), nullable=False)
+    activetimetable = db.Column(db.Integer, db.ForeignKey('timetable.id'), unique=True)
+    status = db.Column(db.String(20), nullable=False)
+    created = db.Column(db.DateTime, nullable=False)
+    started = db.Column(db.DateTime)
+    finished = db.Column(db.DateTime)
+    solverstatus = db.Column(db.String(50))
+    message = db.Column(db.Text)
+    stats = db.Column(db.Text)
+    objective = db.Column(db.Float)
+    gap = db.Column(db.Float)
+    snapshot = db.Column(db.Text)
+    published = db.Column(db.Integer, db.ForeignKey('timetable.id'))
+
+    def __init__(self, timetable):
+        super().__init__()
+        self.timetable = timetable
+        self.activetimetable = timetable
+        self.status = SolverJob.QUEUED
+        self.created = datetime.datetime.now()
+
+    @classmethod
+    def get_active(cls, timetable):
+        '''
+        Get the queued or running job for a timetable.
+        :param timetable: The timetable id.
+        :return: The active job or None.
+        '''
+        return cls.query.filter(cls.activetimetable == timetable).first()
+
+    @classmethod
+    def get_last_run(cls, timetable):
+        '''
+        Get the most recent successful job that produced a timetable and recorded the data it was solved with.
+        :param timetable: The timetable id.
+        :return: The job or None.
+        '''
+        produced = db.or_(cls.published == timetable, db.and_(cls.published == None, cls.timetable == timetable))
+        return cls.query.filter(produced, cls.status == cls.SUCCEEDED,
+                                cls.snapshot != None).order_by(cls.finished.desc()).first()
+
+    def is_active(self):
+        return self.status in SolverJob.ACTIVE
+
+    def is_cancelled(self):
+        '''
+        Check the database for whether this job has been cancelled, as it is cancelled from another thread.
+        :return: True/False
+        '''
+        db.session.refresh(self)
+        return self.status == SolverJob.CANCELLED
+
+    def start(self):
+        self.update(status=SolverJob.RUNNING, started=datetime.datetime.now())
+
+    def finish(self, status, message=None, solverstatus=None):
+        self.update(status=status, message=message, solverstatus=solverstatus, finished=datetime.datetime.now(),
+                    activetimetable=None)
+
+    def cancel(self):
+        '''
+        Cancel the job. The solver checks for this between stages and stops before writing to the timetable.
+        :return: True if the job was active and is now cancelled.
+        '''
+        if not self.is_active():
+            return False
+        self.finish(SolverJob.CANCELLED, message="Cancelled by administrator")
+        return True
+
+    def duration(self):
+        '''
+        Get how long the job has been running for, or ran for if it has finished.
+        :return: Duration in seconds or None if it has not started.
+        '''
+        if self.started is None:
+            return None
+        end = self.finished if self.finished is not None else datetime.datetime.now()
+        return (end - self.started).total_seconds()
+
+    def to_dict(self):
+        timetable = Timetable.query.get(self.timetable)
+        return {
+            'id': self.id,
+            'timetable': self.timetable,
+            'timetablekey': timetable.key if timetable is not None else "",
+            'status': self.status,
+            'created': convert_datetime_to_string(self.created),
+            'started': convert_datetime_to_string(self.started) if self.started is not None else "",
+            'finished': convert_datetime_to_string(self.finished) if self.finished is not None else "",
+            'duration': self.duration(),
+            'solverstatus': self.solverstatus or "",
+            'message': self.message or "",
+            'stats': json.loads(self.stats) if self.stats else {},
+            'objective': self.objective,
+            'gap': self.gap,
+            'published': self.published,
+        }
+
+
+class ImportJob(Base):
+    '''
+    This class represents one uploaded file being imported in the background.
+
+    Jobs move from queued to running and then finish as succeeded or failed. The sha256 hash of the file is kept so
+    the same file uploaded twice is not imported twice.
+    '''
+    __tablename__ = 'importjobs'
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    SUCCEEDED = 'succeeded'
+    FAILED = 'failed'
+    ACTIVE = (QUEUED, RUNNING)
+    KINDS = ('students', 'tutors', 'availabilities', 'classlists')
+
+    kind = db.Column(db.String(20), nullable=False)
+    filename = db.Column(db.String(255))
+    filehash = db.Column(db.String(64), index=True, nullable=False)
+    status = db.Column(db.String(20), nullable=False)
+    created = db.Column(db.DateTime, nullable=False)
+    started = db.Column(db.DateTime)
+    finished = db.Column(db.DateTime)
+    rows = db.Column(db.Integer)
+    processed = db.Column(db.Integer, default=0)
+    errors = db.Column(db.Integer, default=0)
+    message = db.Column(db.Text)
+    stats = db.Column(db.Text)
+
+    def __init__(self, kind, filename, filehash):
+        super().__init__()
+        self.kind = kind
+        self.filename = filename
+        self.filehash = filehash
+        self.status = ImportJob.QUEUED
+        self.created = datetime.datetime.now()
+        self.processed = 0
+        self.errors = 0
+
+    @classmethod
+    def get_duplicate(cls, kind, filehash):
+        '''
+        Get the most recent job that is importing, or has imported, the same file.
+        :param kind: The kind of file.
+        :param filehash: The sha256 hash of the file.
+        :return: The job or None. Failed jobs are not counted so a file can be uploaded again after a failure.
+        '''
+        return cls.query.filter(cls.kind == kind, cls.filehash == filehash, cls.year == get_current_year(),
+                                cls.studyperiod == get_current_studyperiod(),
+                                cls.status.in_(cls.ACTIVE + (cls.SUCCEEDED,))).order_by(cls.created.desc()).first()
+
+    def is_active(self):
+        return self.status in ImportJob.ACTIVE
+
+    def start(self, rows=None):
+        self.update(status=ImportJob.RUNNING, started=datetime.datetime.now(), rows=rows)
+
+    def progress(self, report):
+        '''
+        Record how far the import has got.
+        :param report: Dictionary with the rows read so far and the list of row errors, e.g. the populate_students
+                       report.
+        :return: Nil.
+        '''
+        self.update(processed=report['rows'], errors=len(report.get('errors', ())), stats=json.dumps(report))
+
+    def finish(self, status, message=None):
+        self.update(status=status, message=message, finished=datetime.datetime.now())
+
+    def duration(self):
+        '''
+        Get how long the import has been running for, or ran for if it has finished.
+        :return: Duration in seconds or None if it has not started.
+        '''
+        if self.started is None:
+            return None
+        end = self.finished if self.finished is not None else datetime.datetime.now()
+        return (end - self.started).total_seconds()
+
+    def to_dict(self):
+        duration = self.duration()
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'filename': self.filename or "",
+            'status': self.status,
+            'created': convert_datetime_to_string(self.created),
+            'started': convert_datetime_to_string(self.started) if self.started is not None else "",
+            'finished': convert_datetime_to_string(self.finished) if self.finished is not None else "",
+            'duration': duration,
+            'rows': self.rows,
+            'processed': self.processed or 0,
+            'errors': self.errors or 0,
+            'rowspersecond': round(self.processed / duration) if self.processed and duration else None,
+            'message': self.message or "",
+            'stats': json.loads(self.stats) if self.stats else {},
+        }
+
+
+
+
+class Scenario(Base):
+    '''
+    This class represents one what-if run of the solver with its own objective weights and class size limits.
+
+    Scenarios are run in batches and solved without touching the timetable. Each one keeps its classes so the one
+    the administrator prefers can be committed as a new timetable afterwards.
+    '''
+    __tablename__ = 'scenarios'
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    SUCCEEDED = 'succeeded'
+    FAILED = 'failed'
+
+    batch = db.Column(db.Integer, nullable=False, index=True)
+    name = db.Column(db.String(50), nullable=False)
+    timetable = db.Column(db.Integer, db.ForeignKey('timetable.id'), nullable=False)
+    parameters = db.Column(db.Text, nullable=False)
+    status = db.Column(db.String(20), nullable=False)
+    created = db.Column(db.DateTime, nullable=False)
+    finished = db.Column(db.DateTime)
+    solverstatus = db.Column(db.String(50))
+    message = db.Column(db.Text)
+    objective = db.Column(db.Float)
+    metrics = db.Column(db.Text)
+    classes = db.Column(db.Text)
+    committedtimetable = db.Column(db.Integer, db.ForeignKey('timetable.id'))
+
+    def __init__(self, batch, name, timetable, parameters):
+        super().__init__()
+        self.batch = batch
+        self.name = name
+        self.timetable = timetable
+        self.parameters = json.dumps(parameters)
+        self.status = Scenario.QUEUED
+        self.created = datetime.datetime.now()
+
+    @classmethod
+    def next_batch(cls):
+        '''
+        Get the id for a new batch of scenarios.
+        :return: One more than the largest batch so far.
+        '''
+        last = db.session.query(db.func.max(cls.batch)).scalar()
+        return 1 if last is None else last + 1
+
+    @classmethod
+    def get_batch(cls, batch):
+        return cls.query.filter_by(batch=batch).order_by(cls.id).all()
+
+    def get_parameters(self):
+        return json.loads(self.parameters)
 
+    def get_classes(self):
+        return json.loads(self.classes) if self.classes else []
 
+    def finish(self, status, result=None, message=None):
+        '''
+        Record how the scenario's solve went.
+        :param status: SUCCEEDED or FAILED.
+        :param result: The result dictionary from solve_scenario, if it got that far.
+        :param message: Optional error message.
+        '''
+        kwargs = {}
+        if result is not None:
+            kwargs = {'solverstatus': result['status'], 'objective': result.get('objective'),
+                      'metrics': json.dumps(result.get('metrics') or {}), 'classes': json.dumps(result['classes'])}
+        self.update(status=status, message=message, finished=datetime.datetime.now(), **kwargs)
 
+    def commit(self, key=None):
+        '''
+        Write the scenario's classes to a new timetable and make it the current timetable.
+        :param key: Name for the new timetable, the scenario name if not given.
+        :return: The new Timetable.
+        '''
+        if self.status != Scenario.SUCCEEDED or self.solverstatus not in SOLVED_STATUSES:
+            raise ValueError("Scenario {} has no timetable to commit".format(self.name))
+        timetable = create_timetable_version(key or self.name, self.get_classes(), base=self.timetable)
+        self.update(committedtimetable=timetable.id)
+        return timetable
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'batch': self.batch,
+            'name': self.name,
+            'timetable': self.timetable,
+            'parameters': self.get_parameters(),
+            'status': self.status,
+            'created': convert_datetime_to_string(self.created),
+            'finished': convert_datetime_to_string(self.finished) if self.finished is not None else "",
+            'solverstatus': self.solverstatus or "",
+            'message': self.message or "",
+            'objective': self.objective,
+            'metrics': json.loads(self.metrics) if self.metrics else {},
+            'committedtimetable': self.committedtimetable,
+        }
 
 
 
@@ -507,35 +849,342 @@ def getadmin():
     admin["currentyear"] = get_current_year()
     admin["studyperiod"] = get_current_studyperiod()
     admin["timetable"] = get_current_timetable()
+    admin["solver"] = get_solver_settings()
+    admin["solverengines"] = SOLVER_ENGINES
     return admin
 
 
-def populate_students(df):
+SOLVER_STAGES = ('timetable', 'rooms')
+SOLVER_ENGINES = {'timetable': ('milp', 'sectioned', 'localsearch', 'lns'), 'rooms': ('milp', 'heuristic')}
+
+
+def parse_solver_setting(name, value):
     '''
-    Populate student and subject database from a dataframe.
-    :param df: Pandas dataframe containing the student and subject data.
+    Convert a solver setting from the admin table into its value.
+    :param name: The setting name: timelimit, gap, threads, acceptfeasible or engine.
+    :param value: The stored value. An empty string or None means no limit.
+    :return: A float, an integer, a boolean, a string or None.
+    '''
+    if name == 'engine':
+        return value
+    if name == 'acceptfeasible':
+        return value in (True, 1, '1', 'True', 'true', 'on')
+    if value is None or str(value).strip() in ('', 'None'):
+        return None
+    if name == 'threads':
+        return int(value)
+    return float(value)
+
+
+def get_solver_settings():
+    '''
+    Get the CBC settings for each solver stage from the admin table, falling back to the config defaults.
+    :return: Dictionary of stage -> dictionary of timelimit, gap, threads, acceptfeasible and the engine if the stage
+             has a choice of engines.
+    '''
+    admin = get_admin_settings()
+    settings = {}
+    for stage in SOLVER_STAGES:
+        settings[stage] = {}
+        for name, default in appcfg["solver_settings"][stage].items():
+            settings[stage][name] = parse_solver_setting(name, admin.get(stage + '_' + name, default))
+    return settings
+
+
+def update_solver_settings(form):
+    '''
+    Update the solver settings in the admin table from the admin page form.
+    :param form: The request form with a field named stage_setting for each setting, e.g. timetable_timelimit.
     :return: Nil.
+    :raises ValueError: If a number or engine is not valid. Nothing is updated in that case.
+    '''
+    values = {}
+    for stage in SOLVER_STAGES:
+        for name in appcfg["solver_settings"][stage]:
+            key = stage + '_' + name
+            if name == 'acceptfeasible':
+                value = checkboxvalue(form.get(key))
+            elif name == 'engine':
+                value = form.get(key) or appcfg["solver_settings"][stage][name]
+            else:
+                value = form.get(key, '').strip()
+            parsed = parse_solver_setting(name, value)
+            if name == 'engine':
+                if value not in SOLVER_ENGINES[stage]:
+                    raise ValueError("{} must be one of {}".format(key, ", ".join(SOLVER_ENGINES[stage])))
+            elif parsed is not None and parsed < 0:
+                raise ValueError("{} must not be negative".format(key))
+            values[key] = str(value)
+    for key, value in values.items():
+        admin = Admin.get(key=key)
+        if admin is None:
+            db.session.add(Admin(key=key, value=value))
+        else:
+            admin.update(value=value, commit=False)
+    db.session.commit()
+
+
+def parse_scenarios(scenarios):
+    '''
+    Check the what-if scenarios sent to /runscenarios and fill in their defaults.
+
+    :param scenarios: List of dictionaries with an optional name, weights dictionary and maxclasssize and minclasssize.
+    :return: List of dictionaries of name, weights, maxclasssize and minclasssize.
+    :raises ValueError: If there are no scenarios, too many or one has an unknown weight or a bad value.
+    '''
+    if not isinstance(scenarios, list) or len(scenarios) == 0:
+        raise ValueError("No scenarios given")
+    if len(scenarios) > appcfg["solver_max_scenarios"]:
+        raise ValueError("At most {} scenarios can be run at once".format(appcfg["solver_max_scenarios"]))
+    parsed = []
+    for n, scenario in enumerate(scenarios):
+        name = str(scenario.get('name') or "Scenario {}".format(n + 1))[:50]
+        weights = {}
+        for weight, value in (scenario.get('weights') or {}).items():
+            if weight not in appcfg["solver_weights"]:
+                raise ValueError("{}: no such weight {}".format(name, weight))
+            try:
+                weights[weight] = float(value)
+            except (TypeError, ValueError):
+                raise ValueError("{}: {} must be a number".format(name, weight))
+            if weights[weight] < 0:
+                raise ValueError("{}: {} must not be negative".format(name, weight))
+        sizes = {}
+        for size, default, smallest in (('maxclasssize', appcfg["max_class_size"], 1),
+                                        ('minclasssize', appcfg["min_class_size"], 0)):
+            value = scenario.get(size)
+            try:
+                sizes[size] = default if value in (None, '') else int(value)
+            except (TypeError, ValueError):
+                raise ValueError("{}: {} must be a whole number".format(name, size))
+            if sizes[size] < smallest:
+                raise ValueError("{}: {} must be at least {}".format(name, size, smallest))
+        if sizes['minclasssize'] > sizes['maxclasssize']:
+            raise ValueError("{}: minclasssize is larger than maxclasssize".format(name))
+        parsed.append(dict(name=name, weights=weights, **sizes))
+    return parsed
+
+
+def create_timetable_version(key, classes, base=None):
+    '''
+    Create a new timetable holding the given classes and make it the current timetable.
+
+    The new timetable is staged and filled in first and only then published, so nobody sees it half written.
+
+    :param key: Name of the new timetable.
+    :param classes: List of dictionaries of subject code, time string, tutor name, room name and student names.
+    :param base: Id of the timetable to copy the timeslots from, the current timetable if not given.
+    :return: The new Timetable, with the write-back report of add_solution_to_timetable as its writeback attribute.
+    '''
+    timetable = stage_timetable_version(key, base=base)
+    try:
+        timetable.writeback = add_solution_to_timetable(classes, timetable=timetable)
+    except Exception:
+        discard_timetable(timetable)
+        raise
+    publish_timetable(timetable)
+    return timetable
+
+
+def stage_timetable_version(key, base=None):
+    '''
+    Create a staging timetable to write a new version into.
+
+    The timeslots of the base timetable are copied across, with their tutor availabilities, so the new timetable can
+    be edited and solved again like any other.
+
+    :param key: Name of the new timetable.
+    :param base: Id of the timetable to copy the timeslots from, the current timetable if not given.
+    :return: The staging Timetable.
+    '''
+    base = base if base is not None else get_current_timetable_id()
+    timetable = Timetable.create(key=key, status=Timetable.STAGING)
+    for timeslot in Timeslot.query.filter_by(timetable=base).all():
+        copy = Timeslot(day=timeslot.day, time=timeslot.time, preferredtime=timeslot.preferredtime,
+                        timetable=timetable.id)
+        copy.availabiletutors = list(timeslot.availabiletutors)
+        db.session.add(copy)
+    db.session.commit()
+    return timetable
+
+
+def publish_timetable(timetable):
+    '''
+    Publish a staging timetable and point the Admin 'timetable' key at it in a single commit, so readers either see
+    the old timetable or the whole of the new one.
+
+    :param timetable: The staging Timetable.
+    :return: Nil.
+    '''
+    timetable.status = Timetable.PUBLISHED
+    Admin.get(key='timetable').value = timetable.id
+    db.session.commit()
+
+
+def discard_timetable(timetable):
+    '''
+    Delete a timetable that is not current, with its classes and timeslots.
+
+    :param timetable: The Timetable.
+    :return: Nil.
+    '''
+    db.session.rollback()
+    for timetabledclass in TimetabledClass.query.filter_by(timetable=timetable.id).all():
+        db.session.delete(timetabledclass)
+    db.session.delete(timetable)
+    db.session.commit()
+
+
+def collect_staging_timetables(maxage=None):
+    '''
+    Delete staging timetables that were abandoned part way through being written, e.g. when the server stopped.
+
+    A staging timetable made since the oldest queued or running SolverJob was created may be the one that job is
+    writing, so it is kept however old it is.
+
+    :param maxage: Minutes a staging timetable may be left for before it is deleted, the
+                   timetable_staging_max_age config value if not given.
+    :return: The number of timetables deleted.
+    '''
+    maxage = maxage if maxage is not None else appcfg.get("timetable_staging_max_age", 60)
+    cutoff = datetime.datetime.now() - datetime.timedelta(minutes=maxage)
+    oldestjob = db.session.query(db.func.min(SolverJob.created)).filter(SolverJob.activetimetable != None).scalar()
+    if oldestjob is not None:
+        cutoff = min(cutoff, oldestjob)
+    abandoned = Timetable.query.filter(Timetable.status == Timetable.STAGING, Timetable.created < cutoff).all()
+    for timetable in abandoned:
+        message = "Deleting abandoned staging timetable {}".format(timetable.id)
+        print(message)
+        app.logger.info(message)
+        discard_timetable(timetable)
+    return len(abandoned)
+
+
+def populate_students(df, chunksize=None, progress=None):
+    '''
+    Populate student and subject database from a dataframe.
+
+    The dataframe can also be an iterator of dataframes, e.g. from read_csv with a chunksize, so a large enrolment
+    export is never held in memory all at once. Each chunk is imported with a handful of bulk statements and committed
+    on its own: rows for other study periods are dropped, students and subjects are deduplicated against each other and
+    what is already in the database, and only the new students, subjects and enrolments are inserted.
+
+    :param df: Pandas dataframe, or iterator of dataframes, containing the student and subject data.
+    :param chunksize: Number of rows to import at a time, the enrolment_import_chunk_size config value if not given.
+    :param progress: Optional function called with the report so far after each chunk.
+    :return: Dictionary of the number of rows read, imported and skipped, the students, subjects and enrolments
+             added, the rows that could not be imported with the reason, the time taken and the rows per second.
     '''
     print("Populating Students")
+    started = datetime.datetime.now()
+    chunksize = chunksize or appcfg.get("enrolment_import_chunk_size", 5000)
+    if isinstance(df, pandas.DataFrame):
+        chunks = (df.iloc[n:n + chunksize] for n in range(0, len(df), chunksize))
+    else:
+        chunks = df
+    year = get_current_year()
     studyperiod = get_current_studyperiod()
-    col_student_id = appcfg["enrolment_schema"]["student_id"]
-    col_student_first_name = appcfg["enrolment_schema"]["student_first_name"]
-    col_student_last_name = appcfg["enrolment_schema"]["student_last_name"]
-    col_subject_code = appcfg["enrolment_schema"]["subject_code"]
-    col_subject_name = appcfg["enrolment_schema"]["subject_name"]
-    col_study_period = appcfg["enrolment_schema"]["study_period"]
-    for index, row in df.iterrows():
-        if studyperiod == row[col_study_period]:
-            student_name = (str(row[col_student_first_name]) + " " + str(row[col_student_last_name])).strip().title()
-            print("Adding: ", student_name, row[col_subject_code], row[col_subject_name])
-            student = Student.get_or_create(studentcode=str(int(row[col_student_id])),
-                                            name=student_name,
-                                            universityid=University.query.filter_by(
-                                                name='University of Melbourne').first().id,
-                                            collegeid=str(College.query.filter_by(name="International House").first().id))
-            subject = Subject.get_or_create(subcode=row[col_subject_code],
-                                            subname=row[col_subject_name])
-            student.addSubject(subject)
+    university = University.query.filter_by(name='University of Melbourne').first()
+    college = College.query.filter_by(name="International House").first()
+    imported = {
+        'year': year,
+        'studyperiod': studyperiod,
+        'universityid': university.id if university is not None else None,
+        'collegeid': college.id if college is not None else None,
+        'students': dict(db.session.query(Student.studentcode, Student.id).filter_by(
+            year=year, studyperiod=studyperiod).all()),
+        'subjects': dict(db.session.query(Subject.subcode, Subject.id).filter_by(
+            year=year, studyperiod=studyperiod).all()),
+        'enrolments': set(db.session.query(substumap.c.student_id, substumap.c.subject_id).join(
+            Subject, Subject.id == substumap.c.subject_id).filter(Subject.year == year,
+                                                                  Subject.studyperiod == studyperiod).all())
+    }
+    report = {'rows': 0, 'imported': 0, 'skipped': 0, 'students': 0, 'subjects': 0, 'enrolments': 0, 'errors': []}
+    for chunk in chunks:
+        import_enrolment_chunk(chunk, imported, report)
+        print("Imported {} of {} rows".format(report['imported'], report['rows']))
+        if progress is not None:
+            progress(report)
+    seconds = max((datetime.datetime.now() - started).total_seconds(), 1e-6)
+    report['time'] = round(seconds, 3)
+    report['rowspersecond'] = round(report['rows'] / seconds)
+    message = ("Imported {imported} of {rows} enrolment rows ({students} new students, {subjects} new subjects, "
+               "{enrolments} new enrolments, {errors} errors) in {time}s, {rowspersecond} rows/s").format(
+        **dict(report, errors=len(report['errors'])))
+    print(message)
+    app.logger.info(message)
+    return report
+
+
+def import_enrolment_chunk(chunk, imported, report):
+    '''
+    Import one chunk of an enrolment export for populate_students.
+
+    :param chunk: Pandas dataframe of enrolment rows.
+    :param imported: Dictionary of the year, studyperiod, university and college ids, the studentcode -> id and
+                     subcode -> id of the students and subjects already in the database and the set of (student id,
+                     subject id) enrolments already in the database. Updated with what this chunk adds.
+    :param report: The populate_students report, updated with the counts and errors of this chunk.
+    :return: Nil.
+    '''
+    schema = appcfg["enrolment_schema"]
+    read = len(chunk)
+    report['rows'] += read
+    chunk = chunk[chunk[schema["study_period"]].astype(str).str.strip() == str(imported['studyperiod'])]
+    report['skipped'] += read - len(chunk)
+    codes = pandas.to_numeric(chunk[schema["student_id"]], errors='coerce')
+    subcodes = chunk[schema["subject_code"]].fillna('').astype(str).str.strip()
+    invalid = codes.isnull() | (codes != codes.round()) | (subcodes == '')
+    for index in chunk.index[invalid]:
+        report['errors'].append({'row': int(index) if isinstance(index, (int, numpy.integer)) else str(index),
+                                 'message': "Missing subject code" if subcodes[index] == '' else
+                                 "Invalid student id: {}".format(chunk.at[index, schema["student_id"]])})
+    report['skipped'] += int(invalid.sum())
+    chunk = chunk[~invalid]
+    rows = pandas.DataFrame({
+        'studentcode': codes[~invalid].astype(numpy.int64).astype(str),
+        'name': (chunk[schema["student_first_name"]].fillna('').astype(str) + " " +
+                 chunk[schema["student_last_name"]].fillna('').astype(str)).str.strip().str.title(),
+        'subcode': subcodes[~invalid],
+        'subname': chunk[schema["subject_name"]].fillna('').astype(str).str.strip()
+    })
+    if rows.empty:
+        return
+    year, studyperiod = imported['year'], imported['studyperiod']
+    students = rows.drop_duplicates('studentcode')
+    students = students[~students['studentcode'].isin(imported['students'])]
+    subjects = rows.drop_duplicates('subcode')
+    subjects = subjects[~subjects['subcode'].isin(imported['subjects'])]
+    try:
+        if len(students):
+            db.session.execute(Student.__table__.insert(), [
+                {'studentcode': code, 'name': name, 'universityid': imported['universityid'],
+                 'collegeid': imported['collegeid'], 'email': "", 'year': year, 'studyperiod': studyperiod}
+                for code, name in zip(students['studentcode'], students['name'])])
+            imported['students'].update(db.session.query(Student.studentcode, Student.id).filter(
+                Student.year == year, Student.studyperiod == studyperiod,
+                Student.studentcode.in_(students['studentcode'].tolist())).all())
+        if len(subjects):
+            db.session.execute(Subject.__table__.insert(), [
+                {'subcode': code, 'subname': name, 'repeats': 1, 'year': year, 'studyperiod': studyperiod}
+                for code, name in zip(subjects['subcode'], subjects['subname'])])
+            imported['subjects'].update(db.session.query(Subject.subcode, Subject.id).filter(
+                Subject.year == year, Subject.studyperiod == studyperiod,
+                Subject.subcode.in_(subjects['subcode'].tolist())).all())
+        enrolments = set(zip(rows['studentcode'].map(imported['students']), rows['subcode'].map(imported['subjects'])))
+        enrolments = sorted(enrolments - imported['enrolments'])
+        if enrolments:
+            db.session.execute(substumap.insert(), [{'student_id': int(studentid), 'subject_id': int(subjectid)}
+                                                    for studentid, subjectid in enrolments])
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    imported['enrolments'].update(enrolments)
+    report['imported'] += len(rows)
+    report['students'] += len(students)
+    report['subjects'] += len(subjects)
+    report['enrolments'] += len(enrolments)
 
 
 def populate_timetabledata(df):
@@ -553,7 +1202,7 @@ def populate_timetabledata(df):
         day = time2[0]
         time2 = time2[1]
         time2 = check_time(time2)
-        timeslot = Timeslot.get_or_create(day=day, time=time2)
+        timeslot = Timeslot.get_or_create(timetable=get_current_timetable_id(), day=day, time=time2)
         timetable = get_current_timetable()
         timetabledclass = TimetabledClass.get_or_create(time=timeslot.id, subjectid=subject.id, timetable=timetable.id)
         for i in range(5, len(row)):
@@ -577,7 +1226,7 @@ def populate_availabilities(df):
         for key in row.keys():
             keysplit = key.split(' ')
             if keysplit[0] in ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']:
-                timeslot = Timeslot.get_or_create(day=keysplit[0],
+                timeslot = Timeslot.get_or_create(timetable=get_current_timetable_id(), day=keysplit[0],
                                                   time=keysplit[1])
                 if row[key] == 1:
                     print("Assigning timeslot: ", key, row["Tutor"])
@@ -586,7 +1235,7 @@ def populate_availabilities(df):
 
 def get_tutor_template(tutor, form, msg="", msg2="", msg3=""):
     return render_template('tutor.html', tutor=tutor, eligiblesubjects=Subject.get_all(),
-                           subjects=tutor.subjects, timeslots=Timeslot.get_all(),
+                           subjects=tutor.subjects, timeslots=get_all_timeslots(),
                            availability=tutor.availabletimes,
                            msg=msg, msg2=msg2, msg3=msg3, form=form)
 
@@ -623,13 +1272,59 @@ def update_studyperiod(studyperiod):
     admin.value = studyperiod
     db.session.commit()
 
+SETTINGS_VERSION_KEY = 'settingsversion'
+SETTINGS_CACHE = {}
+
+
+def get_admin_settings():
+    '''
+    Get every key and value in the admin table.
+
+    The values are cached for the whole process along with the settingsversion row of the admin table, which is
+    bumped whenever the admin table changes. The version is checked once per request (and on every call outside a
+    request), so changes made by other worker processes are picked up by the next request.
+    :return: Dictionary of admin key -> value.
+    '''
+    version, values = SETTINGS_CACHE.get('settings', (None, None))
+    if values is not None and has_request_context() and g.get('settingsversion', False) == version:
+        return values
+    row = db.session.query(Admin.value).filter_by(key=SETTINGS_VERSION_KEY).first()
+    current = row[0] if row is not None else None
+    if values is None or current != version:
+        values = dict(db.session.query(Admin.key, Admin.value).all())
+        SETTINGS_CACHE['settings'] = (current, values)
+    if has_request_context():
+        g.settingsversion = current
+    return values
+
+
+@event.listens_for(db.session, 'after_flush')
+def bump_settings_version(session, flush_context):
+    '''
+    Bump the settingsversion row in the same transaction as any change to the admin table, and drop this process's
+    cached settings.
+    '''
+    changed = [admin for admin in list(session.new) + list(session.dirty) + list(session.deleted)
+               if isinstance(admin, Admin) and admin.key != SETTINGS_VERSION_KEY]
+    if not changed:
+        return
+    SETTINGS_CACHE.clear()
+    if has_request_context():
+        g.pop('settingsversion', None)
+    table = Admin.__table__
+    connection = session.connection()
+    bumped = connection.execute(table.update().where(table.c.key == SETTINGS_VERSION_KEY).values(
+        value=db.cast(db.cast(table.c.value, db.Integer) + 1, db.String(50))))
+    if bumped.rowcount == 0:
+        connection.execute(table.insert().values(key=SETTINGS_VERSION_KEY, value='1'))
+
+
 def get_current_year():
     '''
     Get the current year from the admin table.
     :return: The current year as an integer.
     '''
-    admin = Admin.query.filter_by(key='currentyear').first()
-    return int(admin.value)
+    return int(get_admin_settings()['currentyear'])
 
 
 def get_current_timetable():
@@ -637,26 +1332,23 @@ def get_current_timetable():
     Get the current timetable from the database.
     :return: The current timetable as an object.
     '''
-    admin = Admin.query.filter_by(key='timetable').first()
-    return Timetable.get(id=int(admin.value))
+    return Timetable.query.get(get_current_timetable_id())
 
 
 def get_current_timetable_id():
     '''
-    Get the current timetable id from the database.
+    Get the current timetable id from the admin table.
     :return: The current timetable id as an integer.
     '''
-    admin = Admin.query.filter_by(key='timetable').first()
-    return Timetable.get(id=int(admin.value)).id
+    return int(get_admin_settings()['timetable'])
 
 
 def get_current_studyperiod():
     '''
-    Get the current studyperiod from the database
+    Get the current studyperiod from the admin table.
     :return: The current studyperiod as a String.
     '''
-    admin = Admin.query.filter_by(key='studyperiod').first()
-    return admin.value
+    return get_admin_settings()['studyperiod']
 
 
 def linksubjectstudent(studentcode, subcode):
@@ -700,142 +1392,230 @@ def get_all_subjects():
 
 
 def get_all_timeslots():
-    return Timeslot.get_all()
+    '''
+    Get the timeslots of the current timetable. Every timetable version has its own copy of the timeslots.
+    :return: List of Timeslots.
+    '''
+    return Timeslot.get_all(timetable=get_current_timetable_id())
 
-def get_timetable_data(rooms=False):
+def unique_labels(objects, name, suffix):
     '''
-    Get all required timetable data from the database
-    :return: All timetabling data as a tuple to the preparetimetable method.
+    Label each object by its name, adding a suffix to the names that more than one object shares so they stay apart.
+    :param objects: The database objects.
+    :param name: Function giving an object's name.
+    :param suffix: Function giving what to add to a shared name, e.g. the student code.
+    :return: Dictionary of object id -> label.
     '''
-    SUBJECTS = []
-    SUBJECTMAPPING = {}
-    STUDENTS = []
-    ROOMS = []
-    REPEATS = {}
-    TEACHERS = []
-    TUTORAVAILABILITY = {}
-    TEACHERMAPPING = {}
-    PROJECTORS = []
-    PROJECTORROOMS = []
-    NONPREFERREDTIMES = []
-    CAPACITIES = {}
-
-    allsubjects = Subject.query.filter(Subject.year == get_current_year(),
-                                       Subject.studyperiod == get_current_studyperiod(), Subject.tutor != None).all()
-    alltutors = []
-    for subject in allsubjects:
-        SUBJECTMAPPING[subject.subcode] = []
-        REPEATS[subject.subcode] = subject.repeats
-        SUBJECTS.append(subject.subcode)
-        TEACHERS.append(subject.tutor.name)
-        if subject.tutor not in alltutors:
-            alltutors.append(subject.tutor)
-        for student in subject.students:
-            STUDENTS.append(student.name)
-            SUBJECTMAPPING[subject.subcode].append(student.name)
-        SUBJECTMAPPING[subject.subcode] = set(SUBJECTMAPPING[subject.subcode])
-        if subject.needsprojector is True:
-            PROJECTORS.append(subject.subcode)
-    STUDENTS = list(set(STUDENTS))
-    TEACHERS = list(set(TEACHERS))
-    for tutor in alltutors:
-        TUTORAVAILABILITY[tutor.name] = []
-        TEACHERMAPPING[tutor.name] = []
-        for timeslot in tutor.availabletimes:
-            TUTORAVAILABILITY[tutor.name].append(timeslot.day + " " + timeslot.time)
-        for subject in tutor.subjects:
-            TEACHERMAPPING[tutor.name].append(subject.subcode)
-        TUTORAVAILABILITY[tutor.name] = set(TUTORAVAILABILITY[tutor.name])
-        TEACHERMAPPING[tutor.name] = set(TEACHERMAPPING[tutor.name])
-
-    allrooms = Room.query.all()
-    for room in allrooms:
-        ROOMS.append(room.name)
-        if room.projector is True:
-            PROJECTORROOMS.append(room.name)
-        if room.capacity is not None:
-            CAPACITIES[room.name] = int(room.capacity)
-        else:
-            CAPACITIES[room.name] = appcfg["default_room_capacity"]
-    numroomsprojector = len(PROJECTORROOMS)
-    maxclasssize = appcfg["max_class_size"]
-    minclasssize = appcfg["min_class_size"]
-    nrooms = len(ROOMS)
-    TIMES = []
-    day = []
-    timeslots = Timeslot.query.filter_by(year=get_current_year(), studyperiod=get_current_studyperiod(),
-                                         timetable=get_current_timetable().id).all()
-    for timeslot in timeslots:
-        TIMES.append(timeslot.day + " " + timeslot.time)
-        day.append(timeslot.day)
-        if timeslot.preferredtime is False:
-            NONPREFERREDTIMES.append(timeslot.day + " " + timeslot.time)
-
-    day = list(set(day))
-    DAYS = {}
-    for d in day:
-        DAYS[d] = []
+    counts = {}
+    for obj in objects:
+        counts[name(obj)] = counts.get(name(obj), 0) + 1
+    return {obj.id: name(obj) if counts[name(obj)] == 1 else "{} ({})".format(name(obj), suffix(obj))
+            for obj in objects}
+
+
+def student_labels():
+    '''
+    Get the labels the solver knows the students of the current study period by.
+    :return: Dictionary of student id -> label.
+    '''
+    return unique_labels(Student.get_all(), lambda student: student.name, lambda student: student.studentcode)
+
+
+def tutor_labels():
+    '''
+    Get the labels the solver knows the tutors of the current study period by.
+    :return: Dictionary of tutor id -> label.
+    '''
+    return unique_labels(Tutor.get_all(), lambda tutor: tutor.name, lambda tutor: tutor.id)
+
+
+def get_problem_instance():
+    '''
+    Get the timetabling problem for the current timetable from the database as a ProblemInstance.
+
+    Everything is read with a fixed number of queries whatever the size of the timetable: the admin settings through
+    get_admin_settings and one each for the students, tutors, subjects with their tutors, enrolments, timeslots, tutor availabilities and
+    rooms. The association tables are read directly rather than walking the relationships object by object.
+
+    Students and tutors are numbered by their database records, so two students or tutors with the same name are
+    kept apart with a label that adds their student code or tutor id.
+    :return: The ProblemInstance.
+    '''
+    settings = get_admin_settings()
+    year = int(settings['currentyear'])
+    studyperiod = settings['studyperiod']
+    timetable = int(settings['timetable'])
+    studentrows = db.session.query(Student.id, Student.name, Student.studentcode).filter(
+        Student.year == year, Student.studyperiod == studyperiod).all()
+    tutorrows = db.session.query(Tutor.id, Tutor.name).filter(Tutor.year == year,
+                                                              Tutor.studyperiod == studyperiod).all()
+    subjectrows = db.session.query(Subject.id, Subject.subcode, Subject.repeats, Subject.needsprojector,
+                                   subtutmap.c.tutor_id).join(subtutmap, subtutmap.c.subject_id == Subject.id).filter(
+        Subject.year == year, Subject.studyperiod == studyperiod).order_by(Subject.id).all()
+    enrolmentrows = db.session.query(substumap.c.subject_id, substumap.c.student_id).join(
+        Subject, Subject.id == substumap.c.subject_id).filter(Subject.year == year,
+                                                              Subject.studyperiod == studyperiod).all()
+    timeslots = db.session.query(Timeslot.id, Timeslot.day, Timeslot.time, Timeslot.preferredtime).filter(
+        Timeslot.year == year, Timeslot.studyperiod == studyperiod, Timeslot.timetable == timetable).all()
+    availabilityrows = db.session.query(tutoravailabilitymap.c.tutor_id, tutoravailabilitymap.c.timeslot_id).join(
+        Timeslot, Timeslot.id == tutoravailabilitymap.c.timeslot_id).filter(Timeslot.timetable == timetable).all()
+    allrooms = db.session.query(Room.name, Room.projector, Room.capacity).all()
+
+    studentlabels = unique_labels(studentrows, lambda student: student.name, lambda student: student.studentcode)
+    tutorlabels = unique_labels(tutorrows, lambda tutor: tutor.name, lambda tutor: tutor.id)
+    tutornames = {tutor.id: tutor.name for tutor in tutorrows}
+    subjects = []
+    subjecttutor = {}
+    for row in subjectrows:
+        if row.id not in subjecttutor:
+            subjects.append(row)
+            subjecttutor[row.id] = row.tutor_id
+    subjectnumbers = {subject.id: n for n, subject in enumerate(subjects)}
+    tutors = {}
+    for subject in subjects:
+        tutors.setdefault(subjecttutor[subject.id], len(tutors))
+    tutorsubjects = [[] for tutor in tutors]
+    for subject in subjects:
+        tutorsubjects[tutors[subjecttutor[subject.id]]].append(subjectnumbers[subject.id])
+    students = {}
+    subjectstudents = [set() for subject in subjects]
+    for (subjectid, studentid) in enrolmentrows:
+        if subjectid in subjectnumbers:
+            subjectstudents[subjectnumbers[subjectid]].add(students.setdefault(studentid, len(students)))
+    days = []
     for timeslot in timeslots:
-        DAYS[timeslot.day].append(timeslot.day + " " + timeslot.time)
-    for d in day:
-        DAYS[d] = set(DAYS[d])
+        if timeslot.day not in days:
+            days.append(timeslot.day)
+    timenumbers = {timeslot.id: n for n, timeslot in enumerate(timeslots)}
+    availability = numpy.zeros((len(tutors), len(timeslots)), dtype=bool)
+    for (tutorid, timeslotid) in availabilityrows:
+        if tutorid in tutors:
+            availability[tutors[tutorid], timenumbers[timeslotid]] = True
+    return ProblemInstance(
+        students=[studentlabels.get(id, str(id)) for id in students],
+        subjects=[subject.subcode for subject in subjects],
+        times=[timeslot.day + " " + timeslot.time for timeslot in timeslots], days=days,
+        timeday=[days.index(timeslot.day) for timeslot in timeslots],
+        tutors=[tutorlabels.get(id, tutornames.get(id, str(id))) for id in tutors],
+        rooms=[room.name for room in allrooms],
+        subjectstudents=subjectstudents, tutorsubjects=tutorsubjects, availability=availability,
+        repeats=[subject.repeats for subject in subjects],
+        projectors=[subject.needsprojector is True for subject in subjects],
+        nonpreferred=[timeslot.preferredtime is False for timeslot in timeslots],
+        projectorrooms=[room.projector is True for room in allrooms],
+        capacities=[int(room.capacity) if room.capacity is not None else appcfg["default_room_capacity"]
+                    for room in allrooms],
+        maxclasssize=appcfg["max_class_size"], minclasssize=appcfg["min_class_size"],
+        studentids=list(students), tutorids=list(tutors))
 
 
+def get_timetable_data(rooms=False):
+    '''
+    Get all required timetable data from the database, loaded with get_problem_instance so both forms label students
+    and tutors the same way.
+    :param rooms: Whether to include the room data. Without it the tuple ends with the number of rooms, as the
+                  original single stage model expected.
+    :return: All timetabling data as a tuple to the preparetimetable method.
+    '''
+    data = get_problem_instance().to_timetable_data()
     if rooms == True:
-        return (STUDENTS, SUBJECTS, TIMES, day, DAYS, TEACHERS, SUBJECTMAPPING, REPEATS, TEACHERMAPPING,
-                TUTORAVAILABILITY, maxclasssize, minclasssize, ROOMS, PROJECTORS, PROJECTORROOMS, numroomsprojector, NONPREFERREDTIMES, CAPACITIES)
-    else:
-        return (STUDENTS, SUBJECTS, TIMES, day, DAYS, TEACHERS, SUBJECTMAPPING, REPEATS, TEACHERMAPPING,
-                TUTORAVAILABILITY, maxclasssize, minclasssize, nrooms)
+        return data
+    return data[:12] + (len(data[12]),)
 
 
 
 def add_classes_to_timetable(TEACHERS, TEACHERMAPPING, SUBJECTMAPPING, TIMES, subject_vars, assign_vars, ROOMS):
-    print(ROOMS)
+    classes = []
     for m in TEACHERS:
         for j in TEACHERMAPPING[m]:
-            subject = Subject.get(subcode=j)
             for k in TIMES:
                 for n in ROOMS:
-                    print(n)
-                    timesplit = k.split(' ')
-                    timeslot = Timeslot.get(timetable=get_current_timetable().id, day=timesplit[0], time=timesplit[1])
-                    tutor = Tutor.get(name=m)
-                    room = Room.query.filter_by(name=n).first()
-                    print(room.id)
                     if subject_vars[(j, k, m, n)].varValue == 1:
-                        timetabledclass = TimetabledClass.create(subjectid=subject.id,
-                                                                 timetable=get_current_timetable().id, time=timeslot.id,
-                                                                 tutorid=tutor.id, roomid=room.id)
-                        for i in SUBJECTMAPPING[j]:
-                            if assign_vars[(i, j, k, m, n)].varValue == 1:
-                                student = Student.get(name=i)
-                                timetabledclass.students.append(student)
-                                db.session.commit()
-
-
-def add_classes_to_timetable_twostep(TEACHERS, TEACHERMAPPING, SUBJECTMAPPING, TIMES, subject_vars_with_rooms,
-                                     assign_vars, ROOMS, classpop):
+                        classes.append({'subject': j, 'time': k, 'tutor': m, 'room': n,
+                                        'students': [i for i in SUBJECTMAPPING[j]
+                                                     if assign_vars[(i, j, k, m, n)].varValue == 1]})
+    return add_solution_to_timetable(classes)
+
+
+def add_solution_to_timetable(classes, timetable=None):
+    '''
+    Add the classes chosen by the solver to the current timetable.
+
+    All the subject, timeslot, tutor, student and room ids are looked up first with one query each. The classes are
+    then inserted and their students added with a single bulk insert, all in one transaction, so a failure leaves
+    the timetable as it was.
+    :param classes: List of dictionaries of subject code, time string, tutor name, room name and student names.
+    :param timetable: Optional Timetable to add them to instead of the current one.
+    :return: Dictionary of the number of classes and student rows written, the time taken and rows per second.
+    '''
     print("Adding classes to timetable.")
-    for m in TEACHERS:
-        for j in TEACHERMAPPING[m]:
-            subject = Subject.get(subcode=j)
-            for k in TIMES:
-                for n in ROOMS:
-                    if (j,k,m) in classpop.keys():
-                        timesplit = k.split(' ')
-                        timeslot = Timeslot.get(timetable=get_current_timetable().id, day=timesplit[0], time=timesplit[1])
-                        tutor = Tutor.get(name=m)
-                        room = Room.query.filter_by(name=n).first()
-                        if subject_vars_with_rooms[(j, k, m, n)].varValue == 1:
-                            timetabledclass = TimetabledClass.create(subjectid=subject.id,
-                                                                     timetable=get_current_timetable().id, time=timeslot.id,
-                                                                     tutorid=tutor.id, roomid=room.id)
-                            for i in SUBJECTMAPPING[j]:
-                                if assign_vars[(i, j, k, m)].varValue == 1:
-                                    student = Student.get(name=i)
-                                    timetabledclass.students.append(student)
-                                    db.session.commit()
+    started = datetime.datetime.now()
+    timetable = timetable or get_current_timetable()
+    year = get_current_year()
+    studyperiod = get_current_studyperiod()
+    subjects = dict(db.session.query(Subject.subcode, Subject.id).filter(
+        Subject.year == year, Subject.studyperiod == studyperiod).all())
+    timeslots = {day + " " + hour: id for (id, day, hour) in db.session.query(
+        Timeslot.id, Timeslot.day, Timeslot.time).filter(Timeslot.timetable == timetable.id).all()}
+    tutorrows = db.session.query(Tutor.id, Tutor.name).filter(Tutor.year == year,
+                                                              Tutor.studyperiod == studyperiod).all()
+    studentrows = db.session.query(Student.id, Student.name, Student.studentcode).filter(
+        Student.year == year, Student.studyperiod == studyperiod).all()
+    rooms = {name: id for (id, name) in db.session.query(Room.id, Room.name).all()}
+    tutors = {label: id for id, label in
+              unique_labels(tutorrows, lambda tutor: tutor.name, lambda tutor: tutor.id).items()}
+    for tutor in tutorrows:
+        tutors.setdefault(tutor.name, tutor.id)
+    students = {label: id for id, label in unique_labels(studentrows, lambda student: student.name,
+                                                         lambda student: student.studentcode).items()}
+    for student in studentrows:
+        students.setdefault(student.name, student.id)
+    table = TimetabledClass.__table__
+    attending = []
+    try:
+        for timeclass in classes:
+            inserted = db.session.execute(table.insert().values(
+                year=year, studyperiod=studyperiod, subjectid=subjects[timeclass['subject']],
+                timetable=timetable.id, time=timeslots[timeclass['time']], tutorid=tutors[timeclass['tutor']],
+                roomid=rooms.get(timeclass['room'])))
+            classid = inserted.inserted_primary_key[0]
+            attending.extend({'timetabledclass_id': classid, 'student_id': students[i]}
+                             for i in timeclass['students'])
+        if attending:
+            db.session.execute(stutimetable.insert(), attending)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    seconds = max((datetime.datetime.now() - started).total_seconds(), 1e-6)
+    report = {'classes': len(classes), 'students': len(attending), 'time': seconds,
+              'rowspersecond': (len(classes) + len(attending)) / seconds}
+    message = "Wrote {} classes and {} students in {:.3f}s ({:.0f} rows/s)".format(
+        report['classes'], report['students'], seconds, report['rowspersecond'])
+    print(message)
+    app.logger.info(message)
+    return report
+
+
+def get_timetable_solution(timetableid):
+    '''
+    Get the classes of a timetable in the same form as the solver produces them, so that they can be used to start
+    the solver.
+    :param timetableid: The id of the timetable.
+    :return: List of dictionaries of subject code, time string, tutor name, room name and student names.
+    '''
+    classes = []
+    students = student_labels()
+    tutors = tutor_labels()
+    for timetabledclass in TimetabledClass.query.filter_by(timetable=timetableid).all():
+        if timetabledclass.subject is None or timetabledclass.tutor is None or timetabledclass.timeslot is None:
+            continue
+        classes.append({'subject': timetabledclass.subject.subcode,
+                        'time': timetabledclass.timeslot.day + " " + timetabledclass.timeslot.time,
+                        'tutor': tutors.get(timetabledclass.tutor.id, timetabledclass.tutor.name),
+                        'room': timetabledclass.room.name if timetabledclass.room is not None else None,
+                        'students': [students.get(student.id, student.name) for student in timetabledclass.students]})
+    return classes
 
 def get_all_rolls():
     path_to_file = app.config['UPLOAD_FOLDER'] + '/rolls' + time.strftime("%Y-%m-%d_%H%M%S") + '.docx'
@@ -903,6 +1683,13 @@ def init_db_timetable():
         db.session.add(timetableadmin)
         db.session.commit()
 
+def init_db_solversettings():
+    for stage in SOLVER_STAGES:
+        for name, default in appcfg["solver_settings"][stage].items():
+            if Admin.query.filter_by(key=stage + '_' + name).first() is None:
+                db.session.add(Admin(key=stage + '_' + name, value='' if default is None else str(default)))
+    db.session.commit()
+
 def init_db_users():
     if User.query.filter_by(username='admin').first() is None:
         user = User.create(username='admin', password=appcfg['adminpassword'])
@@ -923,7 +1710,8 @@ def init_db_college():
 def init_db_timeslots():
     timeslots = appcfg['timeslots']
     for timeslot in timeslots:
-        if Timeslot.get(day = timeslot[0].split(' ')[0], time = timeslot[0].split(' ')[1]) is None:
+        if Timeslot.get(timetable=get_current_timetable_id(), day=timeslot[0].split(' ')[0],
+                        time=timeslot[0].split(' ')[1]) is None:
             if timeslot[1] == False:
                 Timeslot.create(day = timeslot[0].split(' ')[0], time = timeslot[0].split(' ')[1], preferredtime = False)
             else:
@@ -953,6 +1741,8 @@ def init_db():
    init_db_timeslots()
    print("Creating Rooms")
    init_db_rooms()
+   print("Creating Solver Settings")
+   init_db_solversettings()
 
 def change_preferred_timeslot(id, preferred):
     timeslot = Timeslot.query.get(id)
@@ -1,8 +1,13 @@
 import unittest
+from unittest import mock
 import abc
+import os
+import tempfile
+from time import sleep
 from pandas import DataFrame
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
 from attendance import app
 from attendance.models import *
 from attendance.views import *
@@ -64,14 +69,15 @@ class StudentTests(BaseTest):
         self.assertEqual(Student.get(name="Justin Smallwood"), None)
 
     def test_populate_students(self):
-        data = DataFrame(columns=['Given Name', 'Family Name', 'Student Id', 'Component Study Package Code',
-                                  'Component Study Package Title', 'Study Period'])
-        data['Given Name'] = ['Justin', 'Jemima']
-        data['Family Name'] = ['Smallwood', 'Capper']
-        data['Student Id'] = ['542066', '356351']
-        data['Component Study Package Code'] = ['ECON10005', 'ECON20003']
-        data['Component Study Package Title'] = ['Quantitative Methods 1', 'Quantitative Methods 2']
-        data['Study Period'] = [get_current_studyperiod() for i in range(2)]
+        schema = appcfg["enrolment_schema"]
+        data = DataFrame(columns=[schema["student_first_name"], schema["student_last_name"], schema["student_id"],
+                                  schema["subject_code"], schema["subject_name"], schema["study_period"]])
+        data[schema["student_first_name"]] = ['Justin', 'Jemima']
+        data[schema["student_last_name"]] = ['Smallwood', 'Capper']
+        data[schema["student_id"]] = ['542066', '356351']
+        data[schema["subject_code"]] = ['ECON10005', 'ECON20003']
+        data[schema["subject_name"]] = ['Quantitative Methods 1', 'Quantitative Methods 2']
+        data[schema["study_period"]] = [get_current_studyperiod() for i in range(2)]
         populate_students(data)
         student = Student.get(name='Justin Smallwood')
         subject = Subject.get(subcode='ECON10005')
@@ -94,6 +100,54 @@ class StudentTests(BaseTest):
         self.assertIn(subject, student.subjects)
         self.assertIn(student, subject.students)
 
+    def test_populate_students_chunks(self):
+        schema = appcfg["enrolment_schema"]
+        studyperiod = get_current_studyperiod()
+        data = DataFrame({
+            schema["student_first_name"]: ['justin', 'Tom', 'Tom', 'Ann', 'Bob', 'Jo'],
+            schema["student_last_name"]: ['smallwood', 'Cox', 'Cox', 'Lee', 'Ray', 'Kim'],
+            schema["student_id"]: [542066, 1001, 1001, 1002, 'x', 1003],
+            schema["subject_code"]: ['ECON10005', 'ECON10005', 'ECON10005', 'ECON20003', 'ECON20003', 'ECON20003'],
+            schema["subject_name"]: ['Quantitative Methods 1'] * 3 + ['Quantitative Methods 2'] * 3,
+            schema["study_period"]: [studyperiod] * 5 + ['Some other period']
+        })
+        report = populate_students(data, chunksize=2)
+        self.assertEqual((report['rows'], report['imported'], report['skipped']), (6, 4, 2))
+        self.assertEqual((report['students'], report['subjects'], report['enrolments']), (2, 2, 3))
+        self.assertEqual(report['errors'], [{'row': 4, 'message': 'Invalid student id: x'}])
+        self.assertEqual(len(Student.get_all(name='Justin Smallwood')), 1)
+        self.assertEqual([subject.subcode for subject in Student.get(studentcode='1001').subjects], ['ECON10005'])
+        self.assertEqual(len(Subject.get(subcode='ECON20003').students), 1)
+        # Importing the same file again adds nothing
+        report = populate_students(data)
+        self.assertEqual((report['students'], report['subjects'], report['enrolments']), (0, 0, 0))
+
+    def test_import_job(self):
+        schema = appcfg["enrolment_schema"]
+        data = DataFrame({schema["student_first_name"]: ['Tom', 'Ann'], schema["student_last_name"]: ['Cox', 'Lee'],
+                          schema["student_id"]: [1001, 'x'], schema["subject_code"]: ['ECON10005', 'ECON10005'],
+                          schema["subject_name"]: ['Quantitative Methods 1'] * 2,
+                          schema["study_period"]: [get_current_studyperiod()] * 2})
+        paths = []
+        for n in range(2):
+            handle, path = tempfile.mkstemp(suffix='.csv')
+            os.close(handle)
+            data.to_csv(path, index=False)
+            paths.append(path)
+        job, created = prepareimport('students', paths[0], filename='enrolments.csv')
+        self.assertTrue(created)
+        # Imports run one at a time, so this waits for the job to finish
+        import_executor.submit(lambda: None).result()
+        db.session.refresh(job)
+        self.assertEqual(job.status, ImportJob.SUCCEEDED)
+        self.assertEqual((job.processed, job.errors), (2, 1))
+        self.assertIsNotNone(Student.get(studentcode='1001'))
+        # The same file uploaded again is not imported twice
+        duplicate, created = prepareimport('students', paths[1], filename='enrolments.csv')
+        self.assertFalse(created)
+        self.assertEqual(duplicate, job)
+        self.assertFalse(os.path.exists(paths[1]))
+        os.remove(paths[0])
 
 
 class SubjectTests(BaseTest):
@@ -143,6 +197,32 @@ class AdminTests(BaseTest):
         update_studyperiod(studyperiod)
         self.assertEqual(studyperiod, get_current_studyperiod())
 
+    def test_settings_cache(self):
+        queries = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            queries.append(statement)
+
+        year = get_current_year()
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            with app.test_request_context():
+                for n in range(5):
+                    get_current_year(), get_current_studyperiod(), get_current_timetable_id()
+                self.assertEqual(len(queries), 1)
+                # Another worker process changes the year, which this request does not see
+                table = Admin.__table__
+                db.engine.execute(table.update().where(table.c.key == 'currentyear').values(value=str(year + 1)))
+                db.engine.execute(table.update().where(table.c.key == SETTINGS_VERSION_KEY).values(value='100'))
+                self.assertEqual(get_current_year(), year)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+        with app.test_request_context():
+            self.assertEqual(get_current_year(), year + 1)
+            update_studyperiod('Summer')
+            self.assertEqual(get_current_studyperiod(), 'Summer')
+        self.assertEqual(int(Admin.get(key=SETTINGS_VERSION_KEY).value), 101)
+
 
 class TimeslotTests(BaseTest):
     def setUpTestData(self):
@@ -186,34 +266,37 @@ class TimetableTests(BaseTest):
         db.session.commit()
 
     def test_timetable(self):
+        monday = Timeslot.get(day='Monday')
+        tuesday = Timeslot.get(day='Tuesday')
         STUDENTSTEST = ['Justin Smallwood', 'Tom Cox']
         SUBJECTSTEST = ['ECON10005', 'MAST10006']
-        TIMESTEST = ['Monday 7:30pm', 'Tuesday 9:30pm']
-        dayTEST = ['Monday', 'Tuesday']
+        TIMESTEST = [timeslot.day + ' ' + timeslot.time for timeslot in get_all_timeslots()]
+        dayTEST = sorted(set(timeslot.day for timeslot in get_all_timeslots()))
         DAYSTEST = {}
-        DAYSTEST['Monday'] = set(['Monday 7:30pm'])
-        DAYSTEST['Tuesday'] = set(['Tuesday 9:30pm'])
+        for d in dayTEST:
+            DAYSTEST[d] = set(k for k in TIMESTEST if k.startswith(d + ' '))
         TEACHERSTEST = ['Omid Kaveh', 'Jemima Capper']
 
         REPEATSTEST = {}
         REPEATSTEST['ECON10005'] = 1
         REPEATSTEST['MAST10006'] = 1
 
-        maxclasssizeTEST = 400
-        minclasssizeTEST = 1
-        nroomsTEST = 12
+        maxclasssizeTEST = appcfg['max_class_size']
+        minclasssizeTEST = appcfg['min_class_size']
+        nroomsTEST = len(Room.get_all())
         TEACHERMAPPINGTEST = {}
         TEACHERMAPPINGTEST['Omid Kaveh'] = set(['MAST10006'])
         TEACHERMAPPINGTEST['Jemima Capper'] = set(['ECON10005'])
         TUTORAVAILABILITYTEST = {}
-        TUTORAVAILABILITYTEST['Omid Kaveh'] = set(['Monday 7:30pm'])
-        TUTORAVAILABILITYTEST['Jemima Capper'] = set(['Monday 7:30pm', 'Tuesday 9:30pm'])
+        TUTORAVAILABILITYTEST['Omid Kaveh'] = set([monday.day + ' ' + monday.time])
+        TUTORAVAILABILITYTEST['Jemima Capper'] = set([monday.day + ' ' + monday.time,
+                                                      tuesday.day + ' ' + tuesday.time])
         SUBJECTMAPPINGTEST = {}
         SUBJECTMAPPINGTEST['ECON10005'] = set(['Justin Smallwood', 'Tom Cox'])
         SUBJECTMAPPINGTEST['MAST10006'] = set(['Justin Smallwood'])
 
         (STUDENTS, SUBJECTS, TIMES, day, DAYS, TEACHERS, SUBJECTMAPPING, REPEATS, TEACHERMAPPING,
-         TUTORAVAILABILITY, maxclasssize, minclasssize, nrooms, non_preferred_times) = get_timetable_data()
+         TUTORAVAILABILITY, maxclasssize, minclasssize, nrooms) = get_timetable_data()
 
         self.assertCountEqual(STUDENTS, STUDENTSTEST)
         self.assertCountEqual(SUBJECTS, SUBJECTSTEST)
@@ -229,9 +312,354 @@ class TimetableTests(BaseTest):
         self.assertDictEqual(TEACHERMAPPING, TEACHERMAPPINGTEST)
         self.assertDictEqual(TUTORAVAILABILITY, TUTORAVAILABILITYTEST)
 
-        result = runtimetable2(STUDENTS, SUBJECTS, TIMES, day, DAYS, TEACHERS, SUBJECTMAPPING, REPEATS, TEACHERMAPPING,
-                               TUTORAVAILABILITY, maxclasssize, minclasssize, nrooms, non_preferred_times)
-        self.assertEqual(result, 'Optimal')
+        result = solve_timetable(*get_timetable_data(rooms=True))
+        self.assertEqual(result['status'], 'Optimal')
+        classes = {c['subject']: c for c in result['classes']}
+        self.assertCountEqual(classes, SUBJECTSTEST)
+        # Omid Kaveh can only teach on Monday, so Economics moves to Tuesday to avoid Justin Smallwood's clash
+        self.assertEqual(classes['MAST10006']['time'], monday.day + ' ' + monday.time)
+        self.assertEqual(classes['ECON10005']['time'], tuesday.day + ' ' + tuesday.time)
+        self.assertCountEqual(classes['ECON10005']['students'], STUDENTSTEST)
+        self.assertTrue(all(c['room'] is not None for c in result['classes']))
+
+    def test_local_search(self):
+        result = solve_first_stage_local_search(*get_timetable_data(rooms=True), settings={'timelimit': 5})
+        self.assertEqual(result['status'], 'Feasible')
+        # Justin Smallwood takes both subjects, so Economics moves to Tuesday to avoid the clash
+        times = {j: k for (j, k, m) in result['classstudents']}
+        self.assertTrue(times['MAST10006'].startswith('Monday'))
+        self.assertTrue(times['ECON10005'].startswith('Tuesday'))
+        self.assertEqual(count_clashes(result['classstudents']), 0)
+
+    def test_lns(self):
+        data = get_timetable_data(rooms=True)
+        clashing = [{'subject': 'MAST10006', 'time': 'Monday 17:30', 'tutor': 'Omid Kaveh',
+                     'students': ['Justin Smallwood']},
+                    {'subject': 'ECON10005', 'time': 'Monday 17:30', 'tutor': 'Jemima Capper',
+                     'students': ['Justin Smallwood', 'Tom Cox']}]
+        result = solve_first_stage_lns(*data, settings={'timelimit': 3}, warmstart=clashing)
+        self.assertGreater(result['stats']['lns']['start'], result['objective'])
+        self.assertEqual(result['status'], 'Feasible')
+        self.assertEqual(count_clashes(result['classstudents']), 0)
+
+    def test_sparse_first_stage(self):
+        (STUDENTS, SUBJECTS, TIMES, day, DAYS, TEACHERS, SUBJECTMAPPING, REPEATS, TEACHERMAPPING, TUTORAVAILABILITY,
+         maxclasssize, minclasssize, ROOMS, PROJECTORS, PROJECTORROOMS, numroomsprojector, NONPREFERREDTIMES,
+         CAPACITIES) = get_timetable_data(rooms=True)
+
+        def build(availability):
+            return build_timetable_model(STUDENTS, TIMES, day, DAYS, TEACHERS, SUBJECTMAPPING, REPEATS, TEACHERMAPPING,
+                                         availability, maxclasssize, minclasssize, ROOMS, PROJECTORS,
+                                         numroomsprojector, NONPREFERREDTIMES)
+
+        model, assign_vars, subject_vars, stats = build(TUTORAVAILABILITY)
+        unavailable = [(j, k, m) for m in TEACHERS for j in TEACHERMAPPING[m] for k in TIMES
+                       if k not in TUTORAVAILABILITY[m]]
+        self.assertGreater(len(unavailable), 0)
+        for (j, k, m) in unavailable:
+            self.assertNotIn((j, k, m), subject_vars)
+            for i in SUBJECTMAPPING[j]:
+                self.assertNotIn((i, j, k, m), assign_vars)
+        # The dense model has a variable for every time and forbids the unavailable ones with constraints instead
+        dense, dense_assign_vars, dense_subject_vars, densestats = build({m: set(TIMES) for m in TEACHERS})
+        for (j, k, m) in unavailable:
+            dense += dense_subject_vars[(j, k, m)] == 0
+        self.assertLess(stats['total'], densestats['total'])
+        sparse = solve_model(model)
+        dense = solve_model(dense)
+        self.assertEqual(sparse['status'], 'Optimal')
+        self.assertEqual(dense['status'], 'Optimal')
+        self.assertAlmostEqual(sparse['objective'], dense['objective'])
+
+    def test_benchmark_formulations(self):
+        standard, tight = benchmark_formulations(*get_timetable_data(rooms=True))
+        self.assertEqual((standard['formulation'], tight['formulation']), ('standard', 'tight'))
+        self.assertEqual(standard['status'], 'Optimal')
+        self.assertEqual(tight['status'], 'Optimal')
+        self.assertAlmostEqual(standard['objective'], tight['objective'])
+        # The room benchmark solves the first stage without any solver settings
+        self.assertEqual(len(benchmark_room_allocators(*get_timetable_data(rooms=True))),
+                         len(SOLVER_ENGINES['rooms']))
+
+    def test_cohorts(self):
+        college = College.query.filter_by(name='International House').first().id
+        university = University.query.filter_by(name='University of Melbourne').first().id
+        for name, code in (('Jane Doe', 111111), ('John Doe', 222222)):
+            student = Student.create(name=name, studentcode=code, collegeid=college, universityid=university)
+            student.subjects.append(Subject.get(subcode='MAST10006'))
+            student.subjects.append(Subject.get(subcode='ECON10005'))
+        Subject.get(subcode='ECON10005').update(repeats=2)
+        data = get_timetable_data(rooms=True)
+        results = {}
+        for cohorts in (False, True):
+            with mock.patch.dict(appcfg, {'solver_cohorts': cohorts}):
+                results[cohorts] = solve_first_stage(*data)
+        self.assertEqual(results[True]['stats']['cohorts'], 2)
+        self.assertEqual(results[True]['status'], results[False]['status'])
+        self.assertEqual(count_clashes(results[True]['classstudents']), count_clashes(results[False]['classstudents']))
+        self.assertEqual(results[True]['objective'], results[False]['objective'])
+
+        # Students placed with more clashes than the cohort model counted are scored as placed
+        def clashing(cohorts, assign_vars, running):
+            return {(j, k, m): sorted(data[6][j]) if k.startswith('Monday') else [] for (j, k, m) in running}
+        with mock.patch.dict(appcfg, {'solver_cohorts': True}):
+            with mock.patch('attendance.helpers.expand_cohorts', side_effect=clashing):
+                result = solve_first_stage(*data)
+        self.assertEqual(result['status'], 'Feasible')
+        self.assertEqual(result['objective'], timetable_objective(result['classstudents'], *data[2:5], data[13],
+                                                                  data[15], data[16]))
+        self.assertGreater(result['objective'], result['stats']['cohortobjective'])
+
+    def test_first_stage_without_settings(self):
+        # The benchmark commands solve with no settings at all
+        result = solve_first_stage(*get_timetable_data(rooms=True))
+        self.assertEqual(result['status'], 'Optimal')
+        self.assertEqual(count_clashes(result['classstudents']), 0)
+
+    def test_problem_instance_names(self):
+        # A second Tom Cox must not be merged with the first
+        student = Student.create(name='Tom Cox', studentcode=777777,
+                                 collegeid=College.query.filter_by(name='International House').first().id,
+                                 universityid=University.query.filter_by(name='University of Melbourne').first().id)
+        student.subjects.append(Subject.get(subcode='MAST10006'))
+        db.session.commit()
+        instance = get_problem_instance()
+        self.assertCountEqual(instance.students, ['Justin Smallwood', 'Tom Cox (123595)', 'Tom Cox (777777)'])
+        self.assertIn(student.id, instance.database_ids('students', ['Tom Cox (777777)']))
+        data = instance.to_timetable_data()
+        self.assertEqual(data[6]['MAST10006'], set(['Justin Smallwood', 'Tom Cox (777777)']))
+        # The form without rooms is labelled the same way
+        self.assertEqual(get_timetable_data(), data[:12] + (len(data[12]),))
+        add_solution_to_timetable([{'subject': 'MAST10006', 'time': data[2][0], 'tutor': 'Omid Kaveh',
+                                    'room': data[12][0], 'students': ['Tom Cox (777777)']}])
+        self.assertEqual(get_timetable_solution(get_current_timetable_id())[0]['students'], ['Tom Cox (777777)'])
+        self.assertEqual(student.timetabledclasses[0].subject.subcode, 'MAST10006')
+
+    def test_add_solution_with_shared_names(self):
+        # Two students called Tom Cox in different subjects each get their own class back
+        other = Student.create(name='Tom Cox', studentcode=777777,
+                               collegeid=College.query.filter_by(name='International House').first().id,
+                               universityid=University.query.filter_by(name='University of Melbourne').first().id)
+        other.subjects.append(Subject.get(subcode='MAST10006'))
+        db.session.commit()
+        data = get_timetable_data(rooms=True)
+        self.assertEqual(data[6]['ECON10005'], set(['Justin Smallwood', 'Tom Cox (123595)']))
+        self.assertEqual(data[6]['MAST10006'], set(['Justin Smallwood', 'Tom Cox (777777)']))
+        add_solution_to_timetable([{'subject': 'ECON10005', 'time': data[2][0], 'tutor': 'Jemima Capper',
+                                    'room': data[12][0], 'students': ['Tom Cox (123595)']},
+                                   {'subject': 'MAST10006', 'time': data[2][1], 'tutor': 'Omid Kaveh',
+                                    'room': data[12][0], 'students': ['Tom Cox (777777)']}])
+        first = Student.get(studentcode='123595')
+        self.assertEqual([c.subject.subcode for c in first.timetabledclasses], ['ECON10005'])
+        self.assertEqual([c.subject.subcode for c in other.timetabledclasses], ['MAST10006'])
+
+    def count_instance_queries(self):
+        queries = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            queries.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            instance = get_problem_instance()
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+        return instance, len(queries)
+
+    def test_problem_instance_queries(self):
+        instance, queries = self.count_instance_queries()
+        self.assertEqual(queries, 8)
+        for n in range(20):
+            student = Student.create(name='Student {}'.format(n), studentcode=n,
+                                     collegeid=College.query.filter_by(name='International House').first().id,
+                                     universityid=University.query.filter_by(name='University of Melbourne').first().id)
+            student.subjects.append(Subject.get(subcode='ECON10005'))
+        db.session.commit()
+        instance, queries = self.count_instance_queries()
+        self.assertEqual(queries, 8)
+        self.assertEqual(len(instance.students), 22)
+
+    def test_add_solution_to_timetable(self):
+        data = get_timetable_data(rooms=True)
+        classes = [{'subject': 'MAST10006', 'time': data[2][0], 'tutor': 'Omid Kaveh', 'room': data[12][0],
+                    'students': ['Justin Smallwood']},
+                   {'subject': 'ECON10005', 'time': data[2][1], 'tutor': 'Jemima Capper', 'room': data[12][0],
+                    'students': ['Justin Smallwood', 'Tom Cox']}]
+        # Nothing is written if any of the classes cannot be
+        self.assertRaises(KeyError, add_solution_to_timetable, classes + [dict(classes[0], students=['Nobody'])])
+        self.assertEqual(TimetabledClass.query.count(), 0)
+        report = add_solution_to_timetable(classes)
+        self.assertEqual((report['classes'], report['students']), (2, 3))
+        self.assertCountEqual([(c['subject'], c['time'], sorted(c['students'])) for c in
+                               get_timetable_solution(get_current_timetable_id())],
+                              [(c['subject'], c['time'], sorted(c['students'])) for c in classes])
+
+    def test_feasibility_check(self):
+        data = list(get_timetable_data(rooms=True))
+        self.assertTrue(check_timetable_feasibility(*data)['feasible'])
+        data[10] = 1
+        errors = check_timetable_feasibility(*data)['errors']
+        self.assertEqual([(error['check'], error['subject']) for error in errors], [('maxclasssize', 'ECON10005')])
+
+        # Omid Kaveh is only available at one time
+        Subject.get(subcode='MAST10006').update(repeats=2)
+        report = check_timetable_feasibility(*get_timetable_data(rooms=True))
+        self.assertFalse(report['feasible'])
+        self.assertIn('tutoravailability', [error['check'] for error in report['errors']])
+        job, created = preparetimetable()
+        self.assertTrue(created)
+        self.assertEqual(job.status, SolverJob.FAILED)
+        self.assertIn('Omid Kaveh', job.message)
+
+    def test_scenarios(self):
+        data = get_timetable_data(rooms=True)
+        instance = serialize_timetable_data(data)
+        scenarios = parse_scenarios([{'name': 'Default'},
+                                     {'name': 'No late classes', 'weights': {'clash': 0, 'nonpreferred': 1000}}])
+        self.assertEqual(scenarios[0]['maxclasssize'], appcfg["max_class_size"])
+        self.assertRaises(ValueError, parse_scenarios, [{'weights': {'lunch': 1}}])
+        self.assertRaises(ValueError, parse_scenarios, [{'weights': {'clash': -1}}])
+        results = [solve_scenario(instance, scenario, get_solver_settings()) for scenario in scenarios]
+        for result in results:
+            self.assertEqual(result['metrics']['clashes'], 0)
+        metrics = results[1]['metrics']
+        self.assertEqual(metrics['objective'], 1000 * metrics['nonpreferred'] + 500 * metrics['tutordays'])
+        self.assertEqual(results[0]['metrics']['objective'], results[0]['objective'])
+        self.assertEqual(Timetable.query.count(), 1)
+
+        previous = get_current_timetable_id()
+        timetable = create_timetable_version('No late classes', results[1]['classes'])
+        self.assertEqual(get_current_timetable_id(), timetable.id)
+        self.assertEqual(len(get_timetable_solution(timetable.id)), 2)
+        self.assertEqual(len(get_timetable_solution(previous)), 0)
+        # The new timetable has its own copy of the timeslots and availabilities so it can be solved again
+        self.assertCountEqual(get_timetable_data(rooms=True)[2], data[2])
+        self.assertEqual(len(Timeslot.query.filter_by(timetable=timetable.id).all()), len(data[2]))
+
+    def test_timetable_staging(self):
+        data = get_timetable_data(rooms=True)
+        classes = [{'subject': 'MAST10006', 'time': data[2][0], 'tutor': 'Omid Kaveh', 'room': data[12][0],
+                    'students': ['Justin Smallwood']}]
+        previous = get_current_timetable_id()
+        # A failed write leaves the current timetable where it was and nothing behind
+        self.assertRaises(KeyError, create_timetable_version, 'Broken', [dict(classes[0], students=['Nobody'])])
+        self.assertEqual(get_current_timetable_id(), previous)
+        self.assertEqual(Timetable.query.count(), 1)
+
+        staging = stage_timetable_version('Staging')
+        self.assertEqual(get_current_timetable_id(), previous)
+        self.assertNotIn(staging, Timetable.get_all())
+        self.assertEqual(collect_staging_timetables(), 0)
+        staging.update(created=datetime.datetime.now() - datetime.timedelta(days=1))
+        self.assertEqual(collect_staging_timetables(), 1)
+        self.assertIsNone(Timetable.query.get(staging.id))
+
+        # A queued job may be about to write a staging timetable made after it, so that one is kept
+        job = SolverJob.create(timetable=previous)
+        staging = stage_timetable_version('Staging')
+        staging.update(created=datetime.datetime.now() - datetime.timedelta(days=1))
+        job.update(created=staging.created - datetime.timedelta(minutes=1))
+        self.assertEqual(collect_staging_timetables(), 0)
+        job.finish(SolverJob.SUCCEEDED)
+        self.assertEqual(collect_staging_timetables(), 1)
+        self.assertIsNone(Timetable.query.get(staging.id))
+
+        timetable = create_timetable_version('Published', classes)
+        self.assertEqual(get_current_timetable_id(), timetable.id)
+        self.assertEqual(timetable.status, Timetable.PUBLISHED)
+        self.assertEqual(timetable.writeback['classes'], 1)
+        self.assertEqual(len(get_timetable_solution(previous)), 0)
+
+    def test_timetable_versions(self):
+        self.app.post('/login', data={'user_id': 'admin', 'password': appcfg['adminpassword']})
+        previous = get_current_timetable_id()
+        count = len(Timeslot.get_all())
+        staging = stage_timetable_version('Next version').id
+        # Only the current timetable's timeslots and the published timetables are listed
+        timeslots = json.loads(self.app.get('/viewtimeslotsajax').get_data(as_text=True))['data']
+        self.assertEqual(len(timeslots), count)
+        self.assertTrue(all(timeslot['timetable'] == previous for timeslot in timeslots))
+        self.assertNotIn('Next version', self.app.get('/admin').get_data(as_text=True))
+        self.assertNotIn('Next version', self.app.get('/runtimetabler').get_data(as_text=True))
+
+        publish_timetable(Timetable.query.get(staging))
+        timeslots = json.loads(self.app.get('/viewtimeslotsajax').get_data(as_text=True))['data']
+        self.assertEqual(len(timeslots), count)
+        self.assertTrue(all(timeslot['timetable'] == staging for timeslot in timeslots))
+        self.assertEqual(get_all_timeslots(), Timeslot.get_all(timetable=staging))
+        self.assertEqual(len(Timeslot.get_all()), 2 * count)
+        for page in ['/admin', '/runtimetabler']:
+            html = self.app.get(page).get_data(as_text=True)
+            self.assertIn('Next version', html)
+            self.assertIn('default', html)
+
+
+class SolverJobTests(BaseTest):
+    def setUpTestData(self):
+        self.job = SolverJob.create(timetable=get_current_timetable_id())
+
+    def test_get_active(self):
+        self.assertEqual(SolverJob.get_active(get_current_timetable_id()), self.job)
+        self.job.start()
+        self.assertEqual(SolverJob.get_active(get_current_timetable_id()), self.job)
+        self.job.finish(SolverJob.SUCCEEDED)
+        self.assertIsNone(SolverJob.get_active(get_current_timetable_id()))
+
+    def test_one_active_job_per_timetable(self):
+        job, created = preparetimetable()
+        self.assertFalse(created)
+        self.assertEqual(job, self.job)
+        self.assertEqual(SolverJob.query.count(), 1)
+        # Two requests that both pass the check still cannot both queue a job
+        with mock.patch.object(SolverJob, 'get_active', side_effect=[None, self.job]):
+            job, created = preparetimetable()
+        self.assertFalse(created)
+        self.assertEqual(job, self.job)
+        self.assertEqual(SolverJob.query.count(), 1)
+
+    def test_failed_preparation(self):
+        self.job.finish(SolverJob.SUCCEEDED)
+        with mock.patch.object(attendance.models, 'get_timetable_data', side_effect=ValueError("Bad data")):
+            job, created = preparetimetable()
+        self.assertTrue(created)
+        self.assertEqual(job.status, SolverJob.FAILED)
+        self.assertIn("Bad data", job.message)
+        self.assertIsNone(SolverJob.get_active(get_current_timetable_id()))
+
+    def test_cancel(self):
+        self.assertTrue(self.job.cancel())
+        self.assertTrue(self.job.is_cancelled())
+        self.assertIsNotNone(self.job.finished)
+        self.assertFalse(self.job.cancel())
+        self.assertEqual(self.job.to_dict()['status'], SolverJob.CANCELLED)
+
+    def test_solver_settings(self):
+        self.assertEqual(get_solver_settings()['timetable'],
+                         {'timelimit': None, 'gap': None, 'threads': None, 'acceptfeasible': False,
+                          'engine': 'milp'})
+        update_solver_settings({'timetable_timelimit': '600', 'timetable_gap': '0.01', 'timetable_threads': '2',
+                                'timetable_acceptfeasible': 'on', 'rooms_timelimit': '60'})
+        settings = get_solver_settings()
+        self.assertEqual(settings['timetable'], {'timelimit': 600, 'gap': 0.01, 'threads': 2, 'acceptfeasible': True,
+                                                 'engine': 'milp'})
+        self.assertEqual(settings['rooms'], {'timelimit': 60, 'gap': None, 'threads': None, 'acceptfeasible': False,
+                                             'engine': 'milp'})
+        with self.assertRaises(ValueError):
+            update_solver_settings({'timetable_timelimit': '-1'})
+        with self.assertRaises(ValueError):
+            update_solver_settings({'rooms_engine': 'guess'})
+        self.assertEqual(get_solver_settings()['timetable']['timelimit'], 600)
+
+
+def fake_solver_worker(instance, settings, warmstart, fixed, memorylimit, conn, configuration=None):
+    '''
+    Stand in for solver_worker that takes the result straight from the configuration, after an optional delay.
+    '''
+    os.setpgrp()
+    sleep(configuration.get('delay', 0))
+    conn.send({'status': configuration['status'], 'objective': configuration['objective'], 'stats': {},
+               'classes': [], 'processes': configuration['solver_processes']})
+    conn.close()
 
 
 class TestHelpers(BaseTest):
@@ -248,6 +676,168 @@ class TestHelpers(BaseTest):
         test = allowed_file(filename)
         self.assertEqual(test, True)
 
+    def test_serialize_timetable_data(self):
+        data = (['Justin Smallwood'], ['ECON10005'], ['Monday 19:30'], ['Monday'], {'Monday': set(['Monday 19:30'])},
+                ['Omid Kaveh'], {'ECON10005': set(['Justin Smallwood'])}, {'ECON10005': 1},
+                {'Omid Kaveh': set(['ECON10005'])}, {'Omid Kaveh': set(['Monday 19:30'])}, 16, 0, ['GHB1'], [],
+                ['GHB1'], 1, [], {'GHB1': 15})
+        instance = serialize_timetable_data(data)
+        self.assertEqual(json.loads(json.dumps(instance)), instance)
+        self.assertEqual(deserialize_timetable_data(instance), data)
+
+    def test_problem_instance(self):
+        data = (['Justin Smallwood', 'Tom Cox'], ['ECON10005', 'MAST10006'], ['Monday 19:30', 'Tuesday 19:30'],
+                ['Monday', 'Tuesday'], {'Monday': set(['Monday 19:30']), 'Tuesday': set(['Tuesday 19:30'])},
+                ['Omid Kaveh'], {'ECON10005': set(['Justin Smallwood', 'Tom Cox']), 'MAST10006': set(['Tom Cox'])},
+                {'ECON10005': 2, 'MAST10006': 1}, {'Omid Kaveh': set(['ECON10005', 'MAST10006'])},
+                {'Omid Kaveh': set(['Monday 19:30'])}, 16, 0, ['GHB1'], ['MAST10006'], [], 0, ['Tuesday 19:30'],
+                {'GHB1': 15})
+        instance = ProblemInstance.from_timetable_data(data)
+        self.assertEqual(instance.to_timetable_data(), data)
+        self.assertEqual(list(instance.enrolments()), [2, 1])
+        self.assertEqual(list(instance.student_loads()), [1, 2])
+        self.assertEqual(list(instance.tutor_loads()), [3])
+        self.assertEqual(list(instance.available_tutors()), [1, 0])
+        self.assertEqual(list(instance.students_of(instance.index('subjects', 'MAST10006'))), [1])
+        checks = [error['check'] for error in check_problem_instance(instance)['errors']]
+        self.assertEqual(checks, ['tutoravailability', 'tutorload', 'roomtimes'])
+
+    def test_find_unchanged(self):
+        data = (['Justin Smallwood', 'Jane Doe'], ['ECON10005', 'MAST10006'], ['Monday 19:30'], ['Monday'],
+                {'Monday': set(['Monday 19:30'])}, ['Omid Kaveh', 'Jack Smith'],
+                {'ECON10005': set(['Justin Smallwood']), 'MAST10006': set(['Jane Doe'])},
+                {'ECON10005': 1, 'MAST10006': 1}, {'Omid Kaveh': set(['ECON10005']), 'Jack Smith': set(['MAST10006'])},
+                {'Omid Kaveh': set(['Monday 19:30']), 'Jack Smith': set(['Monday 19:30'])}, 16, 0, ['GHB1'], [],
+                ['GHB1'], 1, [], {'GHB1': 15})
+        previous = serialize_timetable_data(data)
+        changed = list(data)
+        changed[7] = {'ECON10005': 2, 'MAST10006': 1}
+        unchanged = find_unchanged(previous, tuple(changed))
+        self.assertEqual(unchanged['subjects'], ['MAST10006'])
+        self.assertEqual(unchanged['students'], ['Jane Doe'])
+        changed[2] = ['Monday 19:30', 'Monday 20:30']
+        self.assertEqual(find_unchanged(previous, tuple(changed))['subjects'], [])
+
+    def test_decomposition(self):
+        data = (['Justin Smallwood', 'Jane Doe'], ['ECON10005', 'MAST10006'], ['Monday 19:30', 'Tuesday 19:30'],
+                ['Monday', 'Tuesday'], {'Monday': set(['Monday 19:30']), 'Tuesday': set(['Tuesday 19:30'])},
+                ['Omid Kaveh', 'Jack Smith'], {'ECON10005': set(['Justin Smallwood']), 'MAST10006': set(['Jane Doe'])},
+                {'ECON10005': 1, 'MAST10006': 1}, {'Omid Kaveh': set(['ECON10005']), 'Jack Smith': set(['MAST10006'])},
+                {'Omid Kaveh': set(['Monday 19:30', 'Tuesday 19:30']), 'Jack Smith': set(['Monday 19:30'])}, 16, 0,
+                ['GHB1', 'GHB2'], [], ['GHB1'], 1, ['Tuesday 19:30'], {'GHB1': 15, 'GHB2': 15})
+        self.assertCountEqual(find_independent_components(*data), [set(['ECON10005']), set(['MAST10006'])])
+        # With one room both tutors could need it on Monday, so the subjects have to be solved together
+        onlyroom = data[:12] + (['GHB1'],) + data[13:17] + ({'GHB1': 15},)
+        self.assertEqual(find_independent_components(*onlyroom), [set(['ECON10005', 'MAST10006'])])
+        result = solve_first_stage_decomposed(data, processes=2)
+        self.assertEqual(result['status'], 'Optimal')
+        self.assertEqual(result['stats']['components'], 2)
+        self.assertEqual(result['objective'], solve_first_stage(*data)['objective'])
+        self.assertEqual(sorted((j, k, sorted(students)) for (j, k, m), students in result['classstudents'].items()),
+                         [('ECON10005', 'Monday 19:30', ['Justin Smallwood']),
+                          ('MAST10006', 'Monday 19:30', ['Jane Doe'])])
+        # A tutor without any availability rows is grouped like any other, but their subject cannot run
+        unavailable = ((data[0], data[1] + ['FINA10001']) + data[2:5] +
+                       (data[5] + ['Jo Lee'], dict(data[6], FINA10001=set(['Jane Doe'])), dict(data[7], FINA10001=1),
+                        dict(data[8], **{'Jo Lee': set(['FINA10001'])})) + data[9:])
+        self.assertCountEqual(find_independent_components(*unavailable),
+                              [set(['ECON10005']), set(['MAST10006', 'FINA10001'])])
+        self.assertEqual(solve_first_stage_decomposed(unavailable, processes=2)['status'], 'Infeasible')
+
+    def test_allocate_rooms_heuristic(self):
+        TEACHERS = ['Omid Kaveh', 'Jack Smith', 'Jo Lee']
+        TEACHERMAPPING = {'Omid Kaveh': set(['ECON10005']), 'Jack Smith': set(['MAST10006']),
+                          'Jo Lee': set(['FINA10001'])}
+        ROOMS = ['GHB1', 'GHB2', 'GHB3']
+        CAPACITIES = {'GHB1': 10, 'GHB2': 20, 'GHB3': 15}
+        classpop = {('ECON10005', 'Monday 19:30', 'Omid Kaveh'): 18, ('MAST10006', 'Monday 19:30', 'Jack Smith'): 8,
+                    ('FINA10001', 'Monday 19:30', 'Jo Lee'): 12, ('ECON10005', 'Tuesday 19:30', 'Omid Kaveh'): 5,
+                    ('MAST10006', 'Tuesday 19:30', 'Jack Smith'): 9}
+        heuristic = allocate_rooms_heuristic(TEACHERS, ROOMS, ['MAST10006'], ['GHB1'], CAPACITIES, classpop)
+        self.assertEqual(heuristic['status'], 'Feasible')
+        # Every class gets a room and no room has two classes at once
+        self.assertCountEqual(heuristic['allocation'], classpop)
+        self.assertTrue(all(n in ROOMS for n in heuristic['allocation'].values()))
+        self.assertEqual(len(set((k, n) for (j, k, m), n in heuristic['allocation'].items())), len(classpop))
+        objective = room_allocation_objective(heuristic['allocation'], ['MAST10006'], ['GHB1'], CAPACITIES, classpop)
+        milp = allocate_rooms(TEACHERS, TEACHERMAPPING, ROOMS, ['MAST10006'], ['GHB1'], CAPACITIES, classpop,
+                              {'engine': 'milp'})
+        self.assertEqual(milp['status'], 'Optimal')
+        self.assertGreaterEqual(objective, room_allocation_objective(milp['allocation'], ['MAST10006'], ['GHB1'],
+                                                                     CAPACITIES, classpop))
+        # More classes at a time than there are rooms cannot be allocated
+        crowded = dict(classpop)
+        crowded[('FINA10001', 'Monday 19:30', 'Omid Kaveh')] = 1
+        self.assertEqual(allocate_rooms_heuristic(TEACHERS, ROOMS, ['MAST10006'], ['GHB1'], CAPACITIES,
+                                                  crowded)['status'], 'Infeasible')
+
+    def test_portfolio(self):
+        configurations = [{'name': 'slow', 'status': 'Optimal', 'objective': 1, 'delay': 60},
+                          {'name': 'feasible', 'status': 'Feasible', 'objective': 7},
+                          {'name': 'fast', 'status': 'Optimal', 'objective': 5, 'delay': 0.5}]
+        with mock.patch.object(attendance.helpers, 'solver_worker', fake_solver_worker):
+            result = solve_portfolio({}, configurations)
+            # The first optimal result wins and the slow worker is killed rather than waited for
+            self.assertEqual(result['stats']['portfolio']['winner'], 'fast')
+            self.assertEqual(result['stats']['portfolio']['slow']['status'], 'Stopped')
+            self.assertLess(result['stats']['portfolio']['fast']['time'], 30)
+            self.assertEqual(multiprocessing.active_children(), [])
+            self.assertEqual(result['processes'], max(1, (os.cpu_count() or 1) // 3))
+            # Without an optimal result the best feasible one is used
+            result = solve_portfolio({}, [{'name': 'worse', 'status': 'Feasible', 'objective': 9},
+                                          {'name': 'better', 'status': 'Feasible', 'objective': 3},
+                                          {'name': 'failed', 'status': 'Failed', 'objective': None}])
+            self.assertEqual(result['stats']['portfolio']['winner'], 'better')
+
+    def test_solver_cache_key(self):
+        data = (['Justin Smallwood', 'Jane Doe'], ['ECON10005'], ['Monday 19:30'], ['Monday'],
+                {'Monday': set(['Monday 19:30'])}, ['Omid Kaveh'], {'ECON10005': set(['Justin Smallwood', 'Jane Doe'])},
+                {'ECON10005': 1}, {'Omid Kaveh': set(['ECON10005'])}, {'Omid Kaveh': set(['Monday 19:30'])}, 16, 0,
+                ['GHB1'], [], ['GHB1'], 1, [], {'GHB1': 15})
+        reordered = (['Jane Doe', 'Justin Smallwood'],) + data[1:]
+        self.assertEqual(solver_cache_key(data, 'all'), solver_cache_key(reordered, 'all'))
+        self.assertNotEqual(solver_cache_key(data, 'all'), solver_cache_key(data, 'timetable'))
+        self.assertNotEqual(solver_cache_key(data, 'all'), solver_cache_key(data[:10] + (15,) + data[11:], 'all'))
+        key = solver_cache_key(data, 'all')
+        for name, value in (('solver_tight_formulation', not appcfg.get('solver_tight_formulation')),
+                            ('max_class_size', appcfg['max_class_size'] + 1)):
+            with mock.patch.dict(appcfg, {name: value}):
+                self.assertNotEqual(solver_cache_key(data, 'all'), key)
+        self.assertNotEqual(solver_cache_key(data, 'all', {'timelimit': 60}),
+                            solver_cache_key(data, 'all', {'timelimit': 600}))
+        with mock.patch.dict(appcfg, {'solver_cache_dir': tempfile.mkdtemp()}):
+            # A timetable that was only feasible when the time limit ran out is not kept
+            write_solver_cache('feasible', 'result', {'status': 'Feasible'})
+            self.assertIsNone(read_solver_cache('feasible', 'result'))
+            write_solver_cache('optimal', 'result', {'status': 'Optimal'})
+            self.assertEqual(read_solver_cache('optimal', 'result'), {'status': 'Optimal'})
+            # A first stage solve only leaves its result in the cache
+            with mock.patch.dict(appcfg, {'solver_cache': True}):
+                result = solve_first_stage(*data)
+                key = solver_cache_key(data, 'timetable', None)
+                self.assertEqual(os.listdir(solver_cache_path(key)), ['firststage.json'])
+                self.assertEqual(solve_first_stage(*data)['objective'], result['objective'])
+            shutil.rmtree(appcfg['solver_cache_dir'])
+
+    def test_group_student_cohorts(self):
+        cohorts = group_student_cohorts(['Justin Smallwood', 'Omid Kaveh', 'Jane Doe'],
+                                        {'ECON10005': set(['Justin Smallwood', 'Omid Kaveh', 'Jane Doe']),
+                                         'MAST10006': set(['Justin Smallwood', 'Omid Kaveh'])})
+        self.assertEqual(sorted(cohorts.values()), [['Jane Doe'], ['Justin Smallwood', 'Omid Kaveh']])
+
+    def test_section_students(self):
+        students = set(['Justin Smallwood', 'Omid Kaveh', 'Jane Doe'])
+        running = [('ECON10005', 'Monday 7:30pm', 'Jemima Capper'), ('FINA10001', 'Monday 7:30pm', 'Omid Kaveh'),
+                   ('MAST10006', 'Monday 7:30pm', 'Tom Cox'), ('MAST10006', 'Tuesday 7:30pm', 'Tom Cox')]
+        sections = section_students({'ECON10005': students, 'FINA10001': set(['Tom Cox']),
+                                     'MAST10006': students | set(['Tom Cox'])}, running, 3, 0)
+        # Everyone has a class on Monday but only three fit in the Tuesday class
+        self.assertEqual(sections['clashes'], 1)
+        self.assertEqual(len(sections['classstudents'][running[2]]), 1)
+        self.assertEqual(len(sections['classstudents'][running[3]]), 3)
+        self.assertIsNone(assign_sections(sorted(students), ['Monday', 'Tuesday'],
+                                          {i: {'Monday': 0, 'Tuesday': 0} for i in students}, 2, 3))
+
 
 class TestViews(BaseTest):
     def setUpTestData(self):
@@ -85,42 +85,51 @@ def logout():
 def uploadstudentdata():
     if request.method == 'POST':
         try:
-            df = upload_and_return_df(request.files['file'])
-            populate_students(df)
-            return redirect("/students")
+            job, msg = upload_and_queue_import('students', request.files['file'])
+            return render_template('uploadstudentdata.html', msg=msg, job=job)
         except PermissionError as e:
             app.logger.error(e)
             return redirect('/uploadstudentdata')
-
-    # msg = "Completed Successfully"
-    # except:
-    #    msg = "There was an error with the upload, please try again"
-        # Redirect the user to the uploaded_file route, which
-        # will basicaly show on the browser the uploaded file
-
     else:
         return render_template('/uploadstudentdata.html')
 
 
-def upload_and_return_df(file):
+def upload_and_queue_import(kind, file):
+    '''
+    Save an uploaded file and queue it to be imported in the background.
+
+    :param kind: One of ImportJob.KINDS.
+    :param file: The uploaded file.
+    :return: A tuple of the ImportJob as a dictionary, or None if the file was not accepted, and a message for the
+             upload page.
+    '''
     path_to_file = upload(file)
-    if os.path.splitext(path_to_file)[1] == ".csv":
-        return read_csv(path_to_file)
-    else:
-        return read_excel(path_to_file)
+    if path_to_file is None:
+        return None, "Only .xls, .xlsx and .csv files can be uploaded"
+    job, created = prepareimport(kind, path_to_file, filename=file.filename,
+                                 force=request.form.get('force') is not None)
+    if created:
+        return job.to_dict(), "Upload received, importing in the background"
+    return job.to_dict(), "This file has already been uploaded on {}. Tick 'Import again' to import it anyway".format(
+        convert_datetime_to_string(job.created))
 
 
 @app.route('/uploadtimetableclasslists', methods=['GET', 'POST'])
 @admin_permission.require()
 def uploadtimetableclasslists():
     if request.method == 'POST':
-        df = upload_and_return_df(request.files['file'])
-        populate_timetabledata(df)
-        msg = "Completed Successfully"
+        job, msg = upload_and_queue_import('classlists', request.files['file'])
+        return render_template("uploadtimetabledata.html", msg=msg, job=job)
     return render_template("uploadtimetabledata.html")
 
 
-
+@app.route('/importjobstatusajax?jobid=<jobid>')
+@admin_permission.require()
+def import_job_status_ajax(jobid):
+    job = ImportJob.query.get(int(jobid))
+    if job is None:
+        return json.dumps({'error': 'No such import job'}), 404
+    return json.dumps(job.to_dict())
 
 
 @app.route('/currentuser')
@@ -160,30 +169,37 @@ def updatetimetable():
     return redirect('/admin')
 
 
+@app.route('/updatesolversettings', methods=['POST'])
+@admin_permission.require()
+def updatesolversettings():
+    try:
+        update_solver_settings(request.form)
+    except ValueError as e:
+        return render_template('admin.html', admin=getadmin(), timetables=Timetable.get_all(),
+                               msg="Solver settings not saved: " + str(e))
+    return redirect('/admin')
+
+
 @app.route('/uploadtutordata', methods=['GET', 'POST'])
 @admin_permission.require()
 def uploadtutordata():
     if request.method == 'GET':
         return render_template('uploadtutordata.html')
     elif request.method == 'POST':
-        df = upload_and_return_df(request.files['file'])
-        populate_tutors(df)
-        # os.remove(filename2)
-        msg = "Completed successfully"
-        return render_template('uploadtutordata.html', msg=msg)
+        job, msg = upload_and_queue_import('tutors', request.files['file'])
+        return render_template('uploadtutordata.html', msg=msg, job=job)
 
 @app.route('/uploadtutoravailabilities', methods=['POST'])
 @admin_permission.require()
 def upload_tutor_availabilities():
-    df = upload_and_return_df(request.files['file'])
-    populate_availabilities(df)
-    msg2 = "Completed Successfully"
-    return render_template("uploadtutordata.html",msg2=msg2)
+    job, msg2 = upload_and_queue_import('availabilities', request.files['file'])
+    return render_template("uploadtutordata.html", msg2=msg2, job=job)
 
 @app.route('/runtimetabler')
 @admin_permission.require()
 def run_timetabler():
-    return render_template("runtimetabler.html", tutors=Tutor.get_all(), timeslots=Timeslot.get_all())
+    return render_template("runtimetabler.html", tutors=Tutor.get_all(), timeslots=get_all_timeslots(),
+                           timetables=Timetable.get_all(), engines=SOLVER_ENGINES['timetable'])
 
 
 @app.route('/addsubjecttotutor?tutorid=<tutorid>', methods=['GET', 'POST'])
@@ -401,7 +417,7 @@ def view_tutors():
 def view_rooms():
     form = JustNameForm()
     if request.method == 'GET':
-        return render_template('viewrooms.html', form=form, rooms=Room.get_all_sorted(), timeslots=Timeslot.get_all())
+        return render_template('viewrooms.html', form=form, rooms=Room.get_all_sorted(), timeslots=get_all_timeslots())
     else:
         if form.validate_on_submit():
             name = form.name.data
@@ -411,7 +427,7 @@ def view_rooms():
                 db.session.commit()
             msg = "Record successfully added"
             return redirect("/rooms")
-        return render_template('viewrooms.html', form=form, rooms=Room.get_all_sorted(), timeslots=Timeslot.get_all())
+        return render_template('viewrooms.html', form=form, rooms=Room.get_all_sorted(), timeslots=get_all_timeslots())
 
 
 @app.route('/addtutorial', methods=['POST'])
@@ -505,14 +521,14 @@ def view_timeslots():
         if form.validate_on_submit():
             day = form.day.data
             time = form.time.data
-            Timeslot.get_or_create(day=day, time=time)
+            Timeslot.get_or_create(timetable=get_current_timetable_id(), day=day, time=time)
         return render_template('viewtimeslots.html', form=form)
 
 
 @app.route('/tutoravailability')
 @admin_permission.require()
 def managetutoravailability():
-    return render_template("tutoravailability.html", timeslots=Timeslot.get_all(), tutors=Tutor.get_all())
+    return render_template("tutoravailability.html", timeslots=get_all_timeslots(), tutors=Tutor.get_all())
 
 
 @app.route('/students', methods=['GET', 'POST'])
@@ -640,8 +656,90 @@ def view_user(username):
 @app.route('/runtimetableprogram', methods=['GET', 'POST'])
 @admin_permission.require()
 def run_timetable_program():
-    preparetimetable()
-    return "Done"
+    warmstart = request.form.get('warmstart')
+    engine = request.form.get('engine') or None
+    if engine is not None and engine not in SOLVER_ENGINES['timetable']:
+        return json.dumps({'error': 'No such timetable engine'}), 400
+    job, created = preparetimetable(warmstart=int(warmstart) if warmstart else None,
+                                    incremental=request.form.get('incremental') == 'true', engine=engine)
+    data = job.to_dict()
+    data['created_now'] = created
+    return json.dumps(data)
+
+
+@app.route('/checkfeasibilityajax')
+@admin_permission.require()
+def check_feasibility_ajax():
+    return json.dumps(check_timetable_feasibility(*get_timetable_data(rooms=True)))
+
+
+@app.route('/solverjobstatusajax?jobid=<jobid>')
+@admin_permission.require()
+def solver_job_status_ajax(jobid):
+    job = SolverJob.query.get(int(jobid))
+    if job is None:
+        return json.dumps({'error': 'No such solver job'}), 404
+    return json.dumps(job.to_dict())
+
+
+@app.route('/cancelsolverjob?jobid=<jobid>', methods=['POST'])
+@admin_permission.require()
+def cancel_solver_job(jobid):
+    job = SolverJob.query.get(int(jobid))
+    if job is None:
+        return json.dumps({'error': 'No such solver job'}), 404
+    cancelled = job.cancel()
+    data = job.to_dict()
+    data['cancelled_now'] = cancelled
+    return json.dumps(data)
+
+
+@app.route('/solverjobsajax')
+@admin_permission.require()
+def solver_jobs_ajax():
+    data = SolverJob.query.filter_by(year=get_current_year(), studyperiod=get_current_studyperiod()).order_by(
+        SolverJob.created.desc()).all()
+    data = json.dumps([job.to_dict() for job in data])
+    return '{ "data" : ' + data + '}'
+
+
+@app.route('/runscenarios', methods=['POST'])
+@admin_permission.require()
+def run_scenarios_program():
+    scenarios = request.get_json(silent=True)
+    if scenarios is None:
+        try:
+            scenarios = json.loads(request.form.get('scenarios') or 'null')
+        except ValueError:
+            return json.dumps({'error': 'Scenarios must be a JSON list'}), 400
+    if isinstance(scenarios, dict):
+        scenarios = scenarios.get('scenarios')
+    try:
+        scenarios = parse_scenarios(scenarios)
+    except ValueError as e:
+        return json.dumps({'error': str(e)}), 400
+    batch = preparescenarios(scenarios)
+    return json.dumps({'batch': batch, 'scenarios': [scenario.to_dict() for scenario in Scenario.get_batch(batch)]})
+
+
+@app.route('/scenariosajax?batch=<batch>')
+@admin_permission.require()
+def scenarios_ajax(batch):
+    data = json.dumps([scenario.to_dict() for scenario in Scenario.get_batch(int(batch))])
+    return '{ "data" : ' + data + '}'
+
+
+@app.route('/commitscenario?scenarioid=<scenarioid>', methods=['POST'])
+@admin_permission.require()
+def commit_scenario(scenarioid):
+    scenario = Scenario.query.get(int(scenarioid))
+    if scenario is None:
+        return json.dumps({'error': 'No such scenario'}), 404
+    try:
+        timetable = scenario.commit(key=request.form.get('key'))
+    except ValueError as e:
+        return json.dumps({'error': str(e)}), 400
+    return json.dumps({'timetable': timetable.id, 'key': timetable.key, 'scenario': scenario.to_dict()})
 
 
 # APP ERROR HANDLERS
@@ -661,7 +759,7 @@ def internal_server_error(error):
 @app.route('/viewtimeslotsajax')
 @admin_permission.require()
 def viewtimeslots_ajax():
-    data = Timeslot.get_all()
+    data = get_all_timeslots()
     data2 = []
     for row in data:
         data2.append(row.__dict__)
@@ -677,7 +775,8 @@ def viewtimeslots_ajax():
 @app.route('/viewtimetableajax')
 @login_required
 def viewtimetable_ajax():
-    data = TimetabledClass.query.filter_by(year=get_current_year(), studyperiod=get_current_studyperiod()).options(
+    data = TimetabledClass.query.filter_by(year=get_current_year(), studyperiod=get_current_studyperiod(),
+                                           timetable=get_current_timetable_id()).options(
         joinedload('tutor'), joinedload('room')).all()
     data2 = []
 
@@ -880,7 +979,7 @@ def num_eligible_subjects_mapped():
 @app.route('/viewclashesajax')
 @admin_permission.require()
 def viewclashreportajax():
-    timeslots = Timeslot.get_all()
+    timeslots = get_all_timeslots()
     clashes = {}
     for timeslot in timeslots:
         clashestimeslot = {}
@@ -8,5 +8,42 @@ migrate = Migrate(app, db)
 manager = Manager(app)
 manager.add_command('db', MigrateCommand)
 
+
+@manager.command
+def benchmark():
+    """Compare the standard and tightened timetabling formulations on the current timetable data"""
+    from attendance.models import get_timetable_data
+    from attendance.helpers import benchmark_formulations
+    results = benchmark_formulations(*get_timetable_data(rooms=True))
+    print("{:<10} {:<12} {:>12} {:>10} {:>12} {:>10} {:>10}".format('Model', 'Status', 'Objective', 'Variables',
+                                                                     'Constraints', 'Build (s)', 'Solve (s)'))
+    for result in results:
+        print("{formulation:<10} {status:<12} {objective:>12} {variables:>10} {constraints:>12} "
+              "{buildtime:>10.1f} {solvetime:>10.1f}".format(**result))
+
+
+@manager.command
+def benchmark_rooms():
+    """Compare the MILP and heuristic room allocation engines on the current timetable data"""
+    from attendance.models import get_timetable_data
+    from attendance.helpers import benchmark_room_allocators
+    results = benchmark_room_allocators(*get_timetable_data(rooms=True))
+    print("{:<10} {:<12} {:>12} {:>10}".format('Engine', 'Status', 'Objective', 'Time (s)'))
+    for result in results:
+        print("{engine:<10} {status:<12} {objective:>12} {time:>10.3f}".format(**result))
+
+
+@manager.command
+def benchmark_pipelines():
+    """Compare the single first stage model with placing classes and sectioning students separately"""
+    from attendance.models import get_timetable_data
+    from attendance.helpers import benchmark_pipelines
+    results = benchmark_pipelines(*get_timetable_data(rooms=True))
+    print("{:<10} {:<12} {:>12} {:>8} {:>10} {:>14} {:>10}".format('Pipeline', 'Status', 'Objective', 'Clashes',
+                                                                   'Variables', 'Timetable (s)', 'Rooms (s)'))
+    for result in results:
+        print("{pipeline:<10} {status:<12} {objective!s:>12} {clashes!s:>8} {variables:>10} {firststage:>14.1f} "
+              "{rooms!s:>10}".format(**result))
+
 if __name__ == '__main__':
     manager.run()